@@ -0,0 +1,253 @@
+import os
+import zipfile
+import posixpath
+import threading
+import logging
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from archive import IMAGE_EXTENSIONS, EXPORT_SUFFIXES, ARCHIVE_MAX_DEPTH, ArchiveBudget, ArchiveLimitError
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Estimated resources of one conversion: memory in bytes, cpu in processes
+Cost = namedtuple('Cost', ['memory', 'cpu'])
+
+# Rough memory use of the parts of a conversion, from converting sample
+# exports and PDFs. Estimates only need to be in the right range; the
+# budget is what keeps several large conversions from running together.
+JOB_BASE_BYTES = 32 * MB  # Conversion state, output buffers
+PROCESS_BYTES = 64 * MB  # A spawned pool process with the converters imported
+PDF_PAGE_PEAK_BYTES = 16 * MB  # Characters and layout objects of the page being analyzed
+PDF_PAGE_BYTES = 64 * 1024  # Document content kept in memory per converted page
+PDF_BYTES_PER_PAGE = 20 * 1024  # Page count assumed from the file size if it cannot be read
+MARKDOWN_EXPANSION = 40  # Markdown text to HTML, parse tree and document tree
+IMAGE_EXPANSION = 10  # Compressed image to decoded pixels
+
+
+class AdmissionError(Exception):
+    """Raised when a conversion needs more than the whole budget, its message can be shown to the user."""
+
+
+def estimate_pdf_cost(pdf_paths, workers=1, streaming_pages=0, window_pages=50):
+    """
+    Estimate the resources needed to convert PDF files one after another.
+
+    Args:
+        pdf_paths: Paths of the uploaded PDFs
+        workers: Processes a PDF's pages are split across
+        streaming_pages: Page count from which PDFs are converted in
+            streaming mode (0 = never)
+        window_pages: Pages kept in memory at a time in streaming mode
+
+    Returns:
+        Cost of the most expensive PDF
+    """
+    memory = 0
+    for path in pdf_paths:
+        size = os.path.getsize(path)
+        pages = count_pdf_pages(path)
+        if pages is None:
+            pages = max(1, size // PDF_BYTES_PER_PAGE)
+
+        # The document and pdfminer's object cache grow with the pages kept
+        kept = pages if not (0 < streaming_pages <= pages) else min(pages, window_pages)
+        pdf_memory = size * kept // pages + kept * PDF_PAGE_BYTES
+        # The finished document is held as bytes, about the size of the PDF
+        pdf_memory += 2 * size
+        memory = max(memory, pdf_memory)
+
+    return _job_cost(memory, PDF_PAGE_PEAK_BYTES, workers)
+
+
+def count_pdf_pages(pdf_path):
+    """Return the page count of a PDF, or None if it cannot be read (damaged, encrypted)."""
+    # Imported with the first PDF upload, or by the app's warm_up()
+    from PyPDF2 import PdfReader
+
+    try:
+        return len(PdfReader(pdf_path, strict=False).pages)
+    except Exception as e:
+        logger.warning('Could not count pages of %s: %s', os.path.basename(pdf_path), e)
+        return None
+
+
+def estimate_markdown_cost(md_paths, workers=1):
+    """Estimate the resources needed to convert standalone markdown files."""
+    largest = max((os.path.getsize(path) for path in md_paths), default=0)
+    return _job_cost(0, largest * MARKDOWN_EXPANSION, workers)
+
+
+def estimate_export_cost(zip_path, workers=1, merge=False):
+    """
+    Estimate the resources needed to convert a Notion export.
+
+    Nested zips are read into memory whole, down to ARCHIVE_MAX_DEPTH
+    levels. Every page is converted on its own, so the largest page and the
+    largest image decide the peak. The members of nested zips are listed
+    from their central directory, read through a stream of the nested zip;
+    finding it decompresses the nested zip, so the sizes declared for it are
+    checked against the archive budgets first, as ExportArchive checks them.
+
+    Args:
+        zip_path: Path to the uploaded zip file
+        workers: Processes the pages are converted in
+        merge: The pages go into one document, which holds every distinct
+            image until it is saved
+
+    Raises:
+        AdmissionError: If the archive exceeds a budget of archive.ArchiveBudget
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            infos, nested_bytes = _export_infos(zf, ARCHIVE_MAX_DEPTH, ArchiveBudget())
+    except zipfile.BadZipFile:
+        # The job rejects the upload, the cost is that of reading it
+        return _job_cost(os.path.getsize(zip_path), 0, 1)
+    except ArchiveLimitError as e:
+        # The job would fail the same way, reject the upload before it is queued
+        raise AdmissionError(str(e))
+
+    sizes = [(info.filename.lower(), info.file_size) for info in infos]
+    largest_page = max((size for name, size in sizes if name.endswith('.md')), default=0)
+    largest_image = max((size for name, size in sizes if name.endswith(IMAGE_EXTENSIONS)), default=0)
+
+    page_memory = largest_page * MARKDOWN_EXPANSION + largest_image * IMAGE_EXPANSION
+    if workers > 1:
+        # Every pool process reopens the archive to read its pages, nested zips included
+        page_memory += nested_bytes
+    memory = nested_bytes
+    if merge:
+        # Copies of an image in several pages or part zips have the same CRC and size
+        images = {(info.CRC, info.file_size) for info in infos if info.filename.lower().endswith(IMAGE_EXTENSIONS)}
+        memory += sum(size for _, size in images)
+    return _job_cost(memory, page_memory, workers)
+
+
+def _export_infos(zf, depth, budget, chain=()):
+    """
+    List the files of an export zip, and those of the zips inside it down to
+    depth levels, without the zips themselves.
+
+    Raises:
+        ArchiveLimitError: If the zips exceed budget, checked before a nested zip is opened
+
+    Returns:
+        (infos, nested_bytes) with nested_bytes the size of the nested zips
+    """
+    infos = []
+    nested_bytes = 0
+    members = zf.infolist()
+    budget.add_zip(members)
+    for info in members:
+        if info.is_dir():
+            continue
+        name = info.filename.lower()
+        if not name.endswith('.zip'):
+            if name.endswith(EXPORT_SUFFIXES):
+                budget.add_member(posixpath.join(*chain, info.filename), info)
+            infos.append(info)
+        elif depth > 0:
+            budget.add_member(posixpath.join(*chain, info.filename), info)
+            nested_bytes += info.file_size
+            try:
+                with zf.open(info) as member, zipfile.ZipFile(member) as nested:
+                    nested_infos, inner_bytes = _export_infos(nested, depth - 1, budget, chain + (info.filename,))
+                infos.extend(nested_infos)
+                nested_bytes += inner_bytes
+            except (zipfile.BadZipFile, OSError, ValueError):
+                # Assume the worst, a single page as large as the nested zip
+                page = zipfile.ZipInfo(info.filename + '.md')
+                page.file_size = info.file_size
+                infos.append(page)
+    return infos, nested_bytes
+
+
+def _job_cost(memory, page_memory, workers):
+    """Cost of a job holding memory throughout and page_memory in every process converting pages."""
+    if workers > 1:
+        return Cost(JOB_BASE_BYTES + memory + workers * (PROCESS_BYTES + page_memory), workers)
+    return Cost(JOB_BASE_BYTES + memory + page_memory, 1)
+
+
+class AdmissionController:
+    """
+    Memory and CPU budget shared by the conversions of one process.
+
+    A conversion is admitted once the estimated costs of the running ones
+    plus its own fit the budget, otherwise it waits. Waiting conversions
+    are admitted in arrival order, so a large one is not starved by a
+    stream of small ones. A conversion alone always runs, so an estimate
+    over the CPU budget cannot block the queue; one whose memory estimate
+    exceeds the whole budget is rejected up front by check().
+
+    Args:
+        memory_budget: Bytes the running conversions may use together (0 = no limit)
+        cpu_budget: Processes the running conversions may use together (0 = no limit)
+    """
+
+    def __init__(self, memory_budget, cpu_budget):
+        self.memory_budget = memory_budget
+        self.cpu_budget = cpu_budget
+        self._memory = 0
+        self._cpu = 0
+        self._running = 0
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    def check(self, cost):
+        """
+        Reject a conversion before it is queued if it could never run.
+
+        Raises:
+            AdmissionError: If cost can never fit the memory budget
+        """
+        if self.memory_budget and cost.memory > self.memory_budget:
+            raise AdmissionError(
+                f'This upload needs about {cost.memory // MB} MB to convert, more than the '
+                f'{self.memory_budget // MB} MB the server allows. Please split it into smaller files.'
+            )
+
+    @contextmanager
+    def admit(self, cost):
+        """Wait until cost fits the budget and hold it for the duration of the with block."""
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            self._condition.wait_for(lambda: self._waiting[0] is ticket and self._fits(cost))
+            self._waiting.popleft()
+            self._memory += cost.memory
+            self._cpu += cost.cpu
+            self._running += 1
+            # The next waiter may fit as well
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._memory -= cost.memory
+                self._cpu -= cost.cpu
+                self._running -= 1
+                self._condition.notify_all()
+
+    def stats(self):
+        """Return the budget and how much of it is in use."""
+        with self._condition:
+            return {
+                'memory_budget': self.memory_budget,
+                'memory_in_use': self._memory,
+                'cpu_budget': self.cpu_budget,
+                'cpu_in_use': self._cpu,
+                'running': self._running,
+                'waiting': len(self._waiting),
+            }
+
+    def _fits(self, cost):
+        if self._running == 0:
+            return True
+        if self.memory_budget and self._memory + cost.memory > self.memory_budget:
+            return False
+        if self.cpu_budget and self._cpu + cost.cpu > self.cpu_budget:
+            return False
+        return True
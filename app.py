@@ -1,13 +1,38 @@
+import time
+_import_start = time.perf_counter()  # Import time of the app and its dependencies, see /startup/stats
+
+import io
 import os
+import sys
+import hmac
 import uuid
+import random
+import importlib
+import threading
+import posixpath
 import zipfile
 import shutil
-from pathlib import Path
-from flask import Flask, render_template, request, send_file, flash, redirect, url_for, session, g
+import logging
+from flask import Flask, Response, render_template, request, send_file, flash, redirect, url_for, session, g, jsonify
 from flask_babel import Babel, gettext, get_locale
-from werkzeug.utils import secure_filename
-from converter import convert_markdown_to_docx
-from pdf_converter import convert_pdf_to_docx_simple
+from werkzeug.utils import secure_filename, send_file as send_file_headers
+from urllib.parse import quote
+from cache import ConversionCache
+from archive import ExportArchive, OutputArchive, ArchiveLimitError
+from jobs import JobQueue, JobError, QueueFullError, PENDING, RUNNING, DONE, FAILED
+from retention import RetentionJanitor
+import metrics
+import logs
+from profiling import ProfileStore, active as profiling_active
+from admission import (
+    AdmissionController, AdmissionError, estimate_export_cost, estimate_markdown_cost, estimate_pdf_cost,
+)
+
+logger = logging.getLogger(__name__)
+
+# Leveled records through a queue to stdout, unless the process (a benchmark) set up logging itself
+if not logs.configured():
+    logs.configure()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')  # Use env var in production
@@ -17,10 +42,34 @@ UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER', 'output')
 ALLOWED_EXTENSIONS = {'zip'}
 MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # 100MB default
+JOBS_FOLDER = os.environ.get('JOBS_FOLDER', os.path.join(OUTPUT_FOLDER, 'jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # Conversions running at once per process
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 16))  # Conversions waiting for a worker
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 1))  # Processes per PDF conversion (1 = no process pool)
+MARKDOWN_WORKERS = int(os.environ.get('MARKDOWN_WORKERS', 1))  # Processes per multi-file conversion (1 = no process pool)
+MARKDOWN_ENGINE = os.environ.get('MARKDOWN_ENGINE', 'html')  # 'html' (markdown2) or 'tokens' (markdown-it, no HTML step)
+CACHE_FOLDER = os.environ.get('CACHE_FOLDER', 'cache')
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 1GB default, 0 disables the cache
+DOWNLOAD_MODE = os.environ.get('DOWNLOAD_MODE', 'direct')  # 'direct', 'x-accel' (nginx) or 'x-sendfile' (Apache, lighttpd)
+DOWNLOAD_ACCEL_PREFIX = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-output/')  # nginx internal location serving OUTPUT_FOLDER
+RETENTION_TTL = int(os.environ.get('RETENTION_TTL', 24 * 60 * 60))  # Seconds uploads, results and job states are kept
+RETENTION_MAX_BYTES = int(os.environ.get('RETENTION_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # 2GB for uploads and results together, 0 = no quota
+RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', 300))  # Seconds between cleanup sweeps, 0 disables the cleanup
+ADMISSION_MEMORY_BUDGET = int(os.environ.get('ADMISSION_MEMORY_BUDGET', 640 * 1024 * 1024))  # Estimated bytes of running conversions per process, 0 = no limit
+ADMISSION_CPU_BUDGET = int(os.environ.get('ADMISSION_CPU_BUDGET', os.cpu_count() or 1))  # Conversion processes per process, 0 = no limit
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # Enables the X-Profile header and /admin endpoints, empty disables them
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', os.path.join(OUTPUT_FOLDER, 'profiles'))
+PROFILE_SAMPLE_PERCENT = float(os.environ.get('PROFILE_SAMPLE_PERCENT', 0))  # Percentage of conversions profiled at random
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', 0))  # Seconds import plus warm-up should take, longer is logged; 0 = no limit
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['PDF_WORKERS'] = PDF_WORKERS
+app.config['MARKDOWN_WORKERS'] = MARKDOWN_WORKERS
+app.config['MARKDOWN_ENGINE'] = MARKDOWN_ENGINE
+app.config['DOWNLOAD_MODE'] = DOWNLOAD_MODE
+app.config['DOWNLOAD_ACCEL_PREFIX'] = DOWNLOAD_ACCEL_PREFIX
 
 # Babel configuration for i18n
 app.config['BABEL_DEFAULT_LOCALE'] = 'en'
@@ -58,11 +107,68 @@ babel.init_app(app, locale_selector=get_locale)
 for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
+# Background conversion jobs, started once their estimated cost fits the budget
+admission = AdmissionController(ADMISSION_MEMORY_BUDGET, ADMISSION_CPU_BUDGET)
+job_queue = JobQueue(JOBS_FOLDER, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, admission=admission)
+
+# Expire uploads, results and job states, and clean up after crashed requests
+retention = RetentionJanitor(UPLOAD_FOLDER, OUTPUT_FOLDER, JOBS_FOLDER, RETENTION_TTL, RETENTION_MAX_BYTES,
+                             interval=RETENTION_INTERVAL)
+if RETENTION_INTERVAL > 0:
+    retention.start()
+
+# Queue gauges for /metrics, conversion stages are timed by the converters
+metrics.register_gauge('conversion_jobs_queued', 'Conversion jobs waiting for a worker or admission',
+                       lambda: job_queue.active - job_queue.running)
+metrics.register_gauge('conversion_jobs_running', 'Conversion jobs running', lambda: job_queue.running)
+metrics.register_gauge('conversion_admitted_memory_bytes', 'Estimated memory of the admitted conversions',
+                       lambda: admission.stats()['memory_in_use'])
+
+# cProfile dumps of sampled conversions and of those an admin asked for
+profiler = ProfileStore(PROFILE_FOLDER)
+
+# Converted documents keyed by a hash of their inputs
+conversion_cache = ConversionCache(CACHE_FOLDER, CACHE_MAX_BYTES) if CACHE_MAX_BYTES > 0 else None
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def save_upload(file, path):
+    """Save an uploaded file, recording its size and the time taken in the metrics."""
+    with metrics.timed('upload_save'):
+        file.save(path)
+    metrics.count('conversion_bytes_total', os.path.getsize(path), direction='in')
+
+
+def _is_admin(header='X-Admin-Token'):
+    """Whether the request carries ADMIN_TOKEN in the given header."""
+    token = request.headers.get(header, '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+
+def _job_function(func, upload_id):
+    """
+    Return the job function for an upload, profiled if an admin asked for it
+    with the X-Profile header or the upload is sampled by PROFILE_SAMPLE_PERCENT.
+    """
+    if _is_admin('X-Profile') or random.uniform(0, 100) < PROFILE_SAMPLE_PERCENT:
+        logger.info('Profiling conversion of upload %s', upload_id, extra={'upload_id': upload_id})
+        return profiler.wrap(func, upload_id)
+    return func
+
+
+def _pool_workers(setting):
+    """Processes to convert with; profiled jobs convert in their own thread so the profile sees all of it."""
+    return 1 if profiling_active() else app.config[setting]
+
+
+def _cache():
+    """Conversion cache for the running job; profiled jobs skip it so every file is converted."""
+    return None if profiling_active() else conversion_cache
+
+
 def cleanup_temp_files(temp_dir):
     """Remove temporary directory and its contents."""
     if os.path.exists(temp_dir):
@@ -97,28 +203,32 @@ def inject_locale():
 def index():
     # Get download file from session if it exists
     download_file = session.pop('download_file', None)
-    return render_template('index.html', download_file=download_file, active_section='notion')
+    job_id = session.pop('job_id', None)
+    return render_template('index.html', download_file=download_file, job_id=job_id, active_section='notion')
 
 
 @app.route('/notion')
 def notion_converter():
     """Notion to Word converter page."""
     download_file = session.pop('download_file', None)
-    return render_template('index.html', download_file=download_file, active_section='notion')
+    job_id = session.pop('job_id', None)
+    return render_template('index.html', download_file=download_file, job_id=job_id, active_section='notion')
 
 
 @app.route('/markdown')
 def markdown_converter():
     """Markdown to Word converter page."""
     download_file = session.pop('download_file', None)
-    return render_template('index.html', download_file=download_file, active_section='markdown')
+    job_id = session.pop('job_id', None)
+    return render_template('index.html', download_file=download_file, job_id=job_id, active_section='markdown')
 
 
 @app.route('/pdf')
 def pdf_converter():
     """PDF to Word converter page."""
     download_file = session.pop('download_file', None)
-    return render_template('index.html', download_file=download_file, active_section='pdf')
+    job_id = session.pop('job_id', None)
+    return render_template('index.html', download_file=download_file, job_id=job_id, active_section='pdf')
 
 
 @app.route('/robots.txt')
@@ -133,6 +243,249 @@ def sitemap():
     return send_file('static/sitemap.xml', mimetype='application/xml')
 
 
+def _job_accepted(job):
+    """
+    Respond to a route that queued a conversion job.
+
+    API clients asking for JSON get the job ID straight away; browsers are
+    redirected to the index page, which polls the job until it finishes.
+    """
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'status_url': url_for('job_status', job_id=job.id),
+            'result_url': url_for('job_result', job_id=job.id),
+        }), 202
+
+    session['job_id'] = job.id
+    return redirect(url_for('index'))
+
+
+def _convert_notion_export(job, upload_id, zip_path, merge=False):
+    """
+    Background job: convert every markdown file of an uploaded Notion export,
+    into a document each or, with merge, into a single document.
+    """
+    try:
+        # Read the zip in place, nested zips included, instead of extracting it
+        try:
+            archive = ExportArchive(zip_path)
+        except zipfile.BadZipFile:
+            raise JobError('Invalid zip file')
+        except ArchiveLimitError as e:
+            raise JobError(str(e))
+
+        with archive:
+            # Find all markdown files
+            md_files = archive.files('.md')
+            logger.info('Found %d markdown files', len(md_files))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Markdown files: %s', [str(f) for f in md_files])
+
+            if not md_files:
+                raise JobError('No markdown files found in the zip archive')
+
+            if merge:
+                # Named after the upload, without the upload ID prefix
+                export_name = os.path.splitext(os.path.basename(zip_path))[0][len(upload_id) + 1:]
+                return _merge_notion_pages(job, upload_id, md_files, (export_name or 'notion') + '.docx')
+
+            # Converted documents go straight into the output zip
+            output_zip_name = f'{upload_id}_converted.zip'
+            output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
+            logger.debug('Creating output zip: %s', output_zip_path)
+
+            with OutputArchive(output_zip_path) as output:
+                # Convert each markdown file, images are resolved against the directory containing it
+                tasks = [(md_file, md_file.parent) for md_file in md_files]
+                from converter import convert_markdown_files
+                for (md_file, _), data, error in convert_markdown_files(
+                        tasks, workers=_pool_workers('MARKDOWN_WORKERS'), cache=_cache(),
+                        engine=app.config['MARKDOWN_ENGINE']):
+                    if error is None:
+                        output.add(md_file.stem + '.docx', data)
+                        logger.debug('Converted %s', md_file.name)
+                    else:
+                        logger.warning('Error converting %s: %s', md_file.name, error)
+                        job.add_message(f'Error converting {md_file.name}: {str(error)}', 'warning')
+            logger.debug('Created zip with %d files', len(output.filenames))
+
+        # Success message
+        job.add_message(f'Successfully converted {len(output.filenames)} markdown file(s) to Word documents', 'success')
+        logger.info('Conversion complete, download_file=%s', output_zip_name, extra={'documents': len(output.filenames)})
+        return {'download_file': output_zip_name}
+
+    finally:
+        # Cleanup temporary files
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+
+def _merge_notion_pages(job, upload_id, md_files, docx_filename):
+    """
+    Convert the pages of an export into one document, ordered by the page
+    hierarchy, and return the job result serving it directly.
+    """
+    from converter import notion_page_order, convert_notion_pages_to_docx, notion_pages_cache_key
+
+    pages = notion_page_order(md_files)
+    engine = app.config['MARKDOWN_ENGINE']
+    cache = _cache()
+    key = None
+    data = None
+    if cache is not None:
+        try:
+            key = notion_pages_cache_key(pages, engine=engine)
+            data = cache.get(key)
+        except Exception as e:
+            # Let the conversion report the problem
+            logger.warning('Could not compute cache key for the merged document: %s', e)
+
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], upload_id)
+    output_path = os.path.join(output_dir, docx_filename)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if data is not None:
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        failed = []
+    else:
+        try:
+            failed = convert_notion_pages_to_docx(pages, output_path, engine=engine)
+        except Exception:
+            cleanup_temp_files(output_dir)
+            raise
+        for md_file, error in failed:
+            logger.warning('Error converting %s: %s', md_file.name, error)
+            job.add_message(f'Error converting {md_file.name}: {str(error)}', 'warning')
+        if len(failed) == len(pages):
+            cleanup_temp_files(output_dir)
+            raise JobError('No valid markdown files were converted')
+        if key is not None and not failed:
+            with open(output_path, 'rb') as f:
+                cache.put(key, f.read())
+
+    job.add_message(f'Successfully merged {len(pages) - len(failed)} markdown file(s) into one Word document',
+                    'success')
+    logger.info('Conversion complete, file=%s', docx_filename, extra={'documents': 1})
+    return {'file_path': output_path, 'download_name': docx_filename}
+
+
+def _convert_markdown_files(job, upload_id, md_paths):
+    """Background job: convert standalone markdown files saved by the route."""
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+
+    try:
+        output_zip_name = f'{upload_id}_markdown_converted.zip'
+        output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
+        logger.debug('Creating output zip: %s', output_zip_path)
+
+        with OutputArchive(output_zip_path) as output:
+            # Convert each markdown file (no images_dir for standalone markdown)
+            tasks = [(temp_md_path, None) for temp_md_path in md_paths]
+            from converter import convert_markdown_files
+            for (temp_md_path, _), data, error in convert_markdown_files(
+                    tasks, workers=_pool_workers('MARKDOWN_WORKERS'), cache=_cache(),
+                    engine=app.config['MARKDOWN_ENGINE']):
+                filename = os.path.basename(temp_md_path)
+                if error is None:
+                    output.add(os.path.splitext(filename)[0] + '.docx', data)
+                    logger.debug('Converted %s', filename)
+                else:
+                    logger.warning('Error converting %s: %s', filename, error)
+                    job.add_message(f'Error converting {filename}: {str(error)}', 'warning')
+
+            if not output.filenames:
+                raise JobError('No valid markdown files were converted')
+        logger.debug('Created zip with %d files', len(output.filenames))
+
+        # Success message
+        job.add_message(f'Successfully converted {len(output.filenames)} markdown file(s) to Word documents', 'success')
+        logger.info('Conversion complete, download_file=%s', output_zip_name, extra={'documents': len(output.filenames)})
+        return {'download_file': output_zip_name}
+
+    finally:
+        # Cleanup temporary files
+        cleanup_temp_files(upload_dir)
+
+
+def _convert_pdf_cached(pdf_path):
+    """Convert a PDF and return the Word document as bytes, reusing cached conversions."""
+    from pdf_converter import convert_pdf_to_docx_simple, pdf_cache_key
+
+    key = None
+    cache = _cache()
+    if cache is not None:
+        key = pdf_cache_key(pdf_path)
+        data = cache.get(key)
+        if data is not None:
+            logger.info('Cache hit for %s', os.path.basename(pdf_path))
+            return data
+
+    # Convert to Word (using simple mode for better reliability)
+    docx_bytes = io.BytesIO()
+    convert_pdf_to_docx_simple(pdf_path, docx_bytes, workers=_pool_workers('PDF_WORKERS'))
+    data = docx_bytes.getvalue()
+
+    if key is not None:
+        cache.put(key, data)
+    return data
+
+
+def _convert_pdf_files(job, upload_id, pdf_paths):
+    """Background job: convert PDF files saved by the route."""
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+
+    try:
+        # A single PDF is converted straight to the .docx that is served directly
+        if len(pdf_paths) == 1:
+            filename = os.path.basename(pdf_paths[0])
+            docx_filename = os.path.splitext(filename)[0] + '.docx'
+            output_dir = os.path.join(app.config['OUTPUT_FOLDER'], upload_id)
+            output_path = os.path.join(output_dir, docx_filename)
+            os.makedirs(output_dir, exist_ok=True)
+            try:
+                data = _convert_pdf_cached(pdf_paths[0])
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            except Exception as e:
+                logger.warning('Error converting %s: %s', filename, e)
+                job.add_message(f'Error converting {filename}: {str(e)}', 'warning')
+                cleanup_temp_files(output_dir)
+                raise JobError('No valid PDF files were converted')
+            logger.debug('Converted %s', filename)
+            return {'file_path': output_path, 'download_name': docx_filename}
+
+        output_zip_name = f'{upload_id}_pdf_converted.zip'
+        output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
+        logger.debug('Creating output zip: %s', output_zip_path)
+
+        with OutputArchive(output_zip_path) as output:
+            # Convert each PDF file
+            for temp_pdf_path in pdf_paths:
+                filename = os.path.basename(temp_pdf_path)
+                try:
+                    output.add(os.path.splitext(filename)[0] + '.docx', _convert_pdf_cached(temp_pdf_path))
+                    logger.debug('Converted %s', filename)
+                except Exception as e:
+                    logger.warning('Error converting %s: %s', filename, e)
+                    job.add_message(f'Error converting {filename}: {str(e)}', 'warning')
+
+            if not output.filenames:
+                raise JobError('No valid PDF files were converted')
+        logger.debug('Created zip with %d files', len(output.filenames))
+
+        # Success message
+        job.add_message(f'Successfully converted {len(output.filenames)} PDF file(s) to Word documents', 'success')
+        logger.info('Conversion complete, download_file=%s', output_zip_name, extra={'documents': len(output.filenames)})
+        return {'download_file': output_zip_name}
+
+    finally:
+        # Cleanup temporary files
+        cleanup_temp_files(upload_dir)
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     # Check if file was uploaded
@@ -159,100 +512,171 @@ def upload_file():
         # Save uploaded file
         filename = secure_filename(file.filename)
         zip_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{upload_id}_{filename}')
-        file.save(zip_path)
-        print(f"[DEBUG] Saved uploaded file to: {zip_path}")
-
-        # Create temp directory for extraction
-        extract_dir = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
-        os.makedirs(extract_dir, exist_ok=True)
-
-        # Extract zip file
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        print(f"[DEBUG] Extracted zip to: {extract_dir}")
-
-        # Check for nested zip files (common in Notion exports)
-        nested_zips = list(Path(extract_dir).rglob('*.zip'))
-        if nested_zips:
-            print(f"[DEBUG] Found {len(nested_zips)} nested zip files, extracting them...")
-            for nested_zip in nested_zips:
-                nested_extract_dir = nested_zip.parent / nested_zip.stem
-                nested_extract_dir.mkdir(exist_ok=True)
-                try:
-                    with zipfile.ZipFile(nested_zip, 'r') as nested_ref:
-                        nested_ref.extractall(nested_extract_dir)
-                    print(f"[DEBUG] Extracted nested zip: {nested_zip.name}")
-                except Exception as e:
-                    print(f"[DEBUG] Failed to extract nested zip {nested_zip.name}: {e}")
+        save_upload(file, zip_path)
+        logger.info('Saved uploaded file to: %s', zip_path, extra={'upload_id': upload_id})
+
+        # One document for the whole export instead of one per page
+        merge = request.form.get('merge') == '1'
+
+        # Hand the conversion to the job queue
+        try:
+            workers = 1 if merge else app.config['MARKDOWN_WORKERS']
+            cost = estimate_export_cost(zip_path, workers=workers, merge=merge)
+            job = job_queue.submit(upload_id, 'notion', _job_function(_convert_notion_export, upload_id),
+                                   upload_id, zip_path, merge, cost=cost)
+        except QueueFullError:
+            os.remove(zip_path)
+            flash('The server is busy, please try again in a moment', 'error')
+            return redirect(url_for('index'))
+        except AdmissionError as e:
+            os.remove(zip_path)
+            flash(str(e), 'error')
+            return redirect(url_for('index'))
 
-        # Find all markdown files
-        md_files = list(Path(extract_dir).rglob('*.md'))
-        print(f"[DEBUG] Found {len(md_files)} markdown files: {[str(f) for f in md_files]}")
+        return _job_accepted(job)
 
-        if not md_files:
-            print("[DEBUG] No markdown files found in zip")
-            flash('No markdown files found in the zip archive', 'error')
-            cleanup_temp_files(extract_dir)
-            os.remove(zip_path)
+    except Exception as e:
+        logger.exception('Unexpected exception: %s', e)
+        flash(f'An error occurred: {str(e)}', 'error')
+        return redirect(url_for('index'))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the status of a conversion job as JSON."""
+    state = job_queue.get(job_id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_public_job_state(state))
+
+
+def _public_job_state(state):
+    """
+    Job state as shown to clients: the result holds server paths, so a
+    finished job only reports the name of its download and where to get it.
+    """
+    public = {key: value for key, value in state.items() if key != 'result'}
+    result = state.get('result')
+    if state['status'] == DONE and result:
+        public['download_name'] = result.get('download_name') or result.get('download_file')
+        public['result_url'] = url_for('job_result', job_id=state['id'])
+    return public
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Collect the result of a finished conversion job."""
+    state = job_queue.get(job_id)
+    if state is None:
+        flash('Conversion job not found', 'error')
+        return redirect(url_for('index'))
+
+    if state['status'] in (PENDING, RUNNING):
+        return jsonify(_public_job_state(state)), 202
+
+    for category, message in state['messages']:
+        flash(message, category)
+
+    if state['status'] == FAILED:
+        flash(state['error'], 'error')
+        return redirect(url_for('index'))
+
+    result = state['result']
+
+    # Single converted file, return it directly
+    if 'file_path' in result:
+        if not os.path.exists(result['file_path']):
+            flash('File not found', 'error')
             return redirect(url_for('index'))
+        return _send_download(result['file_path'], result['download_name'])
+
+    # Store download file in session and redirect (Post/Redirect/Get pattern)
+    session['download_file'] = result['download_file']
+    return redirect(url_for('index'))
+
+
+def _send_download(file_path, download_name):
+    """
+    Send a converted file from the output folder as an attachment.
+
+    In 'direct' mode the worker streams the file itself. Responses carry an
+    ETag and Last-Modified, and conditional and Range requests are answered,
+    so an interrupted download resumes where it stopped. The proxy modes
+    only send the headers and leave the transfer to the front proxy, which
+    answers conditional and Range requests from the file itself:
+    'x-accel' for nginx (X-Accel-Redirect to DOWNLOAD_ACCEL_PREFIX, an
+    internal location aliased to OUTPUT_FOLDER) and 'x-sendfile' for
+    Apache and lighttpd (X-Sendfile with the absolute path).
+    """
+    mode = app.config['DOWNLOAD_MODE']
+    file_path = os.path.abspath(file_path)
+    relative_path = os.path.relpath(file_path, os.path.abspath(app.config['OUTPUT_FOLDER']))
+    if mode not in ('x-accel', 'x-sendfile') or relative_path.startswith(os.pardir):
+        return send_file(file_path, as_attachment=True, download_name=download_name, conditional=True, etag=True)
+
+    # The proxy handles Range and If-* headers, answer every request with the full file
+    response = send_file_headers(
+        file_path, request.environ, as_attachment=True, download_name=download_name,
+        conditional=False, use_x_sendfile=True, response_class=app.response_class,
+    )
+    if mode == 'x-accel':
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = posixpath.join(
+            app.config['DOWNLOAD_ACCEL_PREFIX'], quote(relative_path.replace(os.sep, '/'))
+        )
+    return response
 
-        # Create output directory for this upload
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], upload_id)
-        os.makedirs(output_dir, exist_ok=True)
 
-        # Convert each markdown file
-        converted_files = []
-        for md_file in md_files:
-            try:
-                # Generate output filename
-                docx_filename = md_file.stem + '.docx'
-                output_path = os.path.join(output_dir, docx_filename)
+@app.route('/cache/stats')
+def cache_stats():
+    """Report conversion cache hit/miss counters for this worker process."""
+    if conversion_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(conversion_cache.stats(), enabled=True))
 
-                # Get the directory containing the markdown file (for image references)
-                images_dir = md_file.parent
 
-                # Convert to Word
-                convert_markdown_to_docx(str(md_file), output_path, str(images_dir))
-                converted_files.append(docx_filename)
-                print(f"[DEBUG] Successfully converted: {md_file.name}")
-            except Exception as e:
-                print(f"[DEBUG] Error converting {md_file.name}: {str(e)}")
-                flash(f'Error converting {md_file.name}: {str(e)}', 'warning')
+@app.route('/admission/stats')
+def admission_stats():
+    """Report the conversion budget of this worker process and how much of it is in use."""
+    return jsonify(dict(admission.stats(), queued_jobs=job_queue.active))
 
-        # Create a zip file with all converted documents
-        output_zip_name = f'{upload_id}_converted.zip'
-        output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
-        print(f"[DEBUG] Creating output zip: {output_zip_path}")
 
-        with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for docx_file in converted_files:
-                file_path = os.path.join(output_dir, docx_file)
-                zipf.write(file_path, docx_file)
-        print(f"[DEBUG] Created zip with {len(converted_files)} files")
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose conversion stage timings, counters and queue gauges in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-        # Cleanup temporary files
-        cleanup_temp_files(extract_dir)
-        cleanup_temp_files(output_dir)
-        os.remove(zip_path)
 
-        # Success message
-        flash(f'Successfully converted {len(converted_files)} markdown file(s) to Word documents', 'success')
-        print(f"[DEBUG] Conversion complete, redirecting with download_file={output_zip_name}")
+@app.route('/admin/profiles')
+def list_profiles():
+    """List the conversion profiles, newest first (requires the X-Admin-Token header)."""
+    if not _is_admin():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'profiles': [
+        dict(dump, url=url_for('download_profile', name=dump['name'])) for dump in profiler.list()
+    ]})
 
-        # Store download file in session and redirect (Post/Redirect/Get pattern)
-        session['download_file'] = output_zip_name
-        return redirect(url_for('index'))
 
-    except zipfile.BadZipFile:
-        print("[DEBUG] BadZipFile exception")
-        flash('Invalid zip file', 'error')
-        return redirect(url_for('index'))
-    except Exception as e:
-        print(f"[DEBUG] Unexpected exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        flash(f'An error occurred: {str(e)}', 'error')
-        return redirect(url_for('index'))
+@app.route('/admin/profiles/<name>')
+def download_profile(name):
+    """
+    Download a conversion profile as a pstats dump, or with ?format=text
+    the functions with the most cumulative time (requires X-Admin-Token).
+    """
+    path = profiler.path(name) if _is_admin() else None
+    if path is None:
+        return jsonify({'error': 'Not found'}), 404
+    if request.args.get('format') == 'text':
+        return Response(profiler.summary(name), mimetype='text/plain')
+    return send_file(path, as_attachment=True, download_name=name)
+
+
+@app.route('/retention/stats')
+def retention_stats():
+    """Report the disk usage of uploads and results found by the last cleanup sweep."""
+    if RETENTION_INTERVAL <= 0:
+        return jsonify({'enabled': False})
+    return jsonify(dict(retention.stats(), enabled=True))
 
 
 @app.route('/download/<filename>')
@@ -264,14 +688,9 @@ def download_file(filename):
             flash('File not found', 'error')
             return redirect(url_for('index'))
 
-        response = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename
-        )
+        response = _send_download(file_path, filename)
 
-        # Schedule file deletion after download (in a production app, use a background task)
-        # For now, we'll leave the file for manual cleanup
+        # The file stays available until the retention janitor expires it
         return response
     except Exception as e:
         flash(f'Error downloading file: {str(e)}', 'error')
@@ -297,67 +716,37 @@ def convert_markdown():
         # Generate unique ID for this conversion
         upload_id = str(uuid.uuid4())
 
-        # Create output directory for this conversion
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], upload_id)
-        os.makedirs(output_dir, exist_ok=True)
+        # Create upload directory for this conversion
+        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+        os.makedirs(upload_dir, exist_ok=True)
 
-        # Convert each markdown file
-        converted_files = []
+        # Save markdown files temporarily, the job converts them
+        md_paths = []
         for file in files:
             if file and file.filename.endswith(('.md', '.markdown')):
-                try:
-                    # Save markdown file temporarily
-                    filename = secure_filename(file.filename)
-                    temp_md_path = os.path.join(output_dir, filename)
-                    file.save(temp_md_path)
-                    print(f"[DEBUG] Saved markdown file: {filename}")
-
-                    # Generate output filename
-                    docx_filename = os.path.splitext(filename)[0] + '.docx'
-                    output_path = os.path.join(output_dir, docx_filename)
-
-                    # Convert to Word (no images_dir for standalone markdown)
-                    convert_markdown_to_docx(temp_md_path, output_path, images_dir=None)
-                    converted_files.append(docx_filename)
-                    print(f"[DEBUG] Successfully converted: {filename}")
-
-                    # Remove temporary markdown file
-                    os.remove(temp_md_path)
-                except Exception as e:
-                    print(f"[DEBUG] Error converting {file.filename}: {str(e)}")
-                    flash(f'Error converting {file.filename}: {str(e)}', 'warning')
-
-        if not converted_files:
-            flash('No valid markdown files were converted', 'error')
-            cleanup_temp_files(output_dir)
+                filename = secure_filename(file.filename)
+                temp_md_path = os.path.join(upload_dir, filename)
+                save_upload(file, temp_md_path)
+                md_paths.append(temp_md_path)
+                logger.debug('Saved markdown file: %s', filename, extra={'upload_id': upload_id})
+
+        try:
+            cost = estimate_markdown_cost(md_paths, workers=app.config['MARKDOWN_WORKERS'])
+            job = job_queue.submit(upload_id, 'markdown', _job_function(_convert_markdown_files, upload_id),
+                                   upload_id, md_paths, cost=cost)
+        except QueueFullError:
+            cleanup_temp_files(upload_dir)
+            flash('The server is busy, please try again in a moment', 'error')
+            return redirect(url_for('index'))
+        except AdmissionError as e:
+            cleanup_temp_files(upload_dir)
+            flash(str(e), 'error')
             return redirect(url_for('index'))
 
-        # Create a zip file with all converted documents
-        output_zip_name = f'{upload_id}_markdown_converted.zip'
-        output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
-        print(f"[DEBUG] Creating output zip: {output_zip_path}")
-
-        with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for docx_file in converted_files:
-                file_path = os.path.join(output_dir, docx_file)
-                zipf.write(file_path, docx_file)
-        print(f"[DEBUG] Created zip with {len(converted_files)} files")
-
-        # Cleanup temporary files
-        cleanup_temp_files(output_dir)
-
-        # Success message
-        flash(f'Successfully converted {len(converted_files)} markdown file(s) to Word documents', 'success')
-        print(f"[DEBUG] Conversion complete, redirecting with download_file={output_zip_name}")
-
-        # Store download file in session and redirect (Post/Redirect/Get pattern)
-        session['download_file'] = output_zip_name
-        return redirect(url_for('index'))
+        return _job_accepted(job)
 
     except Exception as e:
-        print(f"[DEBUG] Unexpected exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Unexpected exception: %s', e)
         flash(f'An error occurred: {str(e)}', 'error')
         return redirect(url_for('index'))
 
@@ -381,83 +770,113 @@ def convert_pdf():
         # Generate unique ID for this conversion
         upload_id = str(uuid.uuid4())
 
-        # Create output directory for this conversion
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], upload_id)
-        os.makedirs(output_dir, exist_ok=True)
+        # Create upload directory for this conversion
+        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+        os.makedirs(upload_dir, exist_ok=True)
 
-        # Convert each PDF file
-        converted_files = []
+        # Save PDF files temporarily, the job converts them
+        pdf_paths = []
         for file in files:
             if file and file.filename.lower().endswith('.pdf'):
-                try:
-                    # Save PDF file temporarily
-                    filename = secure_filename(file.filename)
-                    temp_pdf_path = os.path.join(output_dir, filename)
-                    file.save(temp_pdf_path)
-                    print(f"[DEBUG] Saved PDF file: {filename}")
-
-                    # Generate output filename
-                    docx_filename = os.path.splitext(filename)[0] + '.docx'
-                    output_path = os.path.join(output_dir, docx_filename)
-
-                    # Convert to Word (using simple mode for better reliability)
-                    convert_pdf_to_docx_simple(temp_pdf_path, output_path)
-                    converted_files.append(docx_filename)
-                    print(f"[DEBUG] Successfully converted: {filename}")
-
-                    # Remove temporary PDF file
-                    os.remove(temp_pdf_path)
-                except Exception as e:
-                    print(f"[DEBUG] Error converting {file.filename}: {str(e)}")
-                    flash(f'Error converting {file.filename}: {str(e)}', 'warning')
-
-        if not converted_files:
-            flash('No valid PDF files were converted', 'error')
-            cleanup_temp_files(output_dir)
+                filename = secure_filename(file.filename)
+                temp_pdf_path = os.path.join(upload_dir, filename)
+                save_upload(file, temp_pdf_path)
+                pdf_paths.append(temp_pdf_path)
+                logger.debug('Saved PDF file: %s', filename, extra={'upload_id': upload_id})
+
+        try:
+            from pdf_converter import PDF_STREAMING_PAGES, STREAMING_WINDOW_PAGES
+            cost = estimate_pdf_cost(pdf_paths, workers=app.config['PDF_WORKERS'],
+                                     streaming_pages=PDF_STREAMING_PAGES, window_pages=STREAMING_WINDOW_PAGES)
+            job = job_queue.submit(upload_id, 'pdf', _job_function(_convert_pdf_files, upload_id),
+                                   upload_id, pdf_paths, cost=cost)
+        except QueueFullError:
+            cleanup_temp_files(upload_dir)
+            flash('The server is busy, please try again in a moment', 'error')
+            return redirect(url_for('index'))
+        except AdmissionError as e:
+            cleanup_temp_files(upload_dir)
+            flash(str(e), 'error')
             return redirect(url_for('index'))
 
-        # If only one file, return it directly
-        if len(converted_files) == 1:
-            file_path = os.path.join(output_dir, converted_files[0])
-            response = send_file(
-                file_path,
-                as_attachment=True,
-                download_name=converted_files[0]
-            )
-            # Cleanup after sending
-            # Note: In production, use a background task for cleanup
-            return response
-
-        # Create a zip file with all converted documents
-        output_zip_name = f'{upload_id}_pdf_converted.zip'
-        output_zip_path = os.path.join(app.config['OUTPUT_FOLDER'], output_zip_name)
-        print(f"[DEBUG] Creating output zip: {output_zip_path}")
-
-        with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for docx_file in converted_files:
-                file_path = os.path.join(output_dir, docx_file)
-                zipf.write(file_path, docx_file)
-        print(f"[DEBUG] Created zip with {len(converted_files)} files")
-
-        # Cleanup temporary files
-        cleanup_temp_files(output_dir)
-
-        # Success message
-        flash(f'Successfully converted {len(converted_files)} PDF file(s) to Word documents', 'success')
-        print(f"[DEBUG] Conversion complete, redirecting with download_file={output_zip_name}")
-
-        # Store download file in session and redirect (Post/Redirect/Get pattern)
-        session['download_file'] = output_zip_name
-        return redirect(url_for('index'))
+        return _job_accepted(job)
 
     except Exception as e:
-        print(f"[DEBUG] Unexpected exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Unexpected exception: %s', e)
         flash(f'An error occurred: {str(e)}', 'error')
         return redirect(url_for('index'))
 
 
+def warm_up():
+    """
+    Load what the first requests of a process would otherwise wait for.
+
+    The converters and their libraries (python-docx, BeautifulSoup,
+    pdfplumber, PyPDF2) are not imported with the app, a process that only
+    serves pages and job results never needs them. Warming up imports them,
+    builds both document templates with a sample conversion, and renders
+    every page in every language, which compiles the Jinja templates and
+    loads the translations. Only the first call does the work; gunicorn.conf.py
+    calls it in every worker, or once in the master with preload_app.
+
+    Returns:
+        The startup report, as served by /startup/stats
+    """
+    with _warm_up_lock:
+        if startup['warm_up_seconds'] is not None:
+            return startup
+
+        steps = startup['warm_up_steps']
+
+        def step(name, func):
+            start = time.perf_counter()
+            func()
+            steps[name] = round(time.perf_counter() - start, 3)
+
+        step('import_converter', lambda: importlib.import_module('converter'))
+        step('import_pdf_converter', lambda: [importlib.import_module(name) for name in ('pdf_converter', 'PyPDF2')])
+        step('markdown_sample', lambda: importlib.import_module('converter').warm_up(app.config['MARKDOWN_ENGINE']))
+        step('pdf_template', lambda: importlib.import_module('pdf_converter').warm_up())
+        step('pages', _render_pages)
+        # The sample conversion is not one to report
+        metrics.drain()
+
+        startup['warm_up_seconds'] = round(sum(steps.values()), 3)
+        total = startup['import_seconds'] + startup['warm_up_seconds']
+        logger.info('Started in %.2fs: import %.2fs, warm-up %s', total, startup['import_seconds'], steps)
+        if 0 < STARTUP_BUDGET < total:
+            logger.warning('Start-up took %.2fs, more than STARTUP_BUDGET (%gs)', total, STARTUP_BUDGET)
+    return startup
+
+
+def _render_pages():
+    client = app.test_client()
+    for rule in ('index', 'notion_converter', 'markdown_converter', 'pdf_converter'):
+        for lang in ('en', 'zh_CN', 'zh_TW', 'ja'):
+            with app.test_request_context():
+                url = url_for(rule, lang=lang)
+            response = client.get(url)
+            if response.status_code != 200:
+                logger.warning('Warm-up request %s returned %d', url, response.status_code)
+
+
+@app.route('/startup/stats')
+def startup_stats():
+    """Report how long this worker process took to import the app and to warm up."""
+    return jsonify(dict(startup, pid=os.getpid(),
+                        converters_loaded='converter' in sys.modules and 'pdf_converter' in sys.modules))
+
+
+# Filled in when the module has been imported and by warm_up()
+startup = {
+    'import_seconds': round(time.perf_counter() - _import_start, 3),
+    'warm_up_seconds': None,
+    'warm_up_steps': {},
+    'budget_seconds': STARTUP_BUDGET or None,
+}
+_warm_up_lock = threading.Lock()
+
+
 if __name__ == '__main__':
     # Get configuration from environment variables
     debug_mode = os.environ.get('FLASK_ENV', 'development') == 'development'
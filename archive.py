@@ -0,0 +1,330 @@
+import io
+import os
+import time
+import posixpath
+import zipfile
+import logging
+import metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+# Members of a Notion export the converters use: pages, database tables and images
+EXPORT_SUFFIXES = ('.md', '.csv') + IMAGE_EXTENSIONS
+
+# Budgets of an uploaded archive, checked before any member is read (0 = no limit)
+ARCHIVE_MAX_DEPTH = int(os.environ.get('ARCHIVE_MAX_DEPTH', 3))  # Levels of zips inside the upload that are opened, 0 = none
+ARCHIVE_MAX_BYTES = int(os.environ.get('ARCHIVE_MAX_BYTES', 1024 * 1024 * 1024))  # 1GB of pages, tables, images and nested zips
+ARCHIVE_MAX_MEMBERS = int(os.environ.get('ARCHIVE_MAX_MEMBERS', 50000))  # Entries of all zips together
+ARCHIVE_MAX_RATIO = int(os.environ.get('ARCHIVE_MAX_RATIO', 100))  # Uncompressed to compressed size of a member
+RATIO_MIN_BYTES = 1024 * 1024  # Smaller members may compress well, e.g. pages of a repeated table row
+
+
+class ArchivePath:
+    """
+    A file or directory inside an export archive.
+
+    Offers the small part of the pathlib API the converters need (name, stem,
+    parent, joinpath, is_file, read_bytes, read_text) so archive members can
+    be converted without extracting them to disk. Paths pickle as a reference
+    to the archive on disk, so they can be handed to worker processes.
+    """
+
+    def __init__(self, archive, chain, at):
+        self.archive = archive
+        self.chain = chain  # Names of the nested zips leading to this member
+        self.at = at  # Member name inside the innermost zip, '' for its root
+
+    @property
+    def name(self):
+        return posixpath.basename(self.at.rstrip('/'))
+
+    @property
+    def stem(self):
+        return posixpath.splitext(self.name)[0]
+
+    @property
+    def suffix(self):
+        return posixpath.splitext(self.name)[1]
+
+    @property
+    def parent(self):
+        return ArchivePath(self.archive, self.chain, posixpath.dirname(self.at.rstrip('/')))
+
+    def joinpath(self, *parts):
+        """Join relative parts, resolving '.' and '..' inside the archive."""
+        at = posixpath.normpath(posixpath.join(self.at, *parts))
+        if at in ('.', '') or at.startswith('../') or at == '..':
+            at = ''
+        return ArchivePath(self.archive, self.chain, at)
+
+    def is_file(self):
+        return self.at in self.archive.names(self.chain)
+
+    def exists(self):
+        if not self.at or self.is_file():
+            return True
+        prefix = self.at + '/'
+        return any(name.startswith(prefix) for name in self.archive.names(self.chain))
+
+    def read_bytes(self):
+        with metrics.timed('zip_extract'):
+            return self.archive.zipfile(self.chain).read(self.at)
+
+    def read_text(self, encoding='utf-8'):
+        return self.read_bytes().decode(encoding)
+
+    def __str__(self):
+        return posixpath.join(self.archive.zip_path, *self.chain, self.at)
+
+    def __repr__(self):
+        return f'ArchivePath({str(self)!r})'
+
+    def __reduce__(self):
+        return (_reopen_path, (self.archive.zip_path, self.archive.options, self.chain, self.at))
+
+
+class ArchiveLimitError(Exception):
+    """Raised when an archive exceeds an expansion budget, its message can be shown to the user."""
+
+
+class ArchiveBudget:
+    """
+    Expansion budgets of one archive, checked against the sizes its zips
+    declare in their central directories before a member is read.
+
+    zipfile stops reading a member at its declared size, so the declared
+    sizes bound what is decompressed.
+
+    Args:
+        max_bytes: Uncompressed size of the checked members together
+        max_members: Entries of all the zips together
+        max_ratio: Compression ratio of a checked member larger than RATIO_MIN_BYTES
+
+    The limits default to the ARCHIVE_* settings, 0 turns one off.
+    """
+
+    def __init__(self, max_bytes=None, max_members=None, max_ratio=None):
+        self.max_bytes = ARCHIVE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_members = ARCHIVE_MAX_MEMBERS if max_members is None else max_members
+        self.max_ratio = ARCHIVE_MAX_RATIO if max_ratio is None else max_ratio
+        self.total_bytes = 0
+        self.members = 0
+
+    def add_zip(self, infos):
+        """Count the entries of a zip, raise ArchiveLimitError past max_members."""
+        self.members += len(infos)
+        if 0 < self.max_members < self.members:
+            raise ArchiveLimitError(f'The archive has more than {self.max_members} files')
+
+    def add_member(self, where, info):
+        """Count a member about to be read, raise ArchiveLimitError if it breaks a budget."""
+        if (info.file_size > RATIO_MIN_BYTES and 0 < self.max_ratio
+                and info.file_size > self.max_ratio * max(info.compress_size, 1)):
+            raise ArchiveLimitError(
+                f'{where} is compressed more than {self.max_ratio} times, the archive looks malformed')
+        self.total_bytes += info.file_size
+        if 0 < self.max_bytes < self.total_bytes:
+            raise ArchiveLimitError(
+                f'The archive expands to more than {self.max_bytes // (1024 * 1024)} MB, please split the export')
+
+
+class ExportArchive:
+    """
+    Read-only view over a Notion export zip, nested zips included.
+
+    Notion splits large exports into zips inside the downloaded zip. Those
+    are opened in memory, recursively up to max_depth levels, and their
+    members are listed alongside the outer ones. Only members with one of
+    the given suffixes are listed; nothing else is ever read, and members
+    are only read when a converter asks for them, so images no page refers
+    to are never decompressed.
+
+    Before a nested zip or member is read, the sizes declared in the zips'
+    central directories are checked against an ArchiveBudget: the listed
+    members and the nested zips held in memory together, the number of
+    entries, and the compression ratio of every member that can be read.
+
+    Args:
+        zip_path: Path to the uploaded zip file
+        suffixes: Extensions of the members listed, lower case
+        max_depth: Levels of zips inside the upload that are opened, deeper ones are skipped
+        max_bytes: Uncompressed size of the listed members and nested zips together
+        max_members: Entries of all the zips together
+        max_ratio: Compression ratio of a listed member or nested zip larger than RATIO_MIN_BYTES
+
+    Raises:
+        zipfile.BadZipFile: If zip_path is not a zip file
+        ArchiveLimitError: If the archive exceeds a budget
+    """
+
+    def __init__(self, zip_path, suffixes=EXPORT_SUFFIXES, max_depth=None, max_bytes=None,
+                 max_members=None, max_ratio=None):
+        self.zip_path = zip_path
+        self.suffixes = tuple(suffixes)
+        self.max_depth = ARCHIVE_MAX_DEPTH if max_depth is None else max_depth
+        self.budget = ArchiveBudget(max_bytes, max_members, max_ratio)
+        # Arguments that open the archive the same way in another process
+        self.options = {
+            'suffixes': self.suffixes,
+            'max_depth': self.max_depth,
+            'max_bytes': self.budget.max_bytes,
+            'max_members': self.budget.max_members,
+            'max_ratio': self.budget.max_ratio,
+        }
+        self._names = {}
+        self._infos = {}
+        self.nested = []
+
+        with metrics.timed('zip_extract'):
+            self._zips = {(): zipfile.ZipFile(zip_path, 'r')}
+            try:
+                self._expand(())
+            except BaseException:
+                self.close()
+                raise
+
+    def _expand(self, chain):
+        """Check the budgets for one zip, then open the zips inside it (common in Notion exports)."""
+        zf = self._zips[chain]
+        infos = zf.infolist()
+        self.budget.add_zip(infos)
+
+        listed = []
+        nested = []
+        for info in infos:
+            if info.is_dir():
+                continue
+            name = info.filename.lower()
+            if name.endswith('.zip'):
+                if len(chain) >= self.max_depth:
+                    logger.warning('Skipping %s, zips are opened %d levels deep', info.filename, self.max_depth)
+                    continue
+                nested.append(info)
+            elif not name.endswith(self.suffixes):
+                continue
+            else:
+                listed.append(info)
+            self.budget.add_member(posixpath.join(*chain, info.filename), info)
+        self._infos[chain] = listed
+
+        for info in nested:
+            try:
+                data = zf.read(info)
+                nested_zip = zipfile.ZipFile(io.BytesIO(data), 'r')
+            except (zipfile.BadZipFile, OSError, ValueError) as e:
+                # Not a zip after all, or damaged: its pages are missing from the conversion
+                logger.warning('Failed to open nested zip %s: %s', info.filename, e)
+                continue
+            nested_chain = chain + (info.filename,)
+            self._zips[nested_chain] = nested_zip
+            self.nested.append(posixpath.join(*nested_chain))
+            logger.debug('Opened nested zip: %s', posixpath.join(*nested_chain))
+            self._expand(nested_chain)
+
+    def zipfile(self, chain):
+        return self._zips[chain]
+
+    def names(self, chain):
+        """Return the set of listed member names of one zip in the archive."""
+        if chain not in self._names:
+            self._names[chain] = {info.filename for info in self._infos[chain]}
+        return self._names[chain]
+
+    def files(self, suffix=None):
+        """
+        List the files in the archive with one of its suffixes, nested zips included.
+
+        Args:
+            suffix: Only return files with this extension (e.g. '.md')
+        """
+        paths = []
+        for chain in self._zips:
+            for info in self._infos[chain]:
+                if suffix and not info.filename.lower().endswith(suffix):
+                    continue
+                paths.append(ArchivePath(self, chain, info.filename))
+        return paths
+
+    def close(self):
+        for zf in self._zips.values():
+            zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Archives opened in this process for unpickled paths, keyed by zip path
+_open_archives = {}
+
+
+def _reopen_path(zip_path, options, chain, at):
+    # Opened with the suffixes and budgets of the archive the path was pickled from
+    archive = _open_archives.get(zip_path)
+    if archive is None:
+        archive = _open_archives[zip_path] = ExportArchive(zip_path, **options)
+    return ArchivePath(archive, chain, at)
+
+
+class OutputArchive:
+    """
+    Zip of converted documents, written entry by entry as conversions finish.
+
+    A .docx is itself a zip whose parts are already deflated, so entries are
+    stored instead of being compressed a second time. The archive is written
+    under a temporary name and only appears at path once it is complete.
+
+    Args:
+        path: Where the finished zip file should be created
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = f'{path}.part'
+        self._zip = zipfile.ZipFile(self._tmp_path, 'w', zipfile.ZIP_STORED)
+        self.filenames = []
+
+    def add(self, filename, data):
+        """
+        Add a converted document, renaming it if the name is already taken.
+
+        Returns:
+            The name the document was stored under
+        """
+        stem, ext = posixpath.splitext(filename)
+        name = filename
+        counter = 2
+        while name in self.filenames:
+            name = f'{stem} ({counter}){ext}'
+            counter += 1
+
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        with metrics.timed('output_zip'):
+            self._zip.writestr(info, data)
+        self.filenames.append(name)
+        return name
+
+    def close(self):
+        """Finish the archive and move it to its final path."""
+        self._zip.close()
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self):
+        """Abandon the archive and remove the partial file."""
+        self._zip.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
@@ -0,0 +1,242 @@
+"""
+Benchmark the converters and the upload pipeline on synthetic inputs.
+
+Cases:
+    markdown  convert_markdown_to_docx on every page of a synthetic Notion export
+    pdf       convert_pdf_to_docx on a synthetic PDF
+    upload    POST /upload of the export through the Flask app, until the job is done
+
+Every case runs in a fresh process, so its peak RSS is its own and no cache
+(converted documents, processed images) is warm. The conversion cache is
+off. Results are compared with benchmarks/baselines.json: a case fails when
+it is slower or needs more memory than its baseline by more than the
+tolerance. Record new baselines with --update-baselines after an intended
+change, on the machine the comparisons run on.
+
+Usage:
+    python benchmarks/bench_conversions.py [--scales small,medium] [--cases markdown,pdf,upload]
+        [--repeat 3] [--json results.json] [--update-baselines] [--time-tolerance 0.5] [--memory-tolerance 0.25]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from generators import make_notion_export, make_pdf
+
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+CASES = ('markdown', 'pdf', 'upload')
+
+# Input sizes per scale
+SCALES = {
+    'small': {'pages': 5, 'table_rows': 50, 'images': 2, 'pdf_pages': 5},
+    'medium': {'pages': 25, 'table_rows': 500, 'images': 4, 'pdf_pages': 50},
+    'large': {'pages': 100, 'table_rows': 2000, 'images': 6, 'pdf_pages': 250},
+}
+
+
+def make_fixtures(directory, scale):
+    """Generate the inputs of one scale, return {'notion': path, 'pdf': path}."""
+    params = SCALES[scale]
+    fixtures = {
+        'notion': os.path.join(directory, f'notion-{scale}.zip'),
+        'pdf': os.path.join(directory, f'document-{scale}.pdf'),
+    }
+    make_notion_export(fixtures['notion'], params['pages'], params['table_rows'], params['images'])
+    make_pdf(fixtures['pdf'], params['pdf_pages'])
+    return fixtures
+
+
+# The converters are imported by the cases, after run_case pointed their
+# folders and caches at a scratch directory through the environment
+
+def run_markdown(fixture):
+    from archive import ExportArchive
+    from converter import convert_markdown_to_docx
+
+    start = time.perf_counter()
+    with ExportArchive(fixture) as archive:
+        pages = archive.files('.md')
+        for md_file in pages:
+            convert_markdown_to_docx(md_file, io.BytesIO(), md_file.parent)
+    return time.perf_counter() - start, len(pages)
+
+
+def run_pdf(fixture):
+    import pdfplumber
+    from pdf_converter import convert_pdf_to_docx
+
+    with pdfplumber.open(fixture) as pdf:
+        pages = len(pdf.pages)
+    start = time.perf_counter()
+    convert_pdf_to_docx(fixture, io.BytesIO())
+    return time.perf_counter() - start, pages
+
+
+def run_upload(fixture):
+    from app import app, warm_up
+
+    # As gunicorn.conf.py does before a worker takes requests
+    warm_up()
+    client = app.test_client()
+    start = time.perf_counter()
+    with open(fixture, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, os.path.basename(fixture))},
+                               headers={'Accept': 'application/json'})
+    if response.status_code != 202:
+        raise RuntimeError(f'Upload failed with status {response.status_code}')
+    job_id = response.get_json()['job_id']
+    while True:
+        state = client.get(f'/jobs/{job_id}').get_json()
+        if state['status'] not in ('pending', 'running'):
+            break
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - start
+    if state['status'] != 'done':
+        raise RuntimeError(f'Conversion job failed: {state["error"]}')
+
+    from archive import ExportArchive
+    with ExportArchive(fixture) as archive:
+        pages = len(archive.files('.md'))
+    return elapsed, pages
+
+
+def run_case(case, fixture):
+    """Run one case in this process and print its result as JSON."""
+    from memory import peak_rss
+
+    # Convert from a clean state: no cached documents or images, fresh folders
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'OUTPUT_FOLDER': os.path.join(workdir, 'output'),
+        'CACHE_FOLDER': os.path.join(workdir, 'cache'),
+        'CACHE_MAX_BYTES': '0',
+        'IMAGE_CACHE_FOLDER': os.path.join(workdir, 'images'),
+        'IMAGE_CACHE_MAX_BYTES': '0',
+        'RETENTION_INTERVAL': '0',
+    })
+    # Only warnings, and on stderr: stdout carries the result line
+    import logs
+    logs.configure(level='WARNING', stream='stderr')
+    try:
+        seconds, pages = globals()[f'run_{case}'](fixture)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({
+        'seconds': seconds,
+        'pages': pages,
+        'input_bytes': os.path.getsize(fixture),
+        'peak_rss': peak_rss(),
+    }))
+
+
+def measure(case, fixture, repeat):
+    """Run a case repeat times in fresh processes, return the fastest time and the highest peak RSS."""
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-case', case, fixture],
+            capture_output=True, text=True, cwd=os.path.dirname(BENCH_DIR),
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f'{case} failed:\n{result.stderr}')
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+
+    best = min(runs, key=lambda run: run['seconds'])
+    best['peak_rss'] = max(run['peak_rss'] for run in runs)
+    best['pages_per_second'] = best['pages'] / best['seconds']
+    best['mb_per_second'] = best['input_bytes'] / best['seconds'] / (1024 * 1024)
+    return best
+
+
+def compare(results, baselines, time_tolerance, memory_tolerance):
+    """Return the regressions of results against baselines as messages."""
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if result['seconds'] > baseline['seconds'] * (1 + time_tolerance):
+            regressions.append(f'{key}: {result["seconds"]:.2f}s, baseline {baseline["seconds"]:.2f}s')
+        if result['peak_rss'] > baseline['peak_rss'] * (1 + memory_tolerance):
+            regressions.append(f'{key}: peak RSS {result["peak_rss"] // (1024 * 1024)} MB, '
+                               f'baseline {baseline["peak_rss"] // (1024 * 1024)} MB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='small,medium', help=f'Comma-separated scales ({", ".join(SCALES)})')
+    parser.add_argument('--cases', default=','.join(CASES), help='Comma-separated cases')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the fastest counts')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--update-baselines', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, help='Allowed slowdown (0.5 = 50%%)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='Allowed peak RSS growth')
+    parser.add_argument('--run-case', nargs=2, metavar=('CASE', 'FIXTURE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(*args.run_case)
+        return
+
+    scales = args.scales.split(',')
+    cases = args.cases.split(',')
+    results = {}
+    fixture_dir = tempfile.mkdtemp(prefix='bench-fixtures-')
+    try:
+        print(f'{"case":<18} {"seconds":>8} {"pages/s":>8} {"MB/s":>7} {"peak MB":>8}')
+        for scale in scales:
+            fixtures = make_fixtures(fixture_dir, scale)
+            for case in cases:
+                result = measure(case, fixtures['pdf' if case == 'pdf' else 'notion'], args.repeat)
+                key = f'{case}-{scale}'
+                results[key] = result
+                print(f'{key:<18} {result["seconds"]:>8.2f} {result["pages_per_second"]:>8.1f} '
+                      f'{result["mb_per_second"]:>7.2f} {result["peak_rss"] / (1024 * 1024):>8.0f}')
+    finally:
+        shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    if args.update_baselines:
+        baselines.setdefault('results', {}).update(
+            {key: {'seconds': round(result['seconds'], 3), 'peak_rss': result['peak_rss']}
+             for key, result in results.items()}
+        )
+        baselines['machine'] = f'{platform.machine()}, {os.cpu_count()} CPUs, Python {platform.python_version()}'
+        with open(BASELINES_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baselines written to {BASELINES_PATH}')
+        return
+
+    regressions = compare(results, baselines.get('results', {}), args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print('Regressions against the baselines:')
+        for message in regressions:
+            print(f'  {message}')
+        sys.exit(1)
+    print('No regressions against the baselines' if baselines else 'No baselines stored, run with --update-baselines')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark for writing large tables into Word documents.
+
+Compares filling a table cell by cell through python-docx
+(table.rows[i].cells[j]) with DocumentBuilder.add_table_data, which writes
+all rows in one pass. The time per cell of the bulk writer should stay flat
+as the table grows; the cell-by-cell path grows with the row count, so it
+is only timed up to --cells-max-rows.
+
+Usage:
+    python benchmarks/bench_tables.py [--rows 125,250,...] [--cols 5] [--cells-max-rows 250]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx_builder import DocumentBuilder, new_document, TABLE_TEXT_STYLE, TABLE_HEADER_STYLE
+
+
+def make_rows(num_rows, num_cols):
+    """A header row followed by num_rows - 1 rows of short cell texts."""
+    rows = [[(f'Column {j}', True) for j in range(num_cols)]]
+    for i in range(1, num_rows):
+        rows.append([(f'Row {i} cell {j}', False) for j in range(num_cols)])
+    return rows
+
+
+def fill_cells(rows, num_cols):
+    """Fill the table through python-docx cell proxies (the previous approach)."""
+    builder = DocumentBuilder(new_document())
+    table = builder.add_table(len(rows), num_cols, style='Light Grid Accent 1')
+    for i, cells in enumerate(rows):
+        for j, (text, is_header) in enumerate(cells):
+            cell = table.rows[i].cells[j]
+            cell.text = text
+            cell.paragraphs[0].style = TABLE_HEADER_STYLE if is_header else TABLE_TEXT_STYLE
+
+
+def fill_bulk(rows, num_cols):
+    """Fill the table with the one-pass writer."""
+    builder = DocumentBuilder(new_document())
+    builder.add_table_data(rows, num_cols, style='Light Grid Accent 1')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='125,250,500,1000,2000,4000,8000', help='Comma-separated row counts')
+    parser.add_argument('--cols', type=int, default=5, help='Number of columns')
+    parser.add_argument('--cells-max-rows', type=int, default=250,
+                        help='Largest table also filled cell by cell (0 = bulk writer only)')
+    args = parser.parse_args()
+
+    # Build the template outside the timings
+    new_document()
+
+    print(f'{"rows":>6} {"cells":>7} {"bulk s":>8} {"bulk us/cell":>13} {"cells s":>8} {"cells us/cell":>14}')
+    for num_rows in (int(value) for value in args.rows.split(',')):
+        rows = make_rows(num_rows, args.cols)
+        num_cells = num_rows * args.cols
+
+        bulk = timed(fill_bulk, rows, args.cols)
+        line = f'{num_rows:>6} {num_cells:>7} {bulk:>8.3f} {bulk / num_cells * 1e6:>13.1f}'
+        if num_rows <= args.cells_max_rows:
+            cells = timed(fill_cells, rows, args.cols)
+            line += f' {cells:>8.3f} {cells / num_cells * 1e6:>14.1f}'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
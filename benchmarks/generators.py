@@ -0,0 +1,235 @@
+"""
+Synthetic inputs for the conversion benchmarks.
+
+Notion exports are built like real ones: page folders named with a 32-digit
+hex ID, URL-encoded image links relative to the page, optionally split into
+nested part zips, with large tables, photos and screenshots, and CJK text.
+PDFs have a heading, paragraphs, a ruled table and a JPEG image on every
+page. The output only depends on the arguments, so timings of the same
+inputs can be compared across runs.
+
+Usage:
+    python benchmarks/generators.py notion export.zip [--pages 25] [--table-rows 200] [--images 5] [--flat]
+    python benchmarks/generators.py pdf document.pdf [--pages 50]
+"""
+import io
+import random
+import zipfile
+import zlib
+import argparse
+from urllib.parse import quote
+from PIL import Image
+
+ENGLISH_WORDS = (
+    'conversion document export page table image paragraph heading list item '
+    'notion markdown word format style section detail summary note review'
+).split()
+
+# Lines in the style of test_data/test_chinese.md
+CJK_LINES = (
+    '这是一个中文测试文档，用于验证转换器对中文字符的处理。',
+    '支持**粗体**、*斜体*和`代码`等格式，以及中文标点符号：，。！？',
+    '日本語のテキストも含まれています。変換後も文字化けしないことを確認します。',
+    '表格中的中文内容也需要正确显示，包括较长的句子和混合的 English words。',
+)
+
+
+def _sentence(rng, words=12):
+    return ' '.join(rng.choice(ENGLISH_WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _image(rng, width, height, kind):
+    """A noisy photo (JPEG) or a flat screenshot-like image (PNG), as bytes."""
+    output = io.BytesIO()
+    if kind == 'photo':
+        # Smooth gradient plus noise compresses like a photo
+        base = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        noise = Image.frombytes('RGB', (width // 4, height // 4), rng.randbytes(width // 4 * (height // 4) * 3))
+        Image.blend(base, noise.resize((width, height)), 0.3).save(output, 'JPEG', quality=90)
+    else:
+        image = Image.new('RGB', (width, height), (250, 250, 250))
+        for y in range(0, height, 24):
+            image.paste((rng.randrange(256), 120, 200), (16, y + 4, rng.randrange(32, width - 16), y + 16))
+        image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def notion_page(rng, title, table_rows=20, image_links=(), cjk=True):
+    """Return the markdown of one page: headings, paragraphs, lists, code, a table and images."""
+    lines = [f'# {title}', '']
+    for section in range(3):
+        lines += [f'## Section {section + 1}', '']
+        for _ in range(4):
+            lines += [' '.join(_sentence(rng) for _ in range(4)), '']
+        if cjk:
+            lines += list(CJK_LINES) + ['']
+        lines += [f'- **{rng.choice(ENGLISH_WORDS)}**: {_sentence(rng, 6)}' for _ in range(5)] + ['']
+        lines += ['1. First step', '2. Second step with `inline code`', '   - Nested item', '']
+    lines += ['```python', 'def convert(path):', '    return path.upper()', '```', '']
+    if table_rows:
+        lines += ['| ID | Name | Status | 说明 |', '|----|------|--------|------|']
+        lines += [f'| {i} | {rng.choice(ENGLISH_WORDS)} {i} | {rng.choice(("Done", "Open"))} | 第{i}行 |'
+                  for i in range(1, table_rows)]
+        lines.append('')
+    for alt, link in image_links:
+        lines += [f'![{alt}]({link})', '']
+    return '\n'.join(lines)
+
+
+def make_notion_export(path, pages=25, table_rows=200, images=5, nested=True, cjk=True, seed=0):
+    """
+    Write a synthetic Notion export zip.
+
+    Args:
+        path: Where the zip is written
+        pages: Number of markdown pages, in a tree of top-level pages and subpages
+        table_rows: Rows of the table on the first page, the others have a
+            table of a tenth of that
+        images: Images on each of the first pages, alternately a large
+            photo and a screenshot; one photo is shared by every page
+        nested: Split the pages into two part zips inside the download,
+            as Notion does for large exports
+        cjk: Include Chinese and Japanese text
+        seed: Seed of the generated text and images
+    """
+    rng = random.Random(seed)
+    shared = ('Workspace/shared.jpg', _image(rng, 1200, 800, 'photo'))
+    files = []
+
+    for i in range(pages):
+        page_id = f'{rng.getrandbits(128):032x}'
+        title = f'Page {i + 1}' if not cjk or i % 4 else f'页面 {i + 1}'
+        # Every fifth page is top-level, the others are subpages of the last top-level one
+        if i % 5 == 0:
+            folder = 'Workspace'
+            parent = f'{title} {page_id}'
+        else:
+            folder = f'Workspace/{parent}'
+        page_dir = f'{title} {page_id}'
+
+        links = [('shared', '../' * (folder.count('/')) + 'shared.jpg')]
+        if i < max(1, pages // 5):
+            for j in range(images):
+                kind = 'photo' if j % 2 == 0 else 'screenshot'
+                size = (3000, 2000) if kind == 'photo' else (1600, 900)
+                name = f'image {j}.{"jpg" if kind == "photo" else "png"}'
+                files.append((f'{folder}/{page_dir}/{name}', _image(rng, *size, kind)))
+                links.append((kind, quote(f'{page_dir}/{name}')))
+
+        markdown = notion_page(rng, title, table_rows if i == 0 else table_rows // 10, links, cjk)
+        files.append((f'{folder}/{page_dir}.md', markdown.encode('utf-8')))
+
+    # Images are already compressed, Notion stores them as is
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as export:
+        if not nested:
+            for name, data in [shared] + files:
+                export.writestr(name, data, zipfile.ZIP_STORED if name.endswith(('.jpg', '.png')) else None)
+            return
+
+        # Part zips split at a page boundary, images stay with their page and
+        # every part has a copy of the shared image
+        half = len(files) // 2
+        while half < len(files) and not files[half][0].endswith('.md'):
+            half += 1
+        for part, members in enumerate((files[:half + 1], files[half + 1:]), 1):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as part_zip:
+                for name, data in [shared] + members:
+                    part_zip.writestr(name, data, zipfile.ZIP_STORED if name.endswith(('.jpg', '.png')) else None)
+            export.writestr(f'Export-{seed:08x}-Part-{part}.zip', buffer.getvalue(), zipfile.ZIP_STORED)
+
+
+def make_pdf(path, pages=50, seed=0):
+    """
+    Write a synthetic PDF.
+
+    Every page has a heading, paragraphs of wrapped body text, a 4x4 table
+    with ruling lines, and a JPEG image on every other page.
+    """
+    rng = random.Random(seed)
+    objects = []
+
+    def add(data):
+        objects.append(data)
+        return len(objects)
+
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    photo = _image(rng, 600, 400, 'photo')
+    image = add(b'<< /Type /XObject /Subtype /Image /Width 600 /Height 400 /ColorSpace /DeviceRGB '
+                b'/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n' % len(photo)
+                + photo + b'\nendstream')
+    pages_id = add(b'')
+    page_ids = []
+
+    for number in range(1, pages + 1):
+        ops = [b'BT /F1 16 Tf 72 740 Td (Chapter %d Results) Tj ET' % number]
+        y = 710
+        for paragraph in range(3):
+            for _ in range(5):
+                text = _sentence(rng, 11).encode('ascii')
+                ops.append(b'BT /F1 10 Tf 72 %d Td (%s) Tj ET' % (y, text))
+                y -= 13
+            y -= 10
+
+        top, left = y - 10, 72
+        for row in range(5):
+            ops.append(b'%d %d m %d %d l S' % (left, top - row * 18, left + 400, top - row * 18))
+        for col in range(5):
+            ops.append(b'%d %d m %d %d l S' % (left + col * 100, top, left + col * 100, top - 72))
+        for row in range(4):
+            for col in range(4):
+                cell = b'Total' if row == 0 else b'%d.%d' % (rng.randrange(1000), rng.randrange(100))
+                ops.append(b'BT /F1 9 Tf %d %d Td (%s) Tj ET' % (left + col * 100 + 4, top - row * 18 - 13, cell))
+
+        if number % 2 == 0:
+            ops.append(b'q 240 0 0 160 72 %d cm /Im1 Do Q' % (top - 260))
+
+        content = zlib.compress(b'\n'.join(ops))
+        contents = add(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream')
+        page_ids.append(add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 %d 0 R >> /XObject << /Im1 %d 0 R >> >> >>'
+            % (pages_id, contents, font, image)
+        ))
+
+    objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % page_id for page_id in page_ids), len(page_ids))
+    catalog = add(b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+
+    output = io.BytesIO()
+    output.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, data in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(b'%d 0 obj\n' % number + data + b'\nendobj\n')
+    xref = output.tell()
+    output.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b'%010d 00000 n \n' % offset)
+    output.write(b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, catalog, xref))
+
+    with open(path, 'wb') as f:
+        f.write(output.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('kind', choices=('notion', 'pdf'))
+    parser.add_argument('output', help='File to write')
+    parser.add_argument('--pages', type=int, default=25)
+    parser.add_argument('--table-rows', type=int, default=200, help='Rows of the largest table (notion)')
+    parser.add_argument('--images', type=int, default=5, help='Images per page with images (notion)')
+    parser.add_argument('--flat', action='store_true', help='No nested part zips (notion)')
+    parser.add_argument('--no-cjk', action='store_true', help='English text only (notion)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.kind == 'notion':
+        make_notion_export(args.output, args.pages, args.table_rows, args.images,
+                           nested=not args.flat, cjk=not args.no_cjk, seed=args.seed)
+    else:
+        make_pdf(args.output, args.pages, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
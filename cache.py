@@ -0,0 +1,165 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Seconds between rescans of the cache directory on writes, to count the
+# entries other processes sharing it have written
+RESCAN_INTERVAL = 300
+
+
+def file_digest(hasher, file_path, chunk_size=1024 * 1024):
+    """Feed the contents of a file to a hashlib object in chunks."""
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher
+
+
+class ConversionCache:
+    """
+    Persistent on-disk cache of converted documents.
+
+    Entries are keyed by a content hash of everything the conversion depends
+    on (see converter.markdown_cache_key and pdf_converter.pdf_cache_key), so
+    re-uploading the same export or PDF returns the stored .docx without
+    converting again. The least recently used entries are evicted once the
+    cache grows past max_bytes, from an index of the entries kept in memory
+    so a write does not list the directory. The directory can be shared by
+    several processes: their entries are indexed when read and by a rescan
+    every RESCAN_INTERVAL seconds. The hit and miss counters are per process.
+
+    Args:
+        cache_dir: Directory the cached documents are stored in
+        max_bytes: Total size the cache is trimmed back to
+        suffix: File extension of the cache entries
+    """
+
+    def __init__(self, cache_dir, max_bytes, suffix='.docx'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._rescan()
+
+    def get(self, key):
+        """Return the cached document for key as bytes, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Touch the entry so eviction sees it as recently used
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if path in self._index:
+                self._index.move_to_end(path)
+            else:
+                self._index[path] = len(data)
+                self._size += len(data)
+        return data
+
+    def put(self, key, data):
+        """Store a converted document and evict old entries if over budget."""
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # Replacing an entry, possibly one another process wrote
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Could not write cache entry %s: %s', key, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._size += len(data) - self._index.pop(path, replaced)
+            self._index[path] = len(data)
+            if time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+                # Other processes sharing the directory may have added entries
+                self._rescan()
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def stats(self):
+        """Return hit/miss counters and the current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}{self.suffix}')
+
+    def _entries(self):
+        """Yield (path, size, mtime) for every cache entry."""
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(self.suffix):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _rescan(self):
+        """Index the entries on disk, least recently used first (lock held or not yet shared)."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._index = OrderedDict((path, size) for path, size, _ in entries)
+        self._size = sum(self._index.values())
+        self._scanned_at = time.monotonic()
+
+    def _evict(self):
+        """Remove least recently used entries until under max_bytes (lock held)."""
+        while self._size > self.max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another process
+                pass
+            self._size -= size
+        logger.debug('Cache trimmed to %d bytes', self._size)
+
+
+def new_key_hasher(kind, version, settings=''):
+    """
+    Start a cache key for a converter kind and version.
+
+    Args:
+        kind: Conversion the key is for, with the options that change its output
+        version: Converter version, bumped when the output changes
+        settings: Server settings the output depends on, such as images.IMAGE_SETTINGS
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f'{kind}:{version}:{settings}\0'.encode('utf-8'))
+    return hasher
@@ -0,0 +1,313 @@
+"""
+Convert Notion exports, markdown files and PDFs to Word documents in bulk,
+without the web app and its upload size and request time limits.
+
+Inputs can be directory trees, zip files (Notion exports, or zips of exports
+and PDFs) and single .md or .pdf files. Every document becomes a .docx in
+the output directory, at the same relative path as in its directory or
+zip. The files are converted in -j processes, largest first, with a line
+per finished file; a JSON summary with the time of every file can be
+written with --summary. The exit status is 1 if any file failed.
+
+Zips have no size or member count limit here; how deep nested zips are
+opened and the compression ratio that marks a member as malformed can be
+set with --max-depth and --max-ratio.
+
+Processed images are cached in $XDG_CACHE_HOME/notion-to-word/images
+(~/.cache by default) unless IMAGE_CACHE_FOLDER is set; IMAGE_CACHE_MAX_BYTES=0
+turns the cache off.
+
+Usage:
+    python cli.py INPUT [INPUT ...] -o OUTPUT_DIR [-j 4] [--engine html|tokens]
+        [--skip-existing] [--summary summary.json] [--verbose] [--max-depth 3] [--max-ratio 100]
+"""
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+import posixpath
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# The app keeps processed images under its working directory. The CLI runs
+# from anywhere, so unless IMAGE_CACHE_FOLDER is set its image cache goes to
+# the user cache directory; set before images is imported, pool processes
+# inherit it
+os.environ.setdefault('IMAGE_CACHE_FOLDER', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'notion-to-word', 'images'))
+
+from archive import ArchivePath, ExportArchive, ArchiveLimitError, EXPORT_SUFFIXES, ARCHIVE_MAX_DEPTH, ARCHIVE_MAX_RATIO
+from converter import convert_markdown_to_docx, MARKDOWN_ENGINES
+from pdf_converter import convert_pdf_to_docx
+import logs
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+
+
+class Task:
+    """One document to convert: where it is read from and where its .docx goes."""
+
+    def __init__(self, kind, source, images_dir, output_path, size):
+        self.kind = kind  # 'markdown' or 'pdf'
+        self.source = source  # File path, or ArchivePath inside a zip
+        self.images_dir = images_dir
+        self.output_path = output_path
+        self.size = size
+
+
+def collect_tasks(inputs, output_dir, max_depth=ARCHIVE_MAX_DEPTH, max_ratio=ARCHIVE_MAX_RATIO):
+    """
+    Find the documents to convert in the inputs.
+
+    Args:
+        max_depth: Levels of zips inside a zip that are opened
+        max_ratio: Compression ratio past which a zip member is taken as malformed (0 = no limit)
+
+    Returns:
+        (tasks, errors) with errors as (input, message) for inputs that
+        cannot be read
+    """
+    tasks = []
+    errors = []
+    taken = set()
+
+    def add(kind, source, images_dir, relative_path, size):
+        output_path = _unique_path(os.path.join(output_dir, os.path.splitext(relative_path)[0] + '.docx'), taken)
+        tasks.append(Task(kind, source, images_dir, output_path, size))
+
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for root, dirs, files in os.walk(input_path):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    relative_path = os.path.relpath(path, input_path)
+                    if name.lower().endswith('.zip'):
+                        errors.extend(_collect_zip(path, os.path.splitext(relative_path)[0], add, max_depth, max_ratio))
+                    else:
+                        _collect_file(path, relative_path, add)
+        elif input_path.lower().endswith('.zip'):
+            errors.extend(_collect_zip(input_path, os.path.splitext(os.path.basename(input_path))[0], add,
+                                       max_depth, max_ratio))
+        elif os.path.isfile(input_path):
+            if not _collect_file(input_path, os.path.basename(input_path), add):
+                errors.append((input_path, 'Not a markdown, PDF or zip file'))
+        else:
+            errors.append((input_path, 'No such file or directory'))
+    return tasks, errors
+
+
+def _collect_file(path, relative_path, add):
+    """Add a markdown or PDF file, return whether it was one."""
+    name = path.lower()
+    if name.endswith(MARKDOWN_EXTENSIONS):
+        # Images are linked relative to the page, as in an extracted Notion export
+        add('markdown', path, os.path.dirname(path), relative_path, os.path.getsize(path))
+    elif name.endswith('.pdf'):
+        add('pdf', path, None, relative_path, os.path.getsize(path))
+    else:
+        return False
+    return True
+
+
+def _collect_zip(zip_path, relative_dir, add, max_depth, max_ratio):
+    """Add the markdown pages and PDFs of a zip, nested zips included; return errors."""
+    try:
+        # Left open, pages converted in this process (-j 1) are read from it. No
+        # size or member budget: batch runs convert exports of any size
+        archive = ExportArchive(zip_path, suffixes=EXPORT_SUFFIXES + MARKDOWN_EXTENSIONS + ('.pdf',),
+                                max_depth=max_depth, max_bytes=0, max_members=0, max_ratio=max_ratio)
+    except (zipfile.BadZipFile, OSError) as e:
+        return [(zip_path, f'Invalid zip file: {e}')]
+    except ArchiveLimitError as e:
+        return [(zip_path, str(e))]
+
+    for member in archive.files():
+        name = member.at.lower()
+        if not name.endswith(MARKDOWN_EXTENSIONS + ('.pdf',)):
+            continue
+        size = archive.zipfile(member.chain).getinfo(member.at).file_size
+        # Member names come from the upload, keep them inside the output directory
+        parts = [part for part in posixpath.normpath(member.at).split('/') if part not in ('', '.', '..')]
+        relative_path = os.path.join(relative_dir, *parts)
+        if name.endswith('.pdf'):
+            add('pdf', member, None, relative_path, size)
+        else:
+            add('markdown', member, member.parent, relative_path, size)
+    return []
+
+
+def _unique_path(path, taken):
+    """Return path, or path with ' (2)', ' (3)'... if another document already goes there."""
+    stem, ext = os.path.splitext(path)
+    candidate = path
+    counter = 2
+    while candidate in taken:
+        candidate = f'{stem} ({counter}){ext}'
+        counter += 1
+    taken.add(candidate)
+    return candidate
+
+
+def convert_task(kind, source, images_dir, output_path, engine='html'):
+    """
+    Process pool entry point: convert one document and write its .docx.
+
+    The document is written under a temporary name and renamed when it is
+    complete, so an interrupted run leaves no truncated documents behind.
+
+    Returns:
+        Seconds the conversion took
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = f'{output_path}.part'
+    start = time.perf_counter()
+    try:
+        if kind == 'markdown':
+            convert_markdown_to_docx(source, tmp_path, images_dir, engine=engine)
+        elif isinstance(source, ArchivePath):
+            # pdfplumber reads from a file, PDFs inside zips are copied out first
+            with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_file:
+                pdf_file.write(source.read_bytes())
+                pdf_file.flush()
+                convert_pdf_to_docx(pdf_file.name, tmp_path)
+        else:
+            convert_pdf_to_docx(source, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return time.perf_counter() - start
+
+
+def run(tasks, jobs=1, engine='html', progress=None):
+    """
+    Convert tasks, the largest first, in up to jobs processes.
+
+    Args:
+        progress: Called with (done, total, task, seconds, error) after each file
+
+    Returns:
+        List of (task, seconds, error) in completion order
+    """
+    tasks = sorted(tasks, key=lambda task: task.size, reverse=True)
+    results = []
+
+    def finished(task, seconds, error):
+        results.append((task, seconds, error))
+        if progress is not None:
+            progress(len(results), len(tasks), task, seconds, error)
+
+    if jobs <= 1:
+        for task in tasks:
+            start = time.perf_counter()
+            try:
+                finished(task, convert_task(task.kind, task.source, task.images_dir, task.output_path,
+                                            engine), None)
+            except Exception as e:
+                finished(task, time.perf_counter() - start, e)
+        return results
+
+    context = multiprocessing.get_context('spawn')
+    # Pool processes log like this one; archives are reopened when tasks are
+    # unpickled, after the initializer ran
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                             initializer=logs.init_process, initargs=logs.process_state()) as executor:
+        futures = {
+            executor.submit(convert_task, task.kind, task.source, task.images_dir, task.output_path,
+                            engine): task
+            for task in tasks
+        }
+        for future in as_completed(futures):
+            try:
+                finished(futures[future], future.result(), None)
+            except Exception as e:
+                finished(futures[future], None, e)
+    return results
+
+
+def _print_progress(done, total, task, seconds, error):
+    width = len(str(total))
+    source = str(task.source)
+    if error is None:
+        print(f'[{done:>{width}}/{total}] ok     {seconds:7.2f}s  {source}', file=sys.stderr)
+    else:
+        print(f'[{done:>{width}}/{total}] FAILED           {source}: {error}', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', metavar='INPUT', help='Directories, zip files, .md or .pdf files')
+    parser.add_argument('-o', '--output', required=True, help='Directory the .docx files are written to')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Documents converted at once (default: CPU count)')
+    parser.add_argument('--engine', choices=MARKDOWN_ENGINES, default=os.environ.get('MARKDOWN_ENGINE', 'html'),
+                        help='Markdown engine (default: MARKDOWN_ENGINE or html)')
+    parser.add_argument('--skip-existing', action='store_true', help='Keep documents already in the output directory')
+    parser.add_argument('--summary', help='Write a JSON summary to this file, - for standard output')
+    parser.add_argument('--verbose', action='store_true', help='Log the converters\' progress, not only warnings')
+    parser.add_argument('--max-depth', type=int, default=ARCHIVE_MAX_DEPTH,
+                        help='Levels of zips inside a zip that are opened (default: ARCHIVE_MAX_DEPTH or 3)')
+    parser.add_argument('--max-ratio', type=int, default=ARCHIVE_MAX_RATIO,
+                        help='Compression ratio past which a zip member is taken as malformed, 0 = no limit '
+                             '(default: ARCHIVE_MAX_RATIO or 100)')
+    args = parser.parse_args(argv)
+
+    # Log records go to stderr with the progress lines, stdout is kept for the summary
+    logs.configure(level='DEBUG' if args.verbose else 'WARNING', stream='stderr')
+
+    start = time.perf_counter()
+    tasks, errors = collect_tasks(args.inputs, args.output, args.max_depth, args.max_ratio)
+    for input_path, message in errors:
+        print(f'{input_path}: {message}', file=sys.stderr)
+
+    skipped = []
+    if args.skip_existing:
+        skipped = [task for task in tasks if os.path.exists(task.output_path)]
+        tasks = [task for task in tasks if not os.path.exists(task.output_path)]
+    print(f'Converting {len(tasks)} documents with {args.jobs} processes'
+          + (f', {len(skipped)} already converted' if skipped else ''), file=sys.stderr)
+
+    results = run(tasks, args.jobs, args.engine, progress=_print_progress)
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if result[2] is not None]
+
+    print(f'Converted {len(results) - len(failed)} of {len(results)} documents in {elapsed:.1f}s'
+          + (f', {len(failed)} failed' if failed else ''), file=sys.stderr)
+
+    if args.summary:
+        summary = {
+            'documents': len(results),
+            'converted': len(results) - len(failed),
+            'failed': len(failed),
+            'skipped': len(skipped),
+            'input_errors': [{'input': input_path, 'error': message} for input_path, message in errors],
+            'seconds': round(elapsed, 3),
+            'jobs': args.jobs,
+            'files': sorted((
+                {
+                    'input': str(task.source),
+                    'kind': task.kind,
+                    'output': task.output_path if error is None else None,
+                    'input_bytes': task.size,
+                    'seconds': round(seconds, 3) if seconds is not None else None,
+                    'error': str(error) if error is not None else None,
+                }
+                for task, seconds, error in results
+            ), key=lambda entry: entry['input']),
+        }
+        if args.summary == '-':
+            json.dump(summary, sys.stdout, indent=2, ensure_ascii=False)
+            print()
+        else:
+            with open(args.summary, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    return 1 if failed or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,79 +1,463 @@
+import io
 import os
 import re
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
+import tempfile
+import posixpath
+import multiprocessing
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from docx.shared import Inches, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
 import markdown2
+from markdown_it import MarkdownIt
+from markdown_it.rules_inline import emphasis
+from markdown_it.rules_block import list_block
 from bs4 import BeautifulSoup
 from pathlib import Path
 from urllib.parse import unquote
+from archive import ArchivePath
+from docx_builder import DocumentBuilder, new_document, CODE_STYLE, CODE_CHAR_STYLE
+from cache import new_key_hasher, file_digest
+from images import normalize_image, IMAGE_SETTINGS
+import metrics
+import logs
 
+logger = logging.getLogger(__name__)
 
-def _set_font(run, is_code=False):
+# Bump when a change alters the generated documents, so cached conversions are not reused
+CONVERTER_VERSION = '7'
+
+# Image references in markdown source, used for cache keys
+_MARKDOWN_IMAGE_RE = re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)')
+_HTML_IMAGE_RE = re.compile(r'<img[^>]*\bsrc=["\']([^"\']+)["\']', re.IGNORECASE)
+
+# Notion names page files and folders "<Title> <32 hex digit page ID>"
+_NOTION_ID_RE = re.compile(r'\s+[0-9a-f]{32}$', re.IGNORECASE)
+
+# Links to other pages of an export, a page lists its subpages with them
+_PAGE_LINK_RE = re.compile(r'\]\(\s*<?([^)\s>]+\.md)>?\s*\)', re.IGNORECASE)
+
+_DIGITS_RE = re.compile(r'(\d+)')
+
+# Raw HTML markdown2 keeps as a block of its own instead of wrapping it in a paragraph
+_HTML_BLOCK_RE = re.compile(
+    r'\s*<(?:!--|/?(?:p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
+    r'|ins|del|style|section|article|aside|header|footer|nav|main|figure|hr)[\s/>])', re.IGNORECASE)
+
+# Ordered list markers markdown2 does not take for one
+_PAREN_MARKER_RE = re.compile(r'\d{1,9}\)')
+# Leading whitespace of the lines after the first in a paragraph
+_LINE_INDENT_RE = re.compile(r'\n([ \t]*)')
+
+# Pages that start with a heading of their own, as Notion writes the title
+_HEADING_START_RE = re.compile(r'\s*#\s')
+
+# Task list checkboxes, rendered as <input> elements (no text) by the html engine
+_TASK_MARKER_RE = re.compile(r'^\[[ xX]\]\s+')
+
+MARKDOWN_ENGINES = ('html', 'tokens')
+
+# Converted by warm_up(): one element of each kind the converter handles
+_WARM_UP_MARKDOWN = '''# Heading
+
+Paragraph with **bold**, *italic*, `code` and a [link](https://example.com).
+
+- Item
+  1. Nested item
+- [x] Task
+
+| Column | 列 |
+|--------|----|
+| 1      | 二 |
+
+```python
+print('code block')
+```
+'''
+
+
+def _asterisk_emphasis(state, silent):
+    # markdown2's code-friendly extra leaves _underscores_ alone, so only * emphasizes
+    if state.src[state.pos] == '_':
+        return False
+    return emphasis.tokenize(state, silent)
+
+
+def _markdown2_list(state, start_line, end_line, silent):
+    # markdown2 only numbers lists written "1.", a line starting "1)" stays text
+    start = state.bMarks[start_line] + state.tShift[start_line]
+    if _PAREN_MARKER_RE.match(state.src, start):
+        return False
+    # Nor does a list interrupt a paragraph, "Steps:\n- one" is a single
+    # paragraph, except the text of a list item followed by a nested list
+    if silent and state.parentType == 'paragraph' and state.listIndent < 0:
+        return False
+    return list_block(state, start_line, end_line, silent)
+
+
+# CommonMark parser for the token engine, adjusted towards the markdown2 extras:
+# tables, hard line breaks, no underscore emphasis, no "1)" lists and no
+# lists interrupting a paragraph
+_markdown_parser = MarkdownIt('commonmark', {'breaks': True, 'html': True}).enable('table')
+_markdown_parser.inline.ruler.at('emphasis', _asterisk_emphasis)
+_markdown_parser.block.ruler.at('list', _markdown2_list, {'alt': ['paragraph', 'reference', 'blockquote']})
+
+
+def convert_markdown_to_docx(md_file_path, output_path, images_dir=None, engine='html'):
     """
-    Set appropriate fonts for text to ensure compatibility with Microsoft Word.
+    Convert a markdown file to a Word document with advanced formatting.
 
     Args:
-        run: The run object to set font for
-        is_code: Whether this is code text (uses monospace font)
-    """
-    if is_code:
-        # Code blocks use monospace font
-        run.font.name = 'Consolas'
-        run.font.size = Pt(9)
-        # Set East Asian font for Chinese characters in code
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
+        md_file_path: Path to the markdown file, or an ArchivePath inside an export zip
+        output_path: Path or binary file object the Word document should be saved to
+        images_dir: Directory containing images referenced in markdown, or an ArchivePath
+        engine: 'html' renders with markdown2 and walks the parsed HTML,
+            'tokens' builds the document straight from the markdown-it token stream
+    """
+    if engine not in MARKDOWN_ENGINES:
+        raise ValueError(f'Unknown markdown engine: {engine}')
+
+    md_content = _read_markdown(md_file_path)
+
+    # Create Word document, fonts come from the template styles
+    doc = new_document()
+    builder = DocumentBuilder(doc)
+    _render_markdown(builder, md_content, images_dir, engine)
+
+    # Save document
+    with metrics.timed('docx_save'):
+        doc.save(output_path)
+    metrics.count('conversion_files_total', kind='markdown')
+    metrics.count('conversion_bytes_total', metrics.output_size(output_path), direction='out')
+
+
+def _read_markdown(md_file_path):
+    if isinstance(md_file_path, ArchivePath):
+        return md_file_path.read_text(encoding='utf-8')
+    with open(md_file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _render_markdown(builder, md_content, images_dir, engine):
+    """Append the blocks of a markdown document to builder."""
+    if engine == 'tokens':
+        # Emit docx blocks directly from the token stream, no HTML round trip
+        with metrics.timed('markdown_tokens'):
+            tokens = _markdown_parser.parse(md_content)
+            _keep_line_indents(tokens)
+        with metrics.timed('docx_build'):
+            _process_tokens(builder, tokens, 0, len(tokens), images_dir)
     else:
-        # Regular text uses standard fonts
-        run.font.name = 'Calibri'
-        # Set East Asian font for Chinese/Japanese/Korean characters
-        # This ensures proper display in Microsoft Word
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
-        # Set fallback fonts for better compatibility
-        run._element.rPr.rFonts.set(qn('w:ascii'), 'Calibri')
-        run._element.rPr.rFonts.set(qn('w:hAnsi'), 'Calibri')
+        # Convert markdown to HTML with extras for tables, code blocks, etc.
+        with metrics.timed('markdown_html'):
+            html = markdown2.markdown(
+                md_content,
+                extras=[
+                    'tables',
+                    'fenced-code-blocks',
+                    'code-friendly',
+                    'break-on-newline',
+                    'task_list'
+                ]
+            )
+
+        # Parse HTML with BeautifulSoup
+        with metrics.timed('html_parse'):
+            soup = BeautifulSoup(html, 'html5lib')
+
+        # Process each element in the HTML
+        with metrics.timed('docx_build'):
+            _process_element(builder, soup.body, images_dir)
+
+
+def warm_up(engine='html'):
+    """
+    Convert a small document once, so the first upload a process handles does
+    not pay for building the document template and for the parsers' setup.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        md_path = os.path.join(temp_dir, 'warm-up.md')
+        with open(md_path, 'w', encoding='utf-8') as f:
+            f.write(_WARM_UP_MARKDOWN)
+        convert_markdown_to_docx(md_path, io.BytesIO(), engine=engine)
 
 
-def convert_markdown_to_docx(md_file_path, output_path, images_dir=None):
+def convert_markdown_files(tasks, workers=1, cache=None, engine='html'):
     """
-    Convert a markdown file to a Word document with advanced formatting.
+    Convert several markdown files, optionally fanning out to a process pool.
+
+    The documents are returned as bytes so the caller can write them straight
+    into an output archive without intermediate files.
 
     Args:
-        md_file_path: Path to the markdown file
-        output_path: Path where the Word document should be saved
-        images_dir: Directory containing images referenced in markdown
+        tasks: List of (md_file_path, images_dir) tuples
+        workers: Maximum number of processes to use (1 = convert in this process)
+        cache: Optional ConversionCache, hits are returned without converting
+        engine: Markdown engine, see convert_markdown_to_docx
+
+    Yields:
+        (task, docx_bytes, error) for every task in input order, error is None on success
     """
-    # Read markdown content
-    with open(md_file_path, 'r', encoding='utf-8') as f:
-        md_content = f.read()
+    keys = [None] * len(tasks)
+    cached = [None] * len(tasks)
+    if cache is not None:
+        for i, task in enumerate(tasks):
+            try:
+                keys[i] = markdown_cache_key(*task, engine=engine)
+            except Exception as e:
+                # Let the conversion report the problem
+                logger.warning('Could not compute cache key for %s: %s', task[0], e)
+                continue
+            cached[i] = cache.get(keys[i])
+
+    misses = [task for task, data in zip(tasks, cached) if data is None]
+    converted = _convert_markdown_tasks(misses, workers, engine)
+
+    for task, key, data in zip(tasks, keys, cached):
+        if data is not None:
+            yield task, data, None
+            continue
 
-    # Convert markdown to HTML with extras for tables, code blocks, etc.
-    html = markdown2.markdown(
-        md_content,
-        extras=[
-            'tables',
-            'fenced-code-blocks',
-            'code-friendly',
-            'break-on-newline',
-            'task_list'
-        ]
-    )
+        _, data, error = next(converted)
+        if error is None and key is not None:
+            cache.put(key, data)
+        yield task, data, error
 
-    # Parse HTML with BeautifulSoup
-    soup = BeautifulSoup(html, 'html5lib')
 
-    # Create Word document
-    doc = Document()
+def _convert_markdown_tasks(tasks, workers, engine):
+    """Yield (task, docx_bytes, error) for tasks in order, converting in a pool if workers > 1."""
+    workers = min(workers, len(tasks))
 
-    # Process each element in the HTML
-    _process_element(doc, soup.body, images_dir)
+    if workers <= 1:
+        for task in tasks:
+            try:
+                yield task, convert_markdown_to_bytes(*task, engine=engine), None
+            except Exception as e:
+                yield task, None, e
+        return
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=logs.init_process, initargs=logs.process_state()) as executor:
+        # Keep a bounded number of pages in flight, so finished documents do
+        # not pile up in memory while an earlier page is still being converted
+        futures = deque()
+        for index, task in enumerate(tasks):
+            if len(futures) >= workers * 2:
+                yield _collect(*futures.popleft())
+            try:
+                future = executor.submit(metrics.collected, convert_markdown_to_bytes, *task, engine=engine)
+            except BrokenProcessPool as e:
+                # A pool process died (killed for memory, crashed in a native
+                # parser): the pages not yet converted fail one by one
+                logger.error('Page conversion pool broke: %s', e)
+                while futures:
+                    yield _collect(*futures.popleft())
+                for remaining in tasks[index:]:
+                    yield remaining, None, e
+                return
+            futures.append((task, future))
+        while futures:
+            yield _collect(*futures.popleft())
+
+
+def _collect(task, future):
+    """Return (task, docx_bytes, error) of a finished page, keeping the metrics recorded in its process."""
+    try:
+        data, task_metrics = future.result()
+    except Exception as e:
+        return task, None, e
+    metrics.merge(task_metrics)
+    return task, data, None
+
+
+def convert_markdown_to_bytes(md_file_path, images_dir=None, engine='html'):
+    """Convert a markdown file and return the Word document as bytes."""
+    output = io.BytesIO()
+    convert_markdown_to_docx(md_file_path, output, images_dir, engine=engine)
+    return output.getvalue()
+
+
+def markdown_cache_key(md_file_path, images_dir=None, engine='html'):
+    """
+    Compute the conversion cache key of a markdown file.
+
+    The key covers the converter version and engine, the image resolution
+    and quality settings, the markdown source and the bytes of every image
+    it references, so changing any of them misses the cache.
+    """
+    if isinstance(md_file_path, ArchivePath):
+        md_bytes = md_file_path.read_bytes()
+    else:
+        with open(md_file_path, 'rb') as f:
+            md_bytes = f.read()
+
+    hasher = new_key_hasher(f'markdown-{engine}', CONVERTER_VERSION, IMAGE_SETTINGS)
+    hasher.update(md_bytes)
+
+    if images_dir is not None:
+        md_content = md_bytes.decode('utf-8', errors='replace')
+        sources = set(_MARKDOWN_IMAGE_RE.findall(md_content)) | set(_HTML_IMAGE_RE.findall(md_content))
+        for image_src in sorted(sources):
+            hasher.update(b'\0' + image_src.encode('utf-8') + b'\0')
+            image = _resolve_image(image_src, images_dir)
+            if image is None:
+                hasher.update(b'missing')
+            elif isinstance(image, io.BytesIO):
+                hasher.update(image.getvalue())
+            else:
+                file_digest(hasher, image)
+
+    return hasher.hexdigest()
+
+
+def notion_page_order(md_files):
+    """
+    Order the pages of a Notion export as they nest in the workspace.
+
+    Notion exports a page as "<Title> <ID>.md" and its subpages into a
+    folder "<Title> <ID>" next to it, in the same part zip or another one.
+    Subpages follow their parent, in the order the parent links to them and
+    by title after that; top-level pages are ordered by title.
+
+    Args:
+        md_files: Markdown pages of one export, paths or ArchivePaths
+
+    Returns:
+        List of (md_file, depth, title) with depth 0 for top-level pages
+    """
+    pages = {}
+    for md_file in md_files:
+        pages.setdefault(_page_path(md_file), []).append(md_file)
+
+    children = {}
+    roots = []
+    for path in pages:
+        parent = posixpath.dirname(path) + '.md'
+        if parent in pages:
+            children.setdefault(parent, []).append(path)
+        else:
+            roots.append(path)
+
+    order = []
+
+    def visit(path, depth):
+        for md_file in pages[path]:
+            order.append((md_file, depth, _page_title(md_file)))
+        subpages = children.get(path)
+        if subpages:
+            links = _link_order(path, pages[path][0])
+            subpages.sort(key=lambda subpage: (links.get(subpage, len(links)), _title_key(subpage)))
+            for subpage in subpages:
+                visit(subpage, depth + 1)
+
+    for path in sorted(roots, key=_title_key):
+        visit(path, 0)
+    return order
+
+
+def _page_path(md_file):
+    return md_file.at if isinstance(md_file, ArchivePath) else Path(md_file).as_posix()
+
+
+def _page_title(md_file):
+    stem = md_file.stem if isinstance(md_file, ArchivePath) else Path(md_file).stem
+    return _NOTION_ID_RE.sub('', stem)
+
+
+def _title_key(path):
+    # Numbers in titles compare by value, "Page 2" comes before "Page 10"
+    title = _NOTION_ID_RE.sub('', posixpath.splitext(posixpath.basename(path))[0]).casefold()
+    return [int(part) if part.isdigit() else part for part in _DIGITS_RE.split(title)], path
+
+
+def _page_images_dir(md_file):
+    # Images are linked relative to the page
+    return md_file.parent if isinstance(md_file, ArchivePath) else os.path.dirname(md_file)
+
+
+def _link_order(path, md_file):
+    """Return {page path: position} of the pages the page at path links to."""
+    try:
+        md_content = _read_markdown(md_file)
+    except Exception as e:
+        # The conversion reports the page
+        logger.warning('Could not read links of %s: %s', md_file, e)
+        return {}
+
+    base = posixpath.dirname(path)
+    positions = {}
+    for target in _PAGE_LINK_RE.findall(md_content):
+        positions.setdefault(posixpath.normpath(posixpath.join(base, unquote(target))), len(positions))
+    return positions
+
+
+def convert_notion_pages_to_docx(pages, output_path, engine='html'):
+    """
+    Convert the pages of a Notion export into a single Word document.
+
+    Pages are added in the given order. Each starts with a heading of its
+    title unless its markdown starts with a heading already, as Notion
+    writes it, and its headings are moved down by its depth, so subpages
+    nest under their parent in the navigation pane. Top-level pages start
+    on a new page. An image shown on several pages is stored once:
+    python-docx keeps one image part per distinct image and every picture
+    of it refers to that part. Pages are spooled out of memory once built.
+
+    Args:
+        pages: (md_file, depth, title) tuples, as notion_page_order returns them
+        output_path: Path or binary file object the Word document should be saved to
+        engine: Markdown engine, see convert_markdown_to_docx
+
+    Returns:
+        List of (md_file, error) for the pages that could not be read, they are left out
+    """
+    if engine not in MARKDOWN_ENGINES:
+        raise ValueError(f'Unknown markdown engine: {engine}')
+
+    doc = new_document()
+    builder = DocumentBuilder(doc)
+    failed = []
+    started = False
+
+    for md_file, depth, title in pages:
+        try:
+            md_content = _read_markdown(md_file)
+        except Exception as e:
+            failed.append((md_file, e))
+            continue
+
+        if depth == 0 and started:
+            builder.add_page_break()
+        started = True
+        with builder.demoted(depth):
+            if not _HEADING_START_RE.match(md_content):
+                builder.add_heading(title, level=1)
+            _render_markdown(builder, md_content, _page_images_dir(md_file), engine)
+        builder.spool()
+
+    with metrics.timed('docx_save'):
+        builder.save(output_path)
+    metrics.count('conversion_files_total', len(pages) - len(failed), kind='markdown')
+    metrics.count('conversion_bytes_total', metrics.output_size(output_path), direction='out')
+    return failed
 
-    # Save document
-    doc.save(output_path)
+
+def notion_pages_cache_key(pages, engine='html'):
+    """
+    Compute the conversion cache key of a merged document: the keys of its
+    pages, see markdown_cache_key, with their place in the page tree.
+    """
+    hasher = new_key_hasher(f'notion-merged-{engine}', CONVERTER_VERSION, IMAGE_SETTINGS)
+    for md_file, depth, title in pages:
+        page_key = markdown_cache_key(md_file, _page_images_dir(md_file), engine=engine)
+        hasher.update(f'{depth}\0{title}\0{page_key}\0'.encode('utf-8'))
+    return hasher.hexdigest()
 
 
-def _process_element(doc, element, images_dir, list_level=0):
+def _process_element(builder, element, images_dir, list_level=0):
     """
     Recursively process HTML elements and convert to Word document elements.
     """
@@ -84,10 +468,7 @@ def _process_element(doc, element, images_dir, list_level=0):
         if isinstance(child, str):
             # Skip whitespace-only text nodes at document level
             if child.strip():
-                p = doc.add_paragraph(child.strip())
-                # Set font for all runs in the paragraph
-                for run in p.runs:
-                    _set_font(run)
+                builder.add_paragraph(child.strip())
             continue
 
         tag_name = child.name
@@ -96,50 +477,43 @@ def _process_element(doc, element, images_dir, list_level=0):
         if tag_name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
             level = int(tag_name[1])
             text = child.get_text()
-            heading = doc.add_heading(text, level=level)
-            # Set font for heading
-            for run in heading.runs:
-                _set_font(run)
+            builder.add_heading(text, level=level)
 
         # Paragraphs
         elif tag_name == 'p':
-            p = doc.add_paragraph()
+            p = builder.add_paragraph()
             _process_inline_elements(p, child, images_dir)
 
         # Unordered lists
         elif tag_name == 'ul':
-            _process_list(doc, child, images_dir, ordered=False, level=list_level)
+            _process_list(builder, child, images_dir, ordered=False, level=list_level)
 
         # Ordered lists
         elif tag_name == 'ol':
-            _process_list(doc, child, images_dir, ordered=True, level=list_level)
+            _process_list(builder, child, images_dir, ordered=True, level=list_level)
 
         # Tables
         elif tag_name == 'table':
-            _process_table(doc, child)
+            _process_table(builder, child)
 
         # Code blocks
         elif tag_name == 'pre':
             code = child.get_text()
-            p = doc.add_paragraph(code)
-            # Set monospace font for code
-            for run in p.runs:
-                _set_font(run, is_code=True)
+            builder.add_paragraph(code, style=CODE_STYLE)
 
         # Blockquotes
         elif tag_name == 'blockquote':
-            _process_element(doc, child, images_dir, list_level)
-            # Add some indentation to last paragraph
-            if doc.paragraphs:
-                doc.paragraphs[-1].paragraph_format.left_indent = Inches(0.5)
+            # Indent every paragraph of the quote
+            with builder.indented(Inches(0.5)):
+                _process_element(builder, child, images_dir, list_level)
 
         # Horizontal rule
         elif tag_name == 'hr':
-            doc.add_paragraph('_' * 50)
+            builder.add_paragraph('_' * 50)
 
         # Divs and other containers - recurse
         elif tag_name in ['div', 'body']:
-            _process_element(doc, child, images_dir, list_level)
+            _process_element(builder, child, images_dir, list_level)
 
 
 def _process_inline_elements(paragraph, element, images_dir):
@@ -149,8 +523,7 @@ def _process_inline_elements(paragraph, element, images_dir):
     for child in element.children:
         if isinstance(child, str):
             if child.strip() or child == ' ':
-                run = paragraph.add_run(child)
-                _set_font(run)
+                paragraph.add_run(child)
             continue
 
         tag_name = child.name
@@ -160,18 +533,15 @@ def _process_inline_elements(paragraph, element, images_dir):
         if tag_name in ['strong', 'b']:
             run = paragraph.add_run(text)
             run.bold = True
-            _set_font(run)
 
         # Emphasis/Italic
         elif tag_name in ['em', 'i']:
             run = paragraph.add_run(text)
             run.italic = True
-            _set_font(run)
 
         # Code (inline)
         elif tag_name == 'code':
-            run = paragraph.add_run(text)
-            _set_font(run, is_code=True)
+            paragraph.add_run(text, style=CODE_CHAR_STYLE)
 
         # Links
         elif tag_name == 'a':
@@ -180,7 +550,6 @@ def _process_inline_elements(paragraph, element, images_dir):
             run = paragraph.add_run(f'{text} ({href})')
             run.font.color.rgb = RGBColor(0, 0, 255)
             run.underline = True
-            _set_font(run)
 
         # Images
         elif tag_name == 'img':
@@ -193,7 +562,7 @@ def _process_inline_elements(paragraph, element, images_dir):
             _process_inline_elements(paragraph, child, images_dir)
 
 
-def _process_list(doc, list_element, images_dir, ordered=False, level=0):
+def _process_list(builder, list_element, images_dir, ordered=False, level=0):
     """
     Process ordered or unordered lists.
     """
@@ -209,52 +578,292 @@ def _process_list(doc, list_element, images_dir, ordered=False, level=0):
         text = ''.join(text_parts).strip()
 
         if text:
-            p = doc.add_paragraph(text, style='List Number' if ordered else 'List Bullet')
+            p = builder.add_paragraph(text, style='List Number' if ordered else 'List Bullet')
             p.paragraph_format.left_indent = Inches(0.5 * (level + 1))
-            # Set font for list items
-            for run in p.runs:
-                _set_font(run)
 
         # Process nested lists
         for nested in li.find_all(['ul', 'ol'], recursive=False):
             is_ordered = nested.name == 'ol'
-            _process_list(doc, nested, images_dir, ordered=is_ordered, level=level + 1)
+            _process_list(builder, nested, images_dir, ordered=is_ordered, level=level + 1)
 
 
-def _process_table(doc, table_element):
+def _process_table(builder, table_element):
     """
     Convert HTML table to Word table.
     """
-    rows = table_element.find_all('tr')
+    rows = [
+        [(cell.get_text().strip(), cell.name == 'th') for cell in row.find_all(['th', 'td'])]
+        for row in table_element.find_all('tr')
+    ]
+    _add_table(builder, rows)
+
+
+def _add_table(builder, rows):
+    """
+    Add a table to the Word document.
+
+    Args:
+        rows: List of rows, each a list of (text, is_header_cell) tuples
+    """
     if not rows:
         return
 
-    # Determine number of columns from first row
-    first_row_cells = rows[0].find_all(['th', 'td'])
-    num_cols = len(first_row_cells)
-    num_rows = len(rows)
-
-    # Create Word table
-    table = doc.add_table(rows=num_rows, cols=num_cols)
-    table.style = 'Light Grid Accent 1'
-
-    # Fill table
-    for i, row in enumerate(rows):
-        cells = row.find_all(['th', 'td'])
-        for j, cell in enumerate(cells):
-            if j < num_cols:  # Safety check
-                table.rows[i].cells[j].text = cell.get_text().strip()
-                # Set font and make header row bold
-                if i == 0 or cell.name == 'th':
-                    for paragraph in table.rows[i].cells[j].paragraphs:
-                        for run in paragraph.runs:
-                            run.bold = True
-                            _set_font(run)
-                else:
-                    # Set font for regular cells
-                    for paragraph in table.rows[i].cells[j].paragraphs:
-                        for run in paragraph.runs:
-                            _set_font(run)
+    # Determine number of columns from first row, the first row is the header
+    num_cols = len(rows[0])
+    rows = [[(text, i == 0 or is_header) for text, is_header in cells] for i, cells in enumerate(rows)]
+
+    # Create and fill the Word table in one pass
+    builder.add_table_data(rows, num_cols, style='Light Grid Accent 1')
+
+
+def _keep_line_indents(tokens):
+    """
+    Put back the indentation markdown-it strips from the lines of a
+    paragraph after the first; markdown2 keeps it, tabs as four spaces,
+    except in list items, which it dedents.
+    """
+    items = 0
+    for token in tokens:
+        if token.type in ('list_item_open', 'list_item_close'):
+            items += token.nesting
+        if token.type != 'inline' or not token.children or items:
+            continue
+        indents = iter(_LINE_INDENT_RE.findall(token.content))
+        children = token.children
+        for i, child in enumerate(children):
+            if child.type in ('softbreak', 'hardbreak'):
+                indent = next(indents, '')
+                if indent and i + 1 < len(children) and children[i + 1].type == 'text':
+                    children[i + 1].content = indent.expandtabs(4) + children[i + 1].content
+
+
+def _find_close(tokens, index):
+    """Return the index of the token closing the block opened at tokens[index]."""
+    depth = 0
+    for i in range(index, len(tokens)):
+        depth += tokens[i].nesting
+        if depth == 0:
+            return i
+    return len(tokens) - 1
+
+
+def _inline_text(children, line_break='\n'):
+    """Plain text of inline tokens, the token stream equivalent of get_text()."""
+    parts = []
+    for token in children or []:
+        if token.type in ('text', 'code_inline'):
+            parts.append(token.content)
+        elif token.type in ('softbreak', 'hardbreak'):
+            parts.append(line_break)
+    return ''.join(parts)
+
+
+def _process_tokens(builder, tokens, start, end, images_dir, list_level=0, line_break='\n'):
+    """
+    Convert block tokens in tokens[start:end] to Word document elements.
+
+    Mirrors _process_element so both engines produce the same document.
+    markdown2 indents the lines of a blockquote's HTML, so text lines after
+    a line break start with line_break, two more spaces per quote level.
+    """
+    i = start
+    while i < end:
+        token = tokens[i]
+        token_type = token.type
+
+        # Headings
+        if token_type == 'heading_open':
+            level = int(token.tag[1])
+            builder.add_heading(_inline_text(tokens[i + 1].children), level=level)
+            i = _find_close(tokens, i)
+
+        # Paragraphs
+        elif token_type == 'paragraph_open':
+            p = builder.add_paragraph()
+            _process_inline_tokens(p, tokens[i + 1].children, images_dir, line_break)
+            i = _find_close(tokens, i)
+
+        # Lists
+        elif token_type in ('bullet_list_open', 'ordered_list_open'):
+            close = _find_close(tokens, i)
+            _process_list_tokens(builder, tokens, i, close, images_dir,
+                                 ordered=token_type == 'ordered_list_open', level=list_level, line_break=line_break)
+            i = close
+
+        # Tables
+        elif token_type == 'table_open':
+            close = _find_close(tokens, i)
+            rows = []
+            for j in range(i, close):
+                if tokens[j].type == 'tr_open':
+                    rows.append([])
+                elif tokens[j].type in ('th_open', 'td_open'):
+                    rows[-1].append((_inline_text(tokens[j + 1].children).strip(), tokens[j].type == 'th_open'))
+            _add_table(builder, rows)
+            i = close
+
+        # Code blocks
+        elif token_type in ('fence', 'code_block'):
+            builder.add_paragraph(token.content, style=CODE_STYLE)
+
+        # Blockquotes
+        elif token_type == 'blockquote_open':
+            close = _find_close(tokens, i)
+            # Indent every paragraph of the quote
+            with builder.indented(Inches(0.5)):
+                _process_tokens(builder, tokens, i + 1, close, images_dir, list_level, line_break + '  ')
+            i = close
+
+        # Horizontal rule
+        elif token_type == 'hr':
+            builder.add_paragraph('_' * 50)
+
+        # Raw HTML: markdown2 passes block tags through to the HTML the html
+        # engine walks and wraps anything else (<img>, <span>...) in a paragraph
+        elif token_type == 'html_block':
+            body = BeautifulSoup(token.content, 'html5lib').body
+            if _HTML_BLOCK_RE.match(token.content):
+                _process_element(builder, body, images_dir, list_level)
+            else:
+                _process_inline_elements(builder.add_paragraph(), body, images_dir)
+
+        i += 1
+
+
+def _process_inline_tokens(paragraph, children, images_dir, line_break='\n'):
+    """
+    Process inline tokens within a paragraph (bold, italic, links, images, etc.).
+    """
+    children = children or []
+    pending_break = ''
+    i = 0
+    while i < len(children):
+        token = children[i]
+        token_type = token.type
+
+        if token_type == 'text':
+            text = pending_break + token.content
+            if text.strip() or text == ' ':
+                paragraph.add_run(text)
+
+        # Line breaks start the following text on a new line
+        elif token_type in ('softbreak', 'hardbreak'):
+            pending_break = line_break
+            i += 1
+            continue
+
+        # Strong/Bold, Emphasis/Italic and Links wrap inline content
+        elif token_type in ('strong_open', 'em_open', 'link_open'):
+            close = _find_close(children, i)
+            text = _inline_text(children[i + 1:close], line_break)
+            if token_type == 'link_open':
+                href = token.attrGet('href') or ''
+                run = paragraph.add_run(f'{text} ({href})')
+                run.font.color.rgb = RGBColor(0, 0, 255)
+                run.underline = True
+            else:
+                run = paragraph.add_run(text)
+                run.bold = token_type == 'strong_open' or None
+                run.italic = token_type == 'em_open' or None
+            i = close
+
+        # Code (inline)
+        elif token_type == 'code_inline':
+            paragraph.add_run(token.content, style=CODE_CHAR_STYLE)
+
+        # Images
+        elif token_type == 'image':
+            src = token.attrGet('src') or ''
+            if images_dir and src:
+                _add_image_to_paragraph(paragraph, src, images_dir)
+
+        # Raw <img> tags
+        elif token_type == 'html_inline':
+            match = _HTML_IMAGE_RE.search(token.content)
+            if match and images_dir:
+                _add_image_to_paragraph(paragraph, match.group(1), images_dir)
+
+        pending_break = ''
+        i += 1
+
+
+def _process_list_tokens(builder, tokens, start, end, images_dir, ordered=False, level=0, line_break='\n'):
+    """
+    Process ordered or unordered list tokens.
+    """
+    i = start + 1
+    while i < end:
+        if tokens[i].type != 'list_item_open':
+            i += 1
+            continue
+        item_close = _find_close(tokens, i)
+
+        # Get text content, excluding nested lists. Blocks are joined as in
+        # markdown2's HTML: paragraphs of a loose item by a blank line, other
+        # blocks by a line break, and code keeps its trailing newline
+        text_parts = []
+        nested_lists = []
+        previous = None
+        j = i + 1
+        while j < item_close:
+            token = tokens[j]
+            block = None
+            if token.type in ('bullet_list_open', 'ordered_list_open'):
+                nested_lists.append(j)
+                j = _find_close(tokens, j)
+            elif token.type == 'paragraph_open':
+                block = 'paragraph' if not token.hidden else 'text'
+                text_parts.append(_inline_text(tokens[j + 1].children, line_break))
+                j = _find_close(tokens, j)
+            elif token.type in ('fence', 'code_block'):
+                block = 'code'
+                text_parts.append(token.content)
+            elif token.type == 'html_block':
+                block = 'html'
+                text_parts.append(BeautifulSoup(token.content, 'html5lib').get_text())
+            if block is not None:
+                if previous is not None:
+                    text_parts.insert(-1, '\n\n' if previous == block == 'paragraph' else '\n')
+                previous = block
+            j += 1
+
+        text = _TASK_MARKER_RE.sub('', ''.join(text_parts).strip())
+
+        if text:
+            p = builder.add_paragraph(text, style='List Number' if ordered else 'List Bullet')
+            p.paragraph_format.left_indent = Inches(0.5 * (level + 1))
+
+        # Process nested lists
+        for nested in nested_lists:
+            _process_list_tokens(builder, tokens, nested, _find_close(tokens, nested), images_dir,
+                                 ordered=tokens[nested].type == 'ordered_list_open', level=level + 1,
+                                 line_break=line_break)
+
+        i = item_close + 1
+
+
+def _resolve_image(image_src, images_dir):
+    """
+    Find an image referenced from markdown, handling relative and URL-encoded paths.
+
+    Returns:
+        A filesystem path, a BytesIO with the image read from an export zip,
+        or None if the image does not exist
+    """
+    # URL-decode the image source path (handles Notion exports with encoded Chinese characters)
+    decoded_src = unquote(image_src)
+
+    if isinstance(images_dir, ArchivePath):
+        # Read the image straight from the export zip
+        image_member = images_dir.joinpath(decoded_src)
+        return io.BytesIO(image_member.read_bytes()) if image_member.is_file() else None
+
+    # Handle relative paths
+    if not os.path.isabs(decoded_src):
+        image_path = os.path.join(images_dir, decoded_src)
+    else:
+        image_path = decoded_src
+    return image_path if os.path.exists(image_path) else None
 
 
 def _add_image_to_paragraph(paragraph, image_src, images_dir):
@@ -262,20 +871,21 @@ def _add_image_to_paragraph(paragraph, image_src, images_dir):
     Add an image to a paragraph, handling relative paths and URL-encoded paths.
     """
     try:
-        # URL-decode the image source path (handles Notion exports with encoded Chinese characters)
-        decoded_src = unquote(image_src)
-
-        # Handle relative paths
-        if not os.path.isabs(decoded_src):
-            image_path = os.path.join(images_dir, decoded_src)
-        else:
-            image_path = decoded_src
+        image_path = _resolve_image(image_src, images_dir)
 
         # Check if image exists
-        if os.path.exists(image_path):
-            # Add image with max width of 6 inches
-            run = paragraph.add_run()
-            run.add_picture(image_path, width=Inches(6))
+        if image_path is not None:
+            if isinstance(image_path, io.BytesIO):
+                image_data = image_path.getvalue()
+            else:
+                with open(image_path, 'rb') as f:
+                    image_data = f.read()
+
+            # Add image with max width of 6 inches, downsampled for that width
+            with metrics.timed('images'):
+                run = paragraph.add_run()
+                run.add_picture(io.BytesIO(normalize_image(image_data, width_inches=6)), width=Inches(6))
+            metrics.count('conversion_images_total', kind='markdown')
         else:
             # Image not found - add placeholder text
             run = paragraph.add_run(f'[Image not found: {image_src}]')
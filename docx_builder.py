@@ -0,0 +1,369 @@
+import io
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_BREAK
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.oxml.table import CT_Tbl
+from lxml import etree
+from docx.shared import Emu, Pt
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from xml.sax.saxutils import escape
+
+# Fonts shared by both converters. Microsoft YaHei covers Chinese, Japanese and Korean text.
+BODY_FONT = 'Calibri'
+CODE_FONT = 'Consolas'
+EAST_ASIA_FONT = 'Microsoft YaHei'
+CODE_SIZE = Pt(9)
+
+# Style names runs and paragraphs refer to
+CODE_STYLE = 'Code'
+CODE_CHAR_STYLE = 'Code Char'
+TABLE_TEXT_STYLE = 'Table Text'
+TABLE_HEADER_STYLE = 'Table Header'
+
+# Characters a run turns into elements of their own instead of text
+_RUN_SPECIAL_RE = re.compile(r'([\t\r\n])')
+
+# Part of the package holding the body, and the tag spooled blocks are written after
+_DOCUMENT_PART = 'word/document.xml'
+_BODY_START = b'<w:body>'
+
+# Template documents already built in this process, keyed by their options
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def new_document(heading_size=None):
+    """
+    Create an empty Word document from the prebuilt template.
+
+    The template carries the fonts the converters used to write into every
+    run: Calibri with Microsoft YaHei for East Asian text on Normal and the
+    heading styles, and Consolas on the code styles. Runs created on top of
+    it need no formatting of their own.
+
+    Args:
+        heading_size: Font size for all heading levels, None keeps the
+            sizes of the default template
+
+    Returns:
+        A docx Document
+    """
+    key = heading_size
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            template = _templates[key] = _build_template(heading_size)
+    return Document(io.BytesIO(template))
+
+
+def _build_template(heading_size):
+    """Set up the styles on a default document and return it as .docx bytes."""
+    doc = Document()
+    styles = doc.styles
+
+    _set_style_fonts(styles['Normal'], BODY_FONT)
+
+    for level in range(1, 10):
+        heading = styles[f'Heading {level}']
+        _set_style_fonts(heading, BODY_FONT)
+        if heading_size is not None:
+            heading.font.size = heading_size
+
+    # Code blocks
+    code = styles.add_style(CODE_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    code.base_style = styles['Normal']
+    _set_style_fonts(code, CODE_FONT, CODE_SIZE)
+
+    # Inline code
+    code_char = styles.add_style(CODE_CHAR_STYLE, WD_STYLE_TYPE.CHARACTER)
+    _set_style_fonts(code_char, CODE_FONT, CODE_SIZE)
+
+    # Table cells. The table style applies its own (theme) fonts to the header
+    # row and first column, a paragraph style other than Normal takes precedence.
+    table_text = styles.add_style(TABLE_TEXT_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    table_text.base_style = styles['Normal']
+    _set_style_fonts(table_text, BODY_FONT)
+
+    table_header = styles.add_style(TABLE_HEADER_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    table_header.base_style = table_text
+    table_header.font.bold = True
+
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
+
+def _set_style_fonts(style, font_name, size=None):
+    """Give a style explicit fonts in place of the theme fonts it may inherit."""
+    rFonts = style.element.get_or_add_rPr().get_or_add_rFonts()
+    for attribute in ('w:asciiTheme', 'w:hAnsiTheme', 'w:eastAsiaTheme'):
+        rFonts.attrib.pop(qn(attribute), None)
+    rFonts.set(qn('w:ascii'), font_name)
+    rFonts.set(qn('w:hAnsi'), font_name)
+    rFonts.set(qn('w:eastAsia'), EAST_ASIA_FONT)
+    if size is not None:
+        style.font.size = size
+
+
+class DocumentBuilder:
+    """
+    Appends blocks to the end of a Word document.
+
+    Document.add_paragraph and friends find the insertion point by scanning
+    the whole body, and doc.paragraphs builds a list of every paragraph, so
+    both get slower as the document grows. The builder inserts each block
+    right before the section properties it looks up once, and keeps the
+    blocks it created in a list, so adding a block and reaching the last
+    one take constant time.
+
+    Args:
+        doc: Document to append to, normally from new_document()
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.blocks = []
+        self._container = doc._body
+        self._body = doc.element.body
+        self._sectPr = self._body.sectPr
+        self._block_width = doc._block_width
+        self._style_ids = {}
+        self._spool = None
+        self._spooled_max_id = 0
+        self._heading_offset = 0
+
+    @property
+    def last(self):
+        """The block added last, or None if nothing was added yet."""
+        return self.blocks[-1] if self.blocks else None
+
+    def add_paragraph(self, text='', style=None):
+        """Add a paragraph, optionally with text and a paragraph style name."""
+        paragraph = Paragraph(self._append(OxmlElement('w:p')), self._container)
+        if text:
+            paragraph.add_run(text)
+        if style is not None:
+            paragraph._p.style = self._style_id(style)
+        self.blocks.append(paragraph)
+        return paragraph
+
+    def add_heading(self, text='', level=1):
+        """Add a heading paragraph, level 0 is the Title style."""
+        if not 0 <= level <= 9:
+            raise ValueError(f'level must be in range 0-9, got {level}')
+        if level > 0:
+            level = min(level + self._heading_offset, 9)
+        return self.add_paragraph(text, 'Title' if level == 0 else f'Heading {level}')
+
+    def add_table(self, rows, cols, style=None):
+        """Add an empty table spanning the text width, columns evenly sized."""
+        table = Table(self._append(CT_Tbl.new_tbl(rows, cols, self._block_width)), self._container)
+        if style is not None:
+            table._tbl.tblStyle_val = self._style_id(style)
+        self.blocks.append(table)
+        return table
+
+    def add_table_data(self, rows, cols, style=None):
+        """
+        Add a table filled with text in a single pass.
+
+        Filling cells through table.rows[i].cells[j] rebuilds the row and
+        cell lists on every access, which makes large tables quadratic. This
+        writes the XML of all rows at once instead. Header cells get the
+        Table Header paragraph style (bold), other cells Table Text.
+
+        Args:
+            rows: List of rows, each a list of (text, is_header) tuples.
+                Cells past cols are dropped, short rows are padded.
+            cols: Number of columns
+            style: Table style name
+
+        Returns:
+            The Table, or None if there is nothing to add
+        """
+        if not rows or cols < 1:
+            return None
+
+        col_width = Emu(self._block_width / cols)
+        tc_pr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{col_width.twips}"/></w:tcPr>'
+        header_p_pr = f'<w:pPr><w:pStyle w:val="{self._style_id(TABLE_HEADER_STYLE)}"/></w:pPr>'
+        text_p_pr = f'<w:pPr><w:pStyle w:val="{self._style_id(TABLE_TEXT_STYLE)}"/></w:pPr>'
+        empty_cell = f'<w:tc>{tc_pr}<w:p>{text_p_pr}</w:p></w:tc>'
+
+        parts = []
+        for cells in rows:
+            parts.append('<w:tr>')
+            for text, is_header in cells[:cols]:
+                parts.append(f'<w:tc>{tc_pr}<w:p>{header_p_pr if is_header else text_p_pr}')
+                if text:
+                    parts.append(_run_xml(text))
+                parts.append('</w:p></w:tc>')
+            parts.extend([empty_cell] * (cols - len(cells)))
+            parts.append('</w:tr>')
+
+        tbl = CT_Tbl.new_tbl(0, cols, self._block_width)
+        tbl.extend(list(parse_xml(f'<w:tbl {nsdecls("w")}>{"".join(parts)}</w:tbl>')))
+        table = Table(self._append(tbl), self._container)
+        if style is not None:
+            tbl.tblStyle_val = self._style_id(style)
+        self.blocks.append(table)
+        return table
+
+    def add_picture(self, image, width=None, height=None):
+        """Add a picture in a paragraph of its own."""
+        shape = self.add_paragraph().add_run().add_picture(image, width, height)
+        # python-docx numbers drawings after the highest id still in the tree
+        docPr = shape._inline.docPr
+        if docPr.id <= self._spooled_max_id:
+            docPr.id = self._spooled_max_id + 1
+            docPr.name = f'Picture {docPr.id}'
+        return shape
+
+    def add_page_break(self):
+        """Add a paragraph holding a page break."""
+        paragraph = self.add_paragraph()
+        paragraph.add_run().add_break(WD_BREAK.PAGE)
+        return paragraph
+
+    @contextmanager
+    def indented(self, indent):
+        """
+        Indent every paragraph added inside the with block.
+
+        The indent is added to the paragraph's own left indent, so nested
+        lists keep their levels and nested blocks indent further.
+        """
+        start = len(self.blocks)
+        yield
+        for block in self.blocks[start:]:
+            if isinstance(block, Paragraph):
+                paragraph_format = block.paragraph_format
+                paragraph_format.left_indent = Emu((paragraph_format.left_indent or 0) + indent)
+
+    @contextmanager
+    def demoted(self, levels):
+        """
+        Add the headings inside the with block levels lower: Heading 1
+        becomes Heading 1 + levels, down to Heading 9. Title is left as is.
+        """
+        previous = self._heading_offset
+        self._heading_offset += levels
+        try:
+            yield
+        finally:
+            self._heading_offset = previous
+
+    def spool(self):
+        """
+        Move the blocks added so far out of memory into a temporary file.
+
+        The body of a long document takes far more memory as an element tree
+        than as XML text. Spooled blocks are written out as XML and dropped
+        from the tree; save() puts them back in front of the blocks still in
+        memory. Afterwards blocks and last only cover blocks added later, and
+        the document has to be saved with save() instead of doc.save().
+        Pictures stay in the package, at the size they are stored in.
+        """
+        children = [child for child in self._body if child is not self._sectPr]
+        if not children:
+            return
+
+        self._spooled_max_id = self._renumber_drawings()
+
+        if self._sectPr is not None:
+            self._body.remove(self._sectPr)
+        xml = etree.tostring(self._body, encoding='utf-8')
+        for child in children:
+            self._body.remove(child)
+        if self._sectPr is not None:
+            self._body.append(self._sectPr)
+        self.blocks = []
+
+        # Keep the children, the body start tag carries the namespace declarations
+        start = xml.index(b'>') + 1
+        end = xml.rindex(b'</w:body>')
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile()
+        self._spool.write(xml[start:end])
+
+    def save(self, output):
+        """
+        Save the document, including spooled blocks, to a path or binary file object.
+        """
+        if self._spool is None:
+            self.doc.save(output)
+            return
+
+        self._renumber_drawings()
+        with tempfile.TemporaryFile() as package:
+            self.doc.save(package)
+            package.seek(0)
+            with zipfile.ZipFile(package) as source, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+                for info in source.infolist():
+                    entry = zipfile.ZipInfo(info.filename, info.date_time)
+                    entry.compress_type = info.compress_type
+                    with target.open(entry, 'w') as part:
+                        if info.filename == _DOCUMENT_PART:
+                            xml = source.read(info)
+                            start = xml.index(_BODY_START) + len(_BODY_START)
+                            part.write(xml[:start])
+                            self._spool.seek(0)
+                            shutil.copyfileobj(self._spool, part)
+                            part.write(xml[start:])
+                        else:
+                            with source.open(info) as data:
+                                shutil.copyfileobj(data, part)
+
+    def _renumber_drawings(self):
+        """
+        Give the drawings in the tree that reuse a spooled id a new one, return the highest id.
+
+        Pictures added to paragraphs without add_picture() are numbered by
+        python-docx after the highest id in the tree, which no longer holds
+        the spooled drawings.
+        """
+        ids = [int(value) for value in self._body.xpath('.//@id') if value.isdigit()]
+        next_id = max([self._spooled_max_id] + ids)
+        for docPr in self._body.xpath('.//wp:docPr'):
+            if docPr.id <= self._spooled_max_id:
+                next_id += 1
+                docPr.id = next_id
+                docPr.name = f'Picture {next_id}'
+        return next_id
+
+    def _append(self, element):
+        if self._sectPr is not None:
+            self._sectPr.addprevious(element)
+        else:
+            self._body.append(element)
+        return element
+
+    def _style_id(self, name):
+        style_id = self._style_ids.get(name)
+        if style_id is None:
+            style_id = self._style_ids[name] = self.doc.styles[name].style_id
+        return style_id
+
+
+def _run_xml(text):
+    """Run XML for text, with tabs and line breaks as python-docx writes them."""
+    parts = ['<w:r>']
+    for piece in _RUN_SPECIAL_RE.split(text):
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in ('\r', '\n'):
+            parts.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ''
+            parts.append(f'<w:t{space}>{escape(piece)}</w:t>')
+    parts.append('</w:r>')
+    return ''.join(parts)
@@ -0,0 +1,73 @@
+"""
+Gunicorn settings shared by all deployments.
+
+Gunicorn reads ./gunicorn.conf.py on start-up; options given on the command
+line (bind address, workers, threads, timeout) take precedence.
+"""
+import os
+import sys
+from memory import current_rss
+
+# Workers whose resident memory grows past this are restarted once their
+# conversions have finished (0 = never). Memory freed by a large conversion
+# is often not returned to the system, restarting the worker does.
+WORKER_MAX_RSS = int(os.environ.get('WORKER_MAX_RSS', 896 * 1024 * 1024))
+
+# Import the app in the master and fork the workers from it: the app is
+# loaded and warmed up once, and workers (restarted ones too) start warm
+# sharing its memory. Off by default, code changes then need a full restart.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+# Warm the app up before a worker takes requests (see app.warm_up), so the
+# first conversion after a cold start does not wait for the converters to load
+WARMUP = os.environ.get('WARMUP', '1') != '0'
+
+
+def when_ready(server):
+    """With preload_app, warm up once in the master, before the workers are forked."""
+    if preload_app and WARMUP:
+        _warm_up()
+
+
+def post_worker_init(worker):
+    """Warm up the worker before it accepts requests; a no-op if it was forked from a warm master."""
+    if WARMUP:
+        _warm_up()
+    # Conversions finish in background threads, check memory after each one
+    # too, so a worker is recycled even if no request follows its last job
+    job_queue = getattr(sys.modules.get('app'), 'job_queue', None)
+    if job_queue is not None:
+        job_queue.on_finished = lambda: _recycle_if_large(worker)
+
+
+def _warm_up():
+    warm_up = getattr(sys.modules.get('app'), 'warm_up', None)
+    if warm_up is not None:
+        warm_up()
+
+
+def post_request(worker, req, environ, resp):
+    """Recycle the worker after this request if its memory grew past WORKER_MAX_RSS."""
+    _recycle_if_large(worker)
+
+
+def _recycle_if_large(worker):
+    if WORKER_MAX_RSS <= 0 or not worker.alive:
+        return
+
+    rss = current_rss()
+    if rss is None or rss < WORKER_MAX_RSS:
+        return
+
+    def restart():
+        worker.log.info(f'Worker RSS {rss // (1024 * 1024)} MB exceeds WORKER_MAX_RSS, restarting worker')
+        worker.alive = False
+
+    # Conversions run in background threads of the worker. Stop taking new
+    # ones and restart as soon as the queued ones finished, their results are
+    # on disk so other workers can still serve them.
+    job_queue = getattr(sys.modules.get('app'), 'job_queue', None)
+    if job_queue is not None:
+        job_queue.drain(restart)
+    else:
+        restart()
@@ -0,0 +1,153 @@
+import io
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from cache import ConversionCache
+
+logger = logging.getLogger(__name__)
+
+# Resolution images are stored at for the width they are shown at in the document
+IMAGE_DPI = int(os.environ.get('IMAGE_DPI', 200))
+JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+# Bumped when normalize_image output changes, cached images and documents are then redone
+NORMALIZE_VERSION = 2
+EXIF_ORIENTATION = 0x0112
+
+# Part of the conversion cache keys, documents converted with other settings are not reused
+IMAGE_SETTINGS = f'images={NORMALIZE_VERSION}:dpi={IMAGE_DPI}:quality={JPEG_QUALITY}'
+
+# Processed images are kept in memory and, if a folder is configured, on disk.
+# Settings come from the environment so pooled worker processes share them.
+IMAGE_CACHE_FOLDER = os.environ.get('IMAGE_CACHE_FOLDER', os.path.join('cache', 'images'))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 0 disables the disk cache
+MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_memory_cache = OrderedDict()
+_memory_cache_size = 0
+_memory_lock = threading.Lock()
+_disk_cache = None
+
+
+def normalize_image(data, width_inches=6, dpi=None):
+    """
+    Prepare an image for embedding at a given display width.
+
+    Images wider than needed for width_inches at the target DPI are
+    downsampled. The result is stored as PNG when the image has transparency
+    or few colors (screenshots, diagrams) and as JPEG otherwise (photos).
+    An image that needs no resizing keeps its original encoding unless the
+    other format is smaller. Results are cached by a hash of the input.
+
+    Args:
+        data: Encoded image bytes
+        width_inches: Width the image is displayed at in the document
+        dpi: Target resolution, defaults to IMAGE_DPI
+
+    Returns:
+        Encoded image bytes, the original data if it cannot be processed
+    """
+    dpi = dpi or IMAGE_DPI
+    hasher = hashlib.sha256(data)
+    hasher.update(f'\0{NORMALIZE_VERSION}:{width_inches:.3f}:{dpi}:{JPEG_QUALITY}'.encode('utf-8'))
+    key = hasher.hexdigest()
+
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        result = _process_image(data, round(width_inches * dpi))
+    except Exception as e:
+        logger.warning('Could not normalize image: %s', e)
+        result = data
+
+    _cache_put(key, result)
+    return result
+
+
+def _process_image(data, max_width):
+    img = Image.open(io.BytesIO(data))
+    source_format = img.format
+
+    # Leave formats Pillow cannot re-encode faithfully alone (animations, vector)
+    if source_format not in ('PNG', 'JPEG', 'BMP', 'TIFF', 'GIF', 'WEBP') or getattr(img, 'is_animated', False):
+        return data
+
+    # Rotate photos taken sideways upright, re-encoding drops the EXIF
+    # orientation and Word does not apply it
+    transposed = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+    if transposed:
+        img = ImageOps.exif_transpose(img)
+
+    resized = img.width > max_width
+    if resized:
+        height = max(1, round(img.height * max_width / img.width))
+        img = img.resize((max_width, height), Image.LANCZOS)
+
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    few_colors = has_alpha or img.mode in ('1', 'P') or img.getcolors(256) is not None
+
+    output = io.BytesIO()
+    if few_colors:
+        target_format = 'PNG'
+        img.save(output, format='PNG', optimize=True)
+    else:
+        target_format = 'JPEG'
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    result = output.getvalue()
+
+    # Re-encoding an image that kept its size and orientation is only worth it if it shrinks
+    if not resized and not transposed and source_format in ('PNG', 'JPEG'):
+        if source_format == target_format or len(result) >= len(data):
+            return data
+    return result
+
+
+def _cache_get(key):
+    with _memory_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    disk_cache = _get_disk_cache()
+    data = disk_cache.get(key) if disk_cache else None
+    if data is not None:
+        _memory_put(key, data)
+    return data
+
+
+def _cache_put(key, data):
+    _memory_put(key, data)
+    disk_cache = _get_disk_cache()
+    if disk_cache:
+        disk_cache.put(key, data)
+
+
+def _memory_put(key, data):
+    global _memory_cache_size
+    if len(data) > MEMORY_CACHE_MAX_BYTES:
+        return
+    with _memory_lock:
+        if key in _memory_cache:
+            return
+        _memory_cache[key] = data
+        _memory_cache_size += len(data)
+        while _memory_cache_size > MEMORY_CACHE_MAX_BYTES:
+            _, evicted = _memory_cache.popitem(last=False)
+            _memory_cache_size -= len(evicted)
+
+
+def _get_disk_cache():
+    global _disk_cache
+    if _disk_cache is None and IMAGE_CACHE_MAX_BYTES > 0:
+        try:
+            _disk_cache = ConversionCache(IMAGE_CACHE_FOLDER, IMAGE_CACHE_MAX_BYTES, suffix='.img')
+        except OSError as e:
+            logger.warning('Image cache disabled: %s', e)
+            return None
+    return _disk_cache
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import threading
+import logging
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobError(Exception):
+    """A conversion failure whose message can be shown to the user as-is."""
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue cannot accept more work."""
+
+
+class Job:
+    """
+    A single background conversion.
+
+    Job functions receive the job as their first argument and use
+    add_message() for the per-file warnings the routes used to flash.
+    """
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.status = PENDING
+        self.messages = []
+        self.result = None
+        self.error = None
+        self.cost = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def add_message(self, message, category='warning'):
+        """Record a message to be flashed once the user collects the result."""
+        self.messages.append([category, message])
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'messages': list(self.messages),
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    Bounded in-process worker pool for conversion jobs.
+
+    Job state is mirrored to a JSON file per job in state_dir so that status
+    polls answered by another gunicorn worker process still find the job.
+
+    Args:
+        state_dir: Directory for job state files
+        max_workers: Number of conversions that run at the same time
+        max_pending: Number of jobs allowed to wait for a free worker
+        retention: Seconds a finished job is kept in memory
+        admission: Optional admission.AdmissionController; jobs submitted
+            with a cost stay pending until their cost fits its budget
+
+    Attributes:
+        on_finished: Optional callable run with no arguments after each job
+            finishes, in the thread that ran it
+    """
+
+    def __init__(self, state_dir, max_workers=2, max_pending=16, retention=3600, admission=None):
+        self.state_dir = state_dir
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self.admission = admission
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='convert')
+        self._jobs = {}
+        self._active = 0
+        self._running = 0
+        self._draining = False
+        self._drained = None
+        self.on_finished = None
+        self._lock = threading.Lock()
+        os.makedirs(state_dir, exist_ok=True)
+
+    @property
+    def active(self):
+        """Number of jobs queued or running."""
+        return self._active
+
+    @property
+    def running(self):
+        """Number of jobs running, the others are waiting for a worker or admission."""
+        return self._running
+
+    def submit(self, job_id, kind, func, *args, cost=None):
+        """
+        Queue func(job, *args) for execution and return the new Job.
+
+        Args:
+            cost: Estimated admission.Cost of the job, None runs it as soon
+                as a worker is free
+
+        Raises:
+            QueueFullError: If max_workers + max_pending jobs are already
+                queued, or the queue is draining
+            admission.AdmissionError: If cost exceeds the whole budget
+        """
+        if cost is not None and self.admission is not None:
+            self.admission.check(cost)
+
+        with self._lock:
+            if self._draining or self._active >= self.max_workers + self.max_pending:
+                raise QueueFullError('Conversion queue is full')
+            self._prune()
+            job = Job(job_id, kind)
+            job.cost = cost
+            self._jobs[job_id] = job
+            self._active += 1
+
+        self._save(job)
+        # Records logged while the job runs carry its ID, the upload ID in the app
+        self._executor.submit(logs.wrap(self._run, job.id), job, func, args)
+        return job
+
+    def get(self, job_id):
+        """Return the state dict of a job, or None if it is unknown."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+
+        state_path = self._state_path(job_id)
+        if state_path is None or not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def drain(self, callback=None):
+        """
+        Stop accepting jobs, so the process can be restarted once the queued ones finish.
+
+        Args:
+            callback: Called with no arguments once no job is left, right
+                away if none is queued, else in the thread of the last one
+        """
+        with self._lock:
+            self._draining = True
+            if self._active:
+                self._drained = callback
+                return
+        if callback is not None:
+            callback()
+
+    def _run(self, job, func, args):
+        try:
+            with self._admit(job.cost):
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._save(job)
+                with self._lock:
+                    self._running += 1
+                try:
+                    job.result = func(job, *args)
+                finally:
+                    with self._lock:
+                        self._running -= 1
+            job.status = DONE
+        except JobError as e:
+            logger.info('Job %s failed: %s', job.id, e)
+            job.error = str(e)
+            job.status = FAILED
+        except Exception as e:
+            logger.exception('Job %s failed: %s', job.id, e)
+            job.error = f'An error occurred: {str(e)}'
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+            with self._lock:
+                self._active -= 1
+                drained = None
+                if self._active == 0:
+                    drained, self._drained = self._drained, None
+            if drained is not None:
+                drained()
+            if self.on_finished is not None:
+                self.on_finished()
+
+    def _admit(self, cost):
+        """Wait for the admission budget, jobs without a cost run straight away."""
+        if cost is None or self.admission is None:
+            return nullcontext()
+        return self.admission.admit(cost)
+
+    def _prune(self):
+        """Forget finished jobs older than the retention period (lock held)."""
+        cutoff = time.time() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _state_path(self, job_id):
+        # Job IDs are UUIDs; reject anything that could escape state_dir
+        if not job_id or not all(c.isalnum() or c == '-' for c in job_id):
+            return None
+        return os.path.join(self.state_dir, f'{job_id}.json')
+
+    def _save(self, job):
+        state_path = self._state_path(job.id)
+        tmp_path = f'{state_path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, state_path)
+        except OSError as e:
+            logger.warning('Could not save state for job %s: %s', job.id, e)
@@ -0,0 +1,206 @@
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import functools
+import threading
+import logging.handlers
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import metrics
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # 'text' or 'json' (one object per line, e.g. for Cloud Logging)
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))  # Records waiting to be written, more are dropped
+
+# Per-page records of PDF conversions are logged at INFO for every
+# LOG_PAGE_INTERVAL-th page and at DEBUG for the others (0 = all at DEBUG)
+LOG_PAGE_INTERVAL = int(os.environ.get('LOG_PAGE_INTERVAL', 50))
+
+# Libraries that log every PDF operator or image header at DEBUG
+QUIET_LOGGERS = ('pdfminer', 'pdfplumber', 'PIL')
+
+# Attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'upload_id', 'upload'}
+
+# Upload the thread is working on, set by context()
+_local = threading.local()
+
+_listener = None
+_handler = None
+_config = None  # Arguments of the last configure() call
+
+
+@contextmanager
+def context(upload_id):
+    """Tag the records this thread logs in the with block with an upload ID."""
+    previous = getattr(_local, 'upload_id', None)
+    _local.upload_id = upload_id
+    try:
+        yield
+    finally:
+        _local.upload_id = previous
+
+
+def wrap(func, upload_id):
+    """Return func running inside context(upload_id)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with context(upload_id):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def page_level(page_num):
+    """Level of the per-page records of page_num: INFO for the sampled pages, DEBUG for the others."""
+    if LOG_PAGE_INTERVAL > 0 and page_num % LOG_PAGE_INTERVAL == 0:
+        return logging.INFO
+    return logging.DEBUG
+
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'upload_id'):
+            record.upload_id = getattr(_local, 'upload_id', None)
+        return True
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread, dropping them rather than waiting when the queue is full."""
+
+    def prepare(self, record):
+        # Only what the formatters need crosses the queue: the message with its
+        # arguments merged and the traceback as text, not the objects they refer to
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.count('log_records_dropped_total')
+
+
+class TextFormatter(logging.Formatter):
+    """time LEVEL logger [upload ID]: message key=value..."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s%(upload)s: %(message)s')
+
+    def format(self, record):
+        upload_id = getattr(record, 'upload_id', None)
+        record.upload = f' [{upload_id}]' if upload_id else ''
+        text = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with severity and message keys as log collectors expect them."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        upload_id = getattr(record, 'upload_id', None)
+        if upload_id:
+            entry['upload_id'] = upload_id
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+def configure(level=None, stream='stdout', fmt=None):
+    """
+    Send the log records of this process through a queue to stdout or stderr.
+
+    Logging calls only put the record on a bounded queue, a listener thread
+    formats and writes it, so a conversion never waits for the output. When
+    the queue is full records are dropped and counted in the
+    log_records_dropped_total metric. Calling again replaces the setup.
+
+    Args:
+        level: Lowest level logged, LOG_LEVEL by default
+        stream: 'stdout' or 'stderr'
+        fmt: 'text' or 'json', LOG_FORMAT by default
+    """
+    global _listener, _handler, _config
+    stop()
+    _config = (level, stream, fmt)
+
+    output = logging.StreamHandler(getattr(sys, stream))
+    output.setFormatter(JsonFormatter() if (fmt or LOG_FORMAT) == 'json' else TextFormatter())
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = _QueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(_ContextFilter())
+    root.addHandler(_handler)
+    root.setLevel(level or LOG_LEVEL)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def configured():
+    """Whether configure() was called in this process."""
+    return _config is not None
+
+
+def stop():
+    """Write the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def process_state():
+    """Arguments for init_process(), to log from pool processes as this process does."""
+    return _config, getattr(_local, 'upload_id', None)
+
+
+def init_process(config, upload_id):
+    """Process pool initializer: set up logging like the parent and tag records with its upload ID."""
+    if config is not None:
+        configure(*config)
+    _local.upload_id = upload_id
+
+
+def _after_fork():
+    # The listener thread is not forked along, and its queue may have been
+    # locked by another thread; start over (gunicorn workers of a preloaded app)
+    global _listener
+    _listener = None
+    if _config is not None:
+        configure(*_config)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(stop)
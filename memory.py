@@ -0,0 +1,60 @@
+import os
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes.
+
+    Read from /proc on Linux. Elsewhere the peak RSS of the process is the
+    closest value available and is returned instead.
+
+    Returns:
+        Size in bytes, or None if it cannot be determined
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    return peak_rss()
+
+
+def peak_rss():
+    """Return the highest resident set size this process has reached, in bytes, or None."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+class PeakRSS:
+    """
+    Highest resident set size seen during one piece of work.
+
+    The process-wide peak from getrusage covers the lifetime of the process,
+    so a worker that once converted a large file would report that peak for
+    every later conversion. This samples the current RSS instead; call
+    sample() at the points where memory use is highest. The value is for
+    the whole process and includes conversions running in other threads.
+    """
+
+    def __init__(self):
+        self.peak = current_rss() or 0
+
+    def sample(self):
+        """Record the current RSS, return it."""
+        rss = current_rss() or 0
+        if rss > self.peak:
+            self.peak = rss
+        return rss
+
+    def __str__(self):
+        return f'{self.peak / (1024 * 1024):.0f} MB'
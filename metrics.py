@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Processes sharing a directory here write their metrics to it, and every
+# process reports the sum of all of them, so a scrape answered by any
+# gunicorn worker covers the whole server. Empty keeps metrics per process.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+WRITE_INTERVAL = 5  # Seconds between writes of this process's metrics file
+
+# Upper bounds of the stage duration buckets, in seconds
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Metric name: (type, help)
+METRICS = {
+    'conversion_stage_seconds': (
+        'histogram', 'Time spent in each conversion stage. Stages can nest: '
+        'docx_build includes images and the zip_extract reads of the images it embeds.'),
+    'conversion_files_total': ('counter', 'Documents converted, by kind'),
+    'conversion_pages_total': ('counter', 'PDF pages converted'),
+    'conversion_images_total': ('counter', 'Images embedded in converted documents, by kind'),
+    'conversion_bytes_total': ('counter', 'Bytes uploaded for conversion (in) and of converted documents (out)'),
+    'log_records_dropped_total': ('counter', 'Log records dropped because the log queue was full'),
+}
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_gauges = {}  # name -> (help, callback)
+_last_write = 0.0
+_write_enabled = True
+
+
+@contextmanager
+def timed(stage):
+    """Time the with block as a conversion stage, failures included."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def observe(stage, seconds):
+    """Record the duration of one conversion stage."""
+    key = ('conversion_stage_seconds', (('stage', stage),))
+    with _lock:
+        buckets = _histograms.get(key)
+        if buckets is None:
+            buckets = _histograms[key] = [0] * (len(STAGE_BUCKETS) + 2)
+        buckets[bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+        buckets[-1] += seconds
+    _maybe_write()
+
+
+def count(name, value=1, **labels):
+    """Add value to a counter, e.g. count('conversion_files_total', kind='pdf', result='ok')."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_write()
+
+
+def register_gauge(name, help_text, callback):
+    """Report callback() as a gauge at every scrape, e.g. the number of queued jobs."""
+    with _lock:
+        _gauges[name] = (help_text, callback)
+
+
+def output_size(output):
+    """Return the size of a file written to a path or binary file object."""
+    if hasattr(output, 'tell'):
+        return output.tell()
+    return os.path.getsize(output)
+
+
+def collected(func, *args, **kwargs):
+    """
+    Process pool entry point: call func and return (result, metrics).
+
+    Metrics recorded in a pool process would be lost with it. They are
+    handed back with the result instead, for the parent to merge().
+    """
+    global _write_enabled
+    _write_enabled = False
+    drain()
+    result = func(*args, **kwargs)
+    return result, drain()
+
+
+def drain():
+    """Return the counters and histograms recorded so far and reset them."""
+    with _lock:
+        snapshot = _snapshot()
+        _counters.clear()
+        _histograms.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    """Add metrics returned by collected() in another process."""
+    with _lock:
+        _merge_into(_counters, _histograms, snapshot)
+    _maybe_write()
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+    gauges = _read_gauges()
+
+    if METRICS_DIR and _write_enabled:
+        write()
+        counters, histograms, gauges = _read_all()
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        else:
+            for (metric, labels), buckets in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(STAGE_BUCKETS + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(buckets[-1])}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    for name, (help_text, value) in sorted(gauges.items()):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write():
+    """Write this process's metrics to METRICS_DIR."""
+    global _last_write
+    if not METRICS_DIR:
+        return
+    gauges = _read_gauges()
+    with _lock:
+        state = _snapshot()
+        _last_write = time.monotonic()
+    state['gauges'] = gauges
+
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(f'{path}.tmp', path)
+    except OSError as e:
+        logger.warning('Could not write metrics: %s', e)
+
+
+def _maybe_write():
+    if METRICS_DIR and _write_enabled and time.monotonic() - _last_write > WRITE_INTERVAL:
+        write()
+
+
+def _read_all():
+    """
+    Sum the metrics files of all processes.
+
+    Counters and histograms of processes that have exited are kept, so the
+    totals do not drop when a worker is restarted; gauges only count for
+    processes that are still running.
+    """
+    counters = {}
+    histograms = {}
+    gauges = {}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for filename in names:
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        _merge_into(counters, histograms, state)
+        if _process_alive(int(filename[:-len('.json')])):
+            for name, (help_text, value) in state.get('gauges', {}).items():
+                gauges[name] = [help_text, gauges.get(name, [help_text, 0])[1] + value]
+    return counters, histograms, gauges
+
+
+def _snapshot():
+    """Counters and histograms as a JSON-friendly dict (lock held)."""
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+        'histograms': [[name, list(labels), list(buckets)] for (name, labels), buckets in _histograms.items()],
+    }
+
+
+def _merge_into(counters, histograms, snapshot):
+    for name, labels, value in snapshot.get('counters', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets in snapshot.get('histograms', []):
+        key = (name, tuple(tuple(label) for label in labels))
+        if len(buckets) != len(STAGE_BUCKETS) + 2:
+            continue
+        total = histograms.setdefault(key, [0] * len(buckets))
+        for i, value in enumerate(buckets):
+            total[i] += value
+
+
+def _read_gauges():
+    """Call the gauge callbacks, outside the lock as they take locks of their own."""
+    with _lock:
+        callbacks = dict(_gauges)
+    gauges = {}
+    for name, (help_text, callback) in callbacks.items():
+        try:
+            gauges[name] = [help_text, callback()]
+        except Exception as e:
+            logger.warning('Could not read gauge %s: %s', name, e)
+    return gauges
+
+
+def _process_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+atexit.register(_maybe_write)
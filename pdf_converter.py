@@ -1,12 +1,49 @@
 import os
+import logging
 import pdfplumber
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.oxml.ns import qn
+from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from PIL import Image
 import io
 import re
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pdfminer.pdftypes import (
+    resolve1, LITERALS_DCT_DECODE, LITERALS_JPX_DECODE, LITERALS_CCITTFAX_DECODE, LITERALS_JBIG2_DECODE,
+)
+from cache import new_key_hasher, file_digest
+from images import normalize_image, IMAGE_SETTINGS
+from docx_builder import DocumentBuilder, new_document
+from pdf_layout import analyze_page
+from memory import PeakRSS
+import metrics
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Bump when a change alters the generated documents, so cached conversions are not reused
+CONVERTER_VERSION = '7'
+
+# How images are taken out of the PDF: 'stream' reads the embedded image data
+# (JPEG as stored, other formats decoded once), 'render' rasterizes the page
+# area under every image. Stream mode still renders masked or unusual images.
+PDF_IMAGE_MODE = os.environ.get('PDF_IMAGE_MODE', 'stream')
+
+# Smallest page count worth the start-up cost of a process pool
+PARALLEL_MIN_PAGES = 8
+
+# PDFs with at least this many pages are converted in streaming mode (0 = never):
+# the PDF is reopened every STREAMING_WINDOW_PAGES pages so the objects pdfminer
+# caches are released, and the finished part of the document is spooled to disk
+PDF_STREAMING_PAGES = int(os.environ.get('PDF_STREAMING_PAGES', 100))
+STREAMING_WINDOW_PAGES = 50
+
+# Headings are set in body text size like the extracted text
+HEADING_SIZE = Pt(11)
+
+# Characters below 0x20 that Word documents cannot hold (tab, newline and carriage return are kept)
+_CONTROL_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
 
 def _clean_text(text):
@@ -17,11 +54,8 @@ def _clean_text(text):
     if not text:
         return ""
 
-    # Remove NULL bytes
-    text = text.replace('\x00', '')
-
-    # Remove other control characters except newline, tab, and carriage return
-    text = ''.join(char for char in text if ord(char) >= 32 or char in '\n\r\t')
+    # Remove NULL bytes and other control characters except newline, tab, and carriage return
+    text = _CONTROL_CHARS_RE.sub('', text)
 
     # Remove any remaining problematic Unicode characters
     text = text.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
@@ -29,135 +63,228 @@ def _clean_text(text):
     return text.strip()
 
 
-def _set_font(run, is_code=False):
-    """
-    Set appropriate fonts for text to ensure compatibility with Microsoft Word.
-    """
-    if is_code:
-        run.font.name = 'Consolas'
-        run.font.size = Pt(9)
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
-    else:
-        run.font.name = 'Calibri'
-        run.font.size = Pt(11)  # Set default font size
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
-        run._element.rPr.rFonts.set(qn('w:ascii'), 'Calibri')
-        run._element.rPr.rFonts.set(qn('w:hAnsi'), 'Calibri')
-
-
-def convert_pdf_to_docx(pdf_file_path, output_path, extract_images=True):
+def convert_pdf_to_docx(pdf_file_path, output_path, extract_images=True, workers=1, streaming=None):
     """
     Convert a PDF file to a Word document with improved formatting.
 
     Args:
         pdf_file_path: Path to the PDF file
-        output_path: Path where the Word document should be saved
+        output_path: Path or binary file object the Word document should be saved to
         extract_images: Whether to extract and embed images from PDF
+        workers: Number of processes to split the pages across (1 = convert in this process)
+        streaming: Keep memory use flat regardless of the page count, None
+            enables it for PDFs with at least PDF_STREAMING_PAGES pages
     """
-    # Create Word document
-    doc = Document()
+    peak_rss = PeakRSS()
+
+    # Create Word document from the template with HEADING_SIZE headings
+    doc = new_document(heading_size=HEADING_SIZE)
+    builder = DocumentBuilder(doc)
 
     # Open PDF file
     with pdfplumber.open(pdf_file_path) as pdf:
-        print(f"[DEBUG] Processing PDF with {len(pdf.pages)} pages")
-
-        for page_num, page in enumerate(pdf.pages, 1):
-            print(f"[DEBUG] Processing page {page_num}/{len(pdf.pages)}")
-
-            # Add page break (except for first page)
-            if page_num > 1:
-                doc.add_page_break()
-
-            # Get page layout info
-            page_width = page.width
-            page_height = page.height
-
-            # Extract images first if requested
-            images_positions = []
-            if extract_images:
-                try:
-                    images = page.images
-                    if images:
-                        print(f"[DEBUG] Found {len(images)} images on page {page_num}")
-                        for img in images:
-                            images_positions.append({
-                                'x0': img['x0'],
-                                'top': img['top'],
-                                'x1': img['x1'],
-                                'bottom': img['bottom']
-                            })
-                except Exception as e:
-                    print(f"[DEBUG] Error getting images info: {e}")
-
-            # Extract text with layout
-            text = page.extract_text(layout=True)
-            if text:
-                # Clean text
-                text = _clean_text(text)
-
-                # Process text line by line to preserve layout
-                lines = text.split('\n')
-                current_para = []
-
-                for line in lines:
-                    line = _clean_text(line)
-                    if not line:
-                        # Empty line - end current paragraph
-                        if current_para:
-                            para_text = ' '.join(current_para)
-                            _add_paragraph_with_style(doc, para_text)
-                            current_para = []
-                        continue
-
-                    # Check if line is a heading
-                    if _is_heading(line):
-                        # End current paragraph first
-                        if current_para:
-                            para_text = ' '.join(current_para)
-                            _add_paragraph_with_style(doc, para_text)
-                            current_para = []
-
-                        # Add heading
-                        heading = doc.add_heading(line, level=_get_heading_level(line))
-                        for run in heading.runs:
-                            _set_font(run)
-                    else:
-                        # Regular text - accumulate into paragraph
-                        current_para.append(line)
-
-                # Add remaining paragraph
-                if current_para:
-                    para_text = ' '.join(current_para)
-                    _add_paragraph_with_style(doc, para_text)
-
-            # Extract and add tables
-            tables = page.extract_tables()
-            if tables:
-                print(f"[DEBUG] Found {len(tables)} tables on page {page_num}")
-                for table_data in tables:
-                    _add_table_to_doc(doc, table_data)
-
-            # Extract and add images
-            if extract_images and images_positions:
-                for img_index, img_pos in enumerate(images_positions):
-                    try:
-                        _extract_and_add_image(doc, page, img_pos, page_num, img_index)
-                    except Exception as e:
-                        print(f"[DEBUG] Error extracting image {img_index}: {e}")
+        num_pages = len(pdf.pages)
+        if streaming is None:
+            streaming = 0 < PDF_STREAMING_PAGES <= num_pages
+        parallel = workers > 1 and num_pages >= PARALLEL_MIN_PAGES
+        logger.info('Processing PDF with %d pages%s', num_pages, ' (streaming)' if streaming else '')
+
+        if not parallel and not streaming:
+            for page_num, page in enumerate(pdf.pages, 1):
+                blocks = _extract_page_blocks(page, page_num, num_pages, extract_images)
+                # Drop the characters and layout objects pdfplumber keeps for the page
+                page.flush_cache()
+                _add_blocks_to_doc(builder, blocks, page_break=page_num > 1)
+                peak_rss.sample()
+
+    if parallel or streaming:
+        if parallel:
+            # Split the pages across worker processes and merge them in order
+            pages = _extract_blocks_parallel(pdf_file_path, num_pages, extract_images, workers)
+        else:
+            pages = _extract_blocks_streaming(pdf_file_path, num_pages, extract_images)
+
+        for page_num, blocks in pages:
+            _add_blocks_to_doc(builder, blocks, page_break=page_num > 1)
+            peak_rss.sample()
+            if streaming and page_num % STREAMING_WINDOW_PAGES == 0:
+                builder.spool()
 
     # Save document
-    doc.save(output_path)
-    print(f"[DEBUG] PDF converted successfully to {output_path}")
+    with metrics.timed('docx_save'):
+        builder.save(output_path)
+    peak_rss.sample()
+    metrics.count('conversion_files_total', kind='pdf')
+    metrics.count('conversion_pages_total', num_pages)
+    metrics.count('conversion_bytes_total', metrics.output_size(output_path), direction='out')
+    logger.info('PDF converted: %s (peak RSS %s)', pdf_file_path, peak_rss,
+                extra={'pages': num_pages, 'peak_rss_bytes': peak_rss.peak})
+
+
+def warm_up():
+    """Build the document template of PDF conversions ahead of the first upload."""
+    new_document(heading_size=HEADING_SIZE)
+
+
+def pdf_cache_key(pdf_file_path, extract_images=True):
+    """Compute the conversion cache key of a PDF file from its bytes and the options used."""
+    hasher = new_key_hasher('pdf', CONVERTER_VERSION, IMAGE_SETTINGS)
+    hasher.update(f'images:{PDF_IMAGE_MODE}'.encode('utf-8') if extract_images else b'text')
+    return file_digest(hasher, pdf_file_path).hexdigest()
+
+
+def _extract_blocks_parallel(pdf_file_path, num_pages, extract_images, workers):
+    """
+    Extract the blocks of all pages with a process pool.
+
+    The page range is split into contiguous chunks, a few per worker so a
+    chunk of image-heavy pages does not leave the other workers idle.
+    Yields (page_num, blocks) in page order.
+    """
+    num_chunks = min(num_pages, workers * 4)
+    chunk_size = -(-num_pages // num_chunks)
+    chunks = [
+        list(range(first, min(first + chunk_size, num_pages + 1)))
+        for first in range(1, num_pages + 1, chunk_size)
+    ]
+    logger.debug('Splitting %d pages into %d chunks across %d processes', num_pages, len(chunks), workers)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=logs.init_process, initargs=logs.process_state()) as executor:
+        # Keep a bounded number of chunks in flight, so finished chunks do not
+        # pile up in memory while an earlier one is still being converted
+        futures = deque()
+        for page_numbers in chunks:
+            if len(futures) >= workers * 2:
+                yield from _collect(futures.popleft())
+            futures.append(executor.submit(
+                metrics.collected, _extract_pages_blocks, pdf_file_path, page_numbers, num_pages, extract_images))
+        while futures:
+            yield from _collect(futures.popleft())
+
+
+def _collect(future):
+    """Return the pages of a finished chunk, keeping the metrics recorded in its process."""
+    pages, chunk_metrics = future.result()
+    metrics.merge(chunk_metrics)
+    return pages
+
+
+def _extract_blocks_streaming(pdf_file_path, num_pages, extract_images):
+    """
+    Extract the blocks of all pages in this process, STREAMING_WINDOW_PAGES at a time.
+
+    Every window opens the PDF again, which releases the fonts, content
+    streams and other objects pdfminer cached for the previous pages.
+    Yields (page_num, blocks) in page order.
+    """
+    for first in range(1, num_pages + 1, STREAMING_WINDOW_PAGES):
+        page_numbers = list(range(first, min(first + STREAMING_WINDOW_PAGES, num_pages + 1)))
+        yield from _extract_pages_blocks(pdf_file_path, page_numbers, num_pages, extract_images)
 
 
-def _add_paragraph_with_style(doc, text):
+def _extract_pages_blocks(pdf_file_path, page_numbers, num_pages, extract_images):
+    """Process pool entry point: return [(page_num, blocks)] for the given pages."""
+    results = []
+    with pdfplumber.open(pdf_file_path, pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            results.append((page.page_number, _extract_page_blocks(page, page.page_number, num_pages, extract_images)))
+            page.flush_cache()
+    return results
+
+
+def _extract_page_blocks(page, page_num, num_pages, extract_images):
+    """
+    Extract the content of one page as a list of blocks.
+
+    Blocks follow the page from top to bottom and are plain tuples so they
+    can be sent back from worker processes: ('heading', text, level),
+    ('paragraph', text), ('table', rows) and ('image', image_bytes, width_inches).
+    """
+    blocks = []
+
+    # Read the characters, ruling lines and images of the page once, table text
+    # only ends up in its table
+    regions = analyze_page(page, include_images=extract_images)
+
+    # Every page at debug level, a sample of them otherwise
+    level = logs.page_level(page_num)
+    if logger.isEnabledFor(level):
+        tables = sum(1 for kind, _ in regions if kind == 'table')
+        images = sum(1 for kind, _ in regions if kind == 'image')
+        logger.log(level, 'Page %d/%d: %d tables, %d images', page_num, num_pages, tables, images)
+
+    img_index = 0
+    for kind, content in regions:
+        if kind == 'text':
+            current_para = []
+            for line in content:
+                line = _clean_text(line)
+                if not line:
+                    continue
+
+                # Check if line is a heading
+                if _is_heading(line):
+                    # End current paragraph first
+                    if current_para:
+                        blocks.append(('paragraph', ' '.join(current_para)))
+                        current_para = []
+
+                    # Add heading
+                    blocks.append(('heading', line, _get_heading_level(line)))
+                else:
+                    # Regular text - accumulate into paragraph
+                    current_para.append(line)
+
+            # Add remaining paragraph
+            if current_para:
+                blocks.append(('paragraph', ' '.join(current_para)))
+
+        elif kind == 'table':
+            blocks.append(('table', content))
+
+        elif kind == 'image':
+            try:
+                with metrics.timed('pdf_images'):
+                    image = _extract_image(page, content, page_num, img_index)
+                if image:
+                    metrics.count('conversion_images_total', kind='pdf')
+                    blocks.append(('image',) + image)
+            except Exception as e:
+                logger.warning('Error extracting image %d on page %d: %s', img_index, page_num, e)
+            img_index += 1
+
+    return blocks
+
+
+def _add_blocks_to_doc(builder, blocks, page_break=False):
+    """Add the blocks extracted from one page to the Word document."""
+    # Add page break (except for first page)
+    if page_break:
+        builder.add_page_break()
+
+    for block in blocks:
+        kind = block[0]
+        if kind == 'heading':
+            builder.add_heading(block[1], level=block[2])
+        elif kind == 'paragraph':
+            _add_paragraph_with_style(builder, block[1])
+        elif kind == 'table':
+            _add_table_to_doc(builder, block[1])
+        elif kind == 'image':
+            try:
+                _add_image_to_doc(builder, block[1], block[2])
+            except Exception as e:
+                logger.warning('Could not add image to document: %s', e)
+
+
+def _add_paragraph_with_style(builder, text):
     """Add a paragraph with proper styling."""
     if not text or not text.strip():
         return
 
-    p = doc.add_paragraph(text)
-    for run in p.runs:
-        _set_font(run)
+    p = builder.add_paragraph(text)
 
     # Set paragraph spacing
     p.paragraph_format.space_after = Pt(6)
@@ -218,7 +345,7 @@ def _get_heading_level(text):
     return 3
 
 
-def _add_table_to_doc(doc, table_data):
+def _add_table_to_doc(builder, table_data):
     """
     Add a table to the Word document with improved formatting.
     """
@@ -230,41 +357,28 @@ def _add_table_to_doc(doc, table_data):
     if not valid_rows:
         return
 
-    num_rows = len(valid_rows)
     num_cols = max(len(row) for row in valid_rows)
 
-    # Create Word table
-    table = doc.add_table(rows=num_rows, cols=num_cols)
-    table.style = 'Light Grid Accent 1'
-
-    # Fill table
-    for i, row in enumerate(valid_rows):
-        for j, cell in enumerate(row):
-            if j < num_cols and cell is not None:
-                # Clean cell text
-                cell_text = _clean_text(str(cell))
-                table.rows[i].cells[j].text = cell_text
-
-                # Set font for table cells
-                for paragraph in table.rows[i].cells[j].paragraphs:
-                    for run in paragraph.runs:
-                        run.font.size = Pt(10)
-                        _set_font(run)
-
-                # Make first row bold (header)
-                if i == 0:
-                    for paragraph in table.rows[i].cells[j].paragraphs:
-                        for run in paragraph.runs:
-                            run.bold = True
+    # Clean cell text, make first row bold (header)
+    rows = [
+        [(_clean_text(str(cell)) if cell is not None else '', i == 0) for cell in row]
+        for i, row in enumerate(valid_rows)
+    ]
+
+    # Create and fill the Word table in one pass
+    builder.add_table_data(rows, num_cols, style='Light Grid Accent 1')
 
     # Add spacing after table
-    p = doc.add_paragraph()
+    p = builder.add_paragraph()
     p.paragraph_format.space_after = Pt(12)
 
 
-def _extract_and_add_image(doc, page, img_pos, page_num, img_index):
+def _extract_image(page, img_pos, page_num, img_index):
     """
-    Extract image from PDF page and add to Word document with improved handling.
+    Extract image from PDF page with improved handling.
+
+    Returns:
+        (image_bytes, width_inches), or None if the image is skipped
     """
     try:
         x0, y0, x1, y1 = img_pos['x0'], img_pos['top'], img_pos['x1'], img_pos['bottom']
@@ -273,41 +387,124 @@ def _extract_and_add_image(doc, page, img_pos, page_num, img_index):
         width = x1 - x0
         height = y1 - y0
         if width < 20 or height < 20:
-            print(f"[DEBUG] Skipping small image {img_index} ({width}x{height})")
-            return
+            logger.debug('Skipping small image %d on page %d (%.0fx%.0f)', img_index, page_num, width, height)
+            return None
+
+        # Calculate width (max 6 inches, maintain aspect ratio)
+        img_width_inches = min(6, width / 72)  # Convert points to inches
 
-        # Crop image from page
-        bbox = (x0, y0, x1, y1)
-        cropped_page = page.crop(bbox)
+        image_data = None
+        if PDF_IMAGE_MODE == 'stream':
+            try:
+                image_data = _image_from_stream(img_pos)
+            except Exception as e:
+                logger.debug('Could not read image %d stream on page %d, rendering it: %s', img_index, page_num, e)
+
+        if image_data is None:
+            # Crop image from page and render it with higher resolution
+            bbox = (x0, y0, x1, y1)
+            cropped_page = page.crop(bbox)
+            img = cropped_page.to_image(resolution=200)
+
+            img_bytes = io.BytesIO()
+            img.save(img_bytes, format='PNG')
+            image_data = img_bytes.getvalue()
+            source = 'rendered'
+        else:
+            source = 'stream'
 
-        # Convert to image with higher resolution
-        img = cropped_page.to_image(resolution=200)
+        logger.debug('Extracted image %d from page %d (%.0fx%.0f, %s)', img_index, page_num, width, height, source)
+        return normalize_image(image_data, width_inches=img_width_inches), img_width_inches
 
-        # Save to bytes
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
+    except Exception as e:
+        logger.warning('Could not extract image %d from page %d: %s', img_index, page_num, e)
+        return None
 
-        # Calculate width (max 6 inches, maintain aspect ratio)
-        img_width_inches = min(6, width / 72)  # Convert points to inches
 
-        # Add to document
-        doc.add_picture(img_bytes, width=Inches(img_width_inches))
+def _image_from_stream(image):
+    """
+    Read an image from its embedded stream instead of rendering the page.
 
-        # Add spacing after image
-        p = doc.add_paragraph()
-        p.paragraph_format.space_after = Pt(12)
+    JPEG (DCT) data is returned as stored. JPEG 2000 and raw pixel data
+    (Flate, LZW, run-length or no filter) is decoded once with Pillow and
+    returned as PNG.
 
-        print(f"[DEBUG] Added image {img_index} from page {page_num} ({width:.0f}x{height:.0f})")
+    Args:
+        image: pdfplumber image object
 
-    except Exception as e:
-        print(f"[DEBUG] Could not extract image {img_index} from page {page_num}: {e}")
+    Returns:
+        Encoded image bytes, or None if the image has to be rendered: masks
+        and decode arrays change how it looks on the page, and CCITT, JBIG2,
+        indexed and other color spaces are not decoded here
+    """
+    stream = image['stream']
+    if image.get('imagemask') or any(stream.get(key) is not None for key in ('SMask', 'Mask', 'Decode')):
+        return None
+
+    filters = [name for name, _ in stream.get_filters()]
+    last_filter = filters[-1] if filters else None
+    if last_filter in LITERALS_CCITTFAX_DECODE or last_filter in LITERALS_JBIG2_DECODE:
+        return None
+
+    mode = _stream_color_mode(image.get('colorspace'))
+    if mode is None:
+        return None
+
+    # pdfminer undoes the filters before a JPEG or JPEG 2000 one and leaves that encoded
+    data = stream.get_data()
+    if last_filter in LITERALS_DCT_DECODE:
+        if mode != 'CMYK':
+            return data
+        # Pillow undoes the inverted CMYK of Adobe JPEGs
+        img = Image.open(io.BytesIO(data))
+    elif last_filter in LITERALS_JPX_DECODE:
+        img = Image.open(io.BytesIO(data))
+    else:
+        bits = image.get('bits')
+        if bits == 1 and mode == 'L':
+            mode = '1'
+        elif bits != 8:
+            return None
+        img = Image.frombytes(mode, tuple(image['srcsize']), data)
+
+    if img.mode == 'CMYK':
+        img = img.convert('RGB')
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+
+def _stream_color_mode(colorspace):
+    """Pillow mode of an image color space (pdfplumber colorspace list), None if unsupported."""
+    if colorspace and len(colorspace) == 1 and isinstance(resolve1(colorspace[0]), list):
+        colorspace = resolve1(colorspace[0])
+    if not colorspace:
+        return None
+    name = getattr(resolve1(colorspace[0]), 'name', None)
+    if name == 'ICCBased' and len(colorspace) > 1:
+        profile = resolve1(colorspace[1])
+        components = resolve1(profile.get('N')) if profile is not None else None
+        return {1: 'L', 3: 'RGB', 4: 'CMYK'}.get(components)
+    return {
+        'DeviceGray': 'L', 'CalGray': 'L',
+        'DeviceRGB': 'RGB', 'CalRGB': 'RGB',
+        'DeviceCMYK': 'CMYK',
+    }.get(name)
+
+
+def _add_image_to_doc(builder, image_bytes, width_inches):
+    """Add an extracted image to the Word document."""
+    builder.add_picture(io.BytesIO(image_bytes), width=Inches(width_inches))
+
+    # Add spacing after image
+    p = builder.add_paragraph()
+    p.paragraph_format.space_after = Pt(12)
 
 
-def convert_pdf_to_docx_simple(pdf_file_path, output_path):
+def convert_pdf_to_docx_simple(pdf_file_path, output_path, workers=1, streaming=None):
     """
     Simple PDF to Word conversion with improved formatting.
     """
     # Use the full conversion with images enabled
-    convert_pdf_to_docx(pdf_file_path, output_path, extract_images=True)
+    convert_pdf_to_docx(pdf_file_path, output_path, extract_images=True, workers=workers, streaming=streaming)
 
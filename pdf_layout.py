@@ -0,0 +1,146 @@
+import bisect
+import metrics
+
+# Distances in PDF points, the defaults pdfplumber uses for text extraction
+X_TOLERANCE = 3
+Y_TOLERANCE = 3
+
+# Small fonts are often set with word gaps under X_TOLERANCE, so a gap wider
+# than this fraction of the font size also separates two words
+X_TOLERANCE_RATIO = 0.15
+
+# A vertical gap between two lines larger than this fraction of the line
+# height starts a new paragraph
+PARAGRAPH_GAP = 0.5
+
+
+def analyze_page(page, include_images=True):
+    """
+    Split a PDF page into paragraphs, tables and images in a single pass.
+
+    Table regions are found from the ruling lines and rectangles of the page.
+    Every character is then read once and either goes into the table cell it
+    falls in or into the body text, so table text no longer shows up a
+    second time as paragraphs. Body characters are grouped into lines and
+    the lines into paragraphs by the vertical gaps between them.
+
+    Args:
+        page: pdfplumber page
+        include_images: Whether to return the image regions
+
+    Returns:
+        List of regions ordered top to bottom, each one of
+        ('text', lines) for a paragraph given as a list of line strings,
+        ('table', rows) with rows as lists of cell text (None for merged cells),
+        ('image', image) with the pdfplumber image object
+    """
+    # Finding the tables parses the page, so this stage includes reading its layout
+    with metrics.timed('pdf_tables'):
+        tables = [_TableRegion(table) for table in page.find_tables()]
+
+    with metrics.timed('pdf_text'):
+        body_chars = []
+        for char in page.chars:
+            x = (char['x0'] + char['x1']) / 2
+            y = (char['top'] + char['bottom']) / 2
+            for table in tables:
+                if table.add_char(char, x, y):
+                    break
+            else:
+                body_chars.append(char)
+
+        regions = [(top, 'text', lines) for top, lines in _paragraphs(_lines(body_chars))]
+        regions.extend((table.top, 'table', table.text_rows()) for table in tables)
+    if include_images:
+        regions.extend((image['top'], 'image', image) for image in page.images)
+
+    regions.sort(key=lambda region: region[0])
+    return [(kind, content) for _, kind, content in regions]
+
+
+def _lines(chars):
+    """Group characters into lines, returned as (top, bottom, text) top to bottom."""
+    lines = []
+    current = []
+    line_top = None
+    for char in sorted(chars, key=lambda char: (char['top'], char['x0'])):
+        if current and char['top'] - line_top > Y_TOLERANCE:
+            lines.append(_line(current))
+            current = []
+        if not current:
+            line_top = char['top']
+        current.append(char)
+    if current:
+        lines.append(_line(current))
+    return [line for line in lines if line[2]]
+
+
+def _line(chars):
+    """Join the characters of one line left to right, spacing out gaps between words."""
+    chars.sort(key=lambda char: char['x0'])
+    parts = []
+    last_x1 = None
+    for char in chars:
+        if last_x1 is not None and char['x0'] - last_x1 > min(X_TOLERANCE, char['size'] * X_TOLERANCE_RATIO):
+            parts.append(' ')
+        parts.append(char['text'])
+        last_x1 = char['x1']
+    text = ' '.join(''.join(parts).split())
+    return min(char['top'] for char in chars), max(char['bottom'] for char in chars), text
+
+
+def _paragraphs(lines):
+    """Group lines into paragraphs, returned as (top, [line text])."""
+    paragraphs = []
+    previous = None
+    for top, bottom, text in lines:
+        if previous is None or top - previous[1] > PARAGRAPH_GAP * (previous[1] - previous[0]):
+            paragraphs.append((top, []))
+        paragraphs[-1][1].append(text)
+        previous = (top, bottom)
+    return paragraphs
+
+
+class _TableRegion:
+    """The cell grid of a table found on the page, collecting the characters inside it."""
+
+    def __init__(self, table):
+        self.x0, self.top, self.x1, self.bottom = table.bbox
+        self.rows = [row.cells for row in table.rows]
+        self._row_tops = [row.bbox[1] for row in table.rows]
+        # Left edge of every column, merged cells repeat the edge of the cell spanning them
+        self._cell_x0s = []
+        for cells in self.rows:
+            x0s = []
+            for cell in cells:
+                x0s.append(cell[0] if cell else (x0s[-1] if x0s else self.x0))
+            self._cell_x0s.append(x0s)
+        self._chars = {}
+
+    def add_char(self, char, x, y):
+        """Assign a character whose center is at (x, y), return False if outside the table."""
+        if not (self.x0 <= x <= self.x1 and self.top <= y <= self.bottom):
+            return False
+
+        row = bisect.bisect_right(self._row_tops, y) - 1
+        if row < 0:
+            return True
+        cells = self.rows[row]
+        col = bisect.bisect_right(self._cell_x0s[row], x) - 1
+        # Merged cells are None, the text belongs to the cell spanning them
+        while col >= 0 and cells[col] is None:
+            col -= 1
+        if col >= 0:
+            self._chars.setdefault((row, col), []).append(char)
+        return True
+
+    def text_rows(self):
+        """Return the cell texts, lines within a cell joined by newlines."""
+        return [
+            [
+                None if cell is None
+                else '\n'.join(text for _, _, text in _lines(self._chars.get((row, col), [])))
+                for col, cell in enumerate(cells)
+            ]
+            for row, cells in enumerate(self.rows)
+        ]
@@ -0,0 +1,139 @@
+import io
+import os
+import re
+import pstats
+import cProfile
+import functools
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Dump names: <tag>_<n>_<job function>.prof
+_DUMP_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+\.prof$')
+_UNSAFE_RE = re.compile(r'[^A-Za-z0-9.-]+')
+
+# Capture of the conversion job running in this thread, set by ProfileStore.capture
+_local = threading.local()
+
+
+def active():
+    """Return the tag of the capture running in this thread, or None."""
+    capture = getattr(_local, 'capture', None)
+    return capture[1] if capture else None
+
+
+class ProfileStore:
+    """
+    cProfile dumps of the conversions selected for profiling.
+
+    A conversion job wrapped with wrap(func, tag) is profiled as a whole and
+    dumped once, however many files it converts, to a .prof file named
+    after the tag (the upload ID) and the job function, readable with
+    pstats or snakeviz. While it runs, active() returns the tag, so the job
+    can convert in its own thread where the profile sees it. Dumps beyond
+    max_dumps are removed oldest first. The directory can be shared by
+    several processes.
+
+    Args:
+        directory: Folder the dumps are written to
+        max_dumps: Number of dumps kept
+    """
+
+    def __init__(self, directory, max_dumps=100):
+        self.directory = directory
+        self.max_dumps = max_dumps
+        self._lock = threading.Lock()
+        self._count = 0
+
+    @contextmanager
+    def capture(self, tag):
+        """Mark the conversion this thread runs in the with block as profiled, see active()."""
+        previous = getattr(_local, 'capture', None)
+        _local.capture = (self, _UNSAFE_RE.sub('-', tag))
+        try:
+            yield
+        finally:
+            _local.capture = previous
+
+    def wrap(self, func, tag):
+        """Return func running inside capture(tag) and profiled as one dump, for handing to the job queue."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.capture(tag):
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # Another profiler is active in this process (Python 3.12+ allows one)
+                    logger.warning('Could not profile %s: %s', func.__name__, e)
+                    return func(*args, **kwargs)
+
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    self.dump(profile, active(), func.__name__.strip('_'))
+        return wrapper
+
+    def dump(self, profile, tag, function):
+        """Write a finished profile, return its name or None if it could not be written."""
+        with self._lock:
+            self._count += 1
+            count = self._count
+        name = f'{tag}_{count:03d}_{function}.prof'
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.warning('Could not write profile %s: %s', name, e)
+            return None
+        logger.info('Wrote profile %s', name)
+        self._prune()
+        return name
+
+    def list(self):
+        """Return the dumps newest first as dicts of name, size and created (epoch seconds)."""
+        dumps = []
+        for name in self._names():
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            dumps.append({'name': name, 'size': stat.st_size, 'created': stat.st_mtime})
+        dumps.sort(key=lambda dump: dump['created'], reverse=True)
+        return dumps
+
+    def path(self, name):
+        """Return the path of a dump, or None if there is no dump of that name."""
+        if not _DUMP_NAME_RE.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def summary(self, name, limit=40):
+        """Return the functions of a dump with the most cumulative time, as pstats prints them."""
+        path = self.path(name)
+        if path is None:
+            return None
+        output = io.StringIO()
+        stats = pstats.Stats(path, stream=output)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def _names(self):
+        try:
+            return [name for name in os.listdir(self.directory) if _DUMP_NAME_RE.match(name)]
+        except FileNotFoundError:
+            return []
+
+    def _prune(self):
+        """Remove the oldest dumps beyond max_dumps."""
+        dumps = self.list()
+        for dump in dumps[self.max_dumps:]:
+            try:
+                os.remove(os.path.join(self.directory, dump['name']))
+            except OSError:
+                pass
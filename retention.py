@@ -0,0 +1,220 @@
+import os
+import re
+import json
+import time
+import shutil
+import threading
+import logging
+from jobs import PENDING, RUNNING
+
+logger = logging.getLogger(__name__)
+
+# Uploads and outputs are named after the upload ID (a UUID), alone or as a prefix
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+# Files written under a temporary name while a job runs
+_PARTIAL_SUFFIXES = ('.part', '.tmp')
+
+
+class RetentionJanitor:
+    """
+    Background cleanup of uploads, converted files and job state.
+
+    Every sweep removes, oldest first:
+    - uploads, outputs and job state files older than ttl,
+    - uploads and partial outputs (.part, .tmp) of jobs that are no longer
+      queued or running, left behind by crashed requests or workers, once
+      they are older than orphan_grace,
+    - further outputs until uploads and outputs together fit max_bytes.
+
+    Files of jobs that are queued or running, in any process sharing the
+    folders, are never removed; a job whose state still says running after
+    ttl is taken to have crashed. Only names starting with an upload ID are
+    touched. Several processes can sweep the same folders.
+
+    Args:
+        upload_folder: Folder uploads are saved to
+        output_folder: Folder converted files are written to
+        jobs_dir: Folder of the job state files
+        ttl: Seconds uploads, outputs and job states are kept
+        max_bytes: Total size of uploads and outputs to stay under (0 = no quota)
+        interval: Seconds between sweeps of the background thread
+        orphan_grace: Seconds before files of a job that is not queued or
+            running count as orphaned, so requests still saving an upload
+            are left alone
+    """
+
+    def __init__(self, upload_folder, output_folder, jobs_dir, ttl, max_bytes,
+                 interval=300, orphan_grace=900):
+        self.upload_folder = upload_folder
+        self.output_folder = output_folder
+        self.jobs_dir = jobs_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self._lock = threading.Lock()
+        self._thread = None
+        self._fork_hook = False
+        self._stats = {}
+        self.removed_files = 0
+        self.removed_bytes = 0
+
+    def start(self):
+        """Sweep now and then every interval seconds in a daemon thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+            self._thread.start()
+        if not self._fork_hook:
+            # Forked processes (gunicorn workers of a preloaded app) do not
+            # inherit the thread, and may inherit the lock held mid-sweep
+            os.register_at_fork(after_in_child=self._restart_in_child)
+            self._fork_hook = True
+
+    def _restart_in_child(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.start()
+
+    def sweep(self):
+        """Remove expired, orphaned and over-quota files once, return the usage afterwards."""
+        with self._lock:
+            now = time.time()
+            active, job_states = self._sweep_job_states(now)
+
+            entries = self._entries(self.upload_folder, True) + self._entries(self.output_folder, False)
+            kept = []
+            for entry in entries:
+                path, upload_id, size, mtime, is_upload = entry
+                age = now - mtime
+                if upload_id is None or upload_id in active:
+                    kept.append(entry)
+                elif age > self.ttl:
+                    self._remove(path, size, 'expired')
+                elif age > self.orphan_grace and (is_upload or path.endswith(_PARTIAL_SUFFIXES)):
+                    self._remove(path, size, 'orphaned')
+                else:
+                    kept.append(entry)
+
+            total = sum(entry[2] for entry in kept)
+            if self.max_bytes > 0 and total > self.max_bytes:
+                for path, upload_id, size, mtime, is_upload in sorted(kept, key=lambda entry: entry[3]):
+                    if total <= self.max_bytes:
+                        break
+                    if upload_id is None or upload_id in active:
+                        continue
+                    self._remove(path, size, 'over quota')
+                    total -= size
+                    kept.remove((path, upload_id, size, mtime, is_upload))
+
+            self._stats = {
+                'upload_bytes': sum(entry[2] for entry in kept if entry[4]),
+                'output_bytes': sum(entry[2] for entry in kept if not entry[4]),
+                'total_bytes': total,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'entries': len(kept),
+                'job_states': job_states,
+                'active_jobs': len(active),
+                'removed_files': self.removed_files,
+                'removed_bytes': self.removed_bytes,
+                'last_sweep': now,
+            }
+            return dict(self._stats)
+
+    def stats(self):
+        """Return the usage found by the last sweep."""
+        with self._lock:
+            return dict(self._stats)
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception('Retention sweep failed: %s', e)
+            time.sleep(self.interval)
+
+    def _sweep_job_states(self, now):
+        """Remove expired job state files, return (IDs of queued or running jobs, states kept)."""
+        active = set()
+        kept = 0
+        for entry in _scandir(self.jobs_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            age = now - stat.st_mtime
+            if age > self.ttl or (entry.name.endswith('.tmp') and age > self.orphan_grace):
+                self._remove(entry.path, stat.st_size, 'expired')
+                continue
+            kept += 1
+            if entry.name.endswith('.json') and _job_status(entry.path) in (PENDING, RUNNING):
+                active.add(entry.name[:-len('.json')])
+        return active, kept
+
+    def _entries(self, folder, is_upload):
+        """List (path, upload_id, size, mtime, is_upload) for the top-level entries of a folder."""
+        entries = []
+        jobs_dir = os.path.abspath(self.jobs_dir)
+        for entry in _scandir(folder):
+            if os.path.abspath(entry.path) == jobs_dir:
+                continue
+            match = _UPLOAD_ID_RE.match(entry.name)
+            try:
+                size, mtime = _usage(entry)
+            except OSError:
+                continue
+            entries.append((entry.path, match.group(0) if match else None, size, mtime, is_upload))
+        return entries
+
+    def _remove(self, path, size, reason):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # Removed by another process sweeping the same folders
+            return
+        except OSError as e:
+            logger.warning('Could not remove %s: %s', path, e)
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+        logger.info('Removed %s %s (%d bytes)', reason, path, size)
+
+
+def _scandir(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+def _usage(entry):
+    """Return (total size, latest mtime) of a file or directory tree."""
+    stat = entry.stat(follow_symlinks=False)
+    if not entry.is_dir(follow_symlinks=False):
+        return stat.st_size, stat.st_mtime
+
+    size = 0
+    mtime = stat.st_mtime
+    for root, _, files in os.walk(entry.path):
+        for name in files:
+            try:
+                file_stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            size += file_stat.st_size
+            mtime = max(mtime, file_stat.st_mtime)
+    return size, mtime
+
+
+def _job_status(state_path):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('status')
+    except (OSError, ValueError):
+        return None
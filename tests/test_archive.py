@@ -0,0 +1,131 @@
+"""
+ExportArchive opens nested zips within its budgets, and ArchivePath survives pickling.
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import zipfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive
+from archive import ExportArchive, ArchiveBudget, ArchiveLimitError, RATIO_MIN_BYTES
+from admission import estimate_export_cost, AdmissionError
+
+
+def _zip_bytes(members):
+    """Deflated zip of {name: bytes}."""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return output.getvalue()
+
+
+def _member(path):
+    """Name of an ArchivePath inside its archive, through the nested zips."""
+    return '/'.join(path.chain + (path.at,))
+
+
+class ExportArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        archive._open_archives.clear()
+
+    def tearDown(self):
+        for opened in archive._open_archives.values():
+            opened.close()
+        archive._open_archives.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_zip(self, members):
+        path = os.path.join(self.directory, f'export{len(os.listdir(self.directory))}.zip')
+        with open(path, 'wb') as f:
+            f.write(_zip_bytes(members))
+        return path
+
+    def nested_export(self):
+        """Export of a page, and a part zip holding a page and a zip one level deeper."""
+        deeper = _zip_bytes({'Deep.md': b'# Deep'})
+        part = _zip_bytes({'Workspace/Sub.md': b'# Sub', 'Workspace/image.png': b'png', 'More.zip': deeper})
+        return self.write_zip({'Root.md': b'# Root', 'notes.txt': b'skipped', 'Part-1.zip': part})
+
+    def test_lists_nested_members_with_suffixes(self):
+        with ExportArchive(self.nested_export()) as export:
+            names = sorted(_member(path) for path in export.files())
+            pages = sorted(path.name for path in export.files('.md'))
+            self.assertEqual(export.nested, ['Part-1.zip', 'Part-1.zip/More.zip'])
+        self.assertEqual(names, ['Part-1.zip/More.zip/Deep.md', 'Part-1.zip/Workspace/Sub.md',
+                                 'Part-1.zip/Workspace/image.png', 'Root.md'])
+        self.assertEqual(pages, ['Deep.md', 'Root.md', 'Sub.md'])
+
+    def test_max_depth_skips_deeper_zips(self):
+        with ExportArchive(self.nested_export(), max_depth=1) as export:
+            pages = sorted(path.name for path in export.files('.md'))
+        self.assertEqual(pages, ['Root.md', 'Sub.md'])
+        with ExportArchive(self.nested_export(), max_depth=0) as export:
+            self.assertEqual([path.name for path in export.files('.md')], ['Root.md'])
+
+    def test_max_members(self):
+        path = self.write_zip({f'page{i}.md': b'text' for i in range(10)})
+        with self.assertRaises(ArchiveLimitError):
+            ExportArchive(path, max_members=5)
+        ExportArchive(path, max_members=10).close()
+
+    def test_max_bytes_counts_nested_zips(self):
+        path = self.nested_export()
+        with ExportArchive(path, max_bytes=0) as export:
+            total = export.budget.total_bytes
+        with self.assertRaises(ArchiveLimitError):
+            ExportArchive(path, max_bytes=total - 1)
+        ExportArchive(path, max_bytes=total).close()
+
+    def test_max_ratio(self):
+        bomb = self.write_zip({'page.md': b'\0' * (2 * RATIO_MIN_BYTES)})
+        with self.assertRaisesRegex(ArchiveLimitError, 'page.md'):
+            ExportArchive(bomb)
+        ExportArchive(bomb, max_ratio=0).close()
+
+        # The ratio of a nested zip is checked before it is read
+        nested = self.write_zip({'Part-1.zip': _zip_bytes({'page.md': b'\0' * (2 * RATIO_MIN_BYTES)})})
+        with self.assertRaisesRegex(ArchiveLimitError, 'Part-1.zip/page.md'):
+            ExportArchive(nested)
+
+    def test_budget_ignores_small_members_ratio(self):
+        budget = ArchiveBudget(max_bytes=0, max_members=0, max_ratio=2)
+        info = zipfile.ZipInfo('small.md')
+        info.file_size, info.compress_size = RATIO_MIN_BYTES, 1
+        budget.add_member('small.md', info)
+        self.assertEqual(budget.total_bytes, RATIO_MIN_BYTES)
+
+    def test_estimate_rejects_archive_over_budget(self):
+        bomb = self.write_zip({'Part-1.zip': _zip_bytes({'page.md': b'\0' * (2 * RATIO_MIN_BYTES)})})
+        with self.assertRaises(AdmissionError):
+            estimate_export_cost(bomb)
+
+    def test_pickled_path_reopens_with_options(self):
+        path = self.write_zip({f'page{i}.md': f'# Page {i}'.encode() for i in range(3)})
+        with ExportArchive(path, suffixes=('.md',), max_members=0, max_ratio=0) as export:
+            page = sorted(export.files(), key=_member)[1]
+            data = pickle.dumps(page)
+
+        # As in a pool process, the archive is reopened from the pickle
+        reopened = pickle.loads(data)
+        self.assertIsNot(reopened.archive, page.archive)
+        self.assertEqual(_member(reopened), 'page1.md')
+        self.assertEqual(reopened.read_text(), '# Page 1')
+        self.assertEqual(reopened.archive.options, export.options)
+        self.assertEqual(reopened.archive.budget.max_members, 0)
+        # Later paths of the same zip share the reopened archive
+        self.assertIs(pickle.loads(data).archive, reopened.archive)
+
+
+if __name__ == '__main__':
+    unittest.main()
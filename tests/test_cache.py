@@ -0,0 +1,144 @@
+"""
+Conversion cache keys cover every input of a conversion, and the cache stays within its budget.
+
+Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# No image cache on disk, converted images would land in the working directory
+os.environ.setdefault('IMAGE_CACHE_MAX_BYTES', '0')
+
+import cache
+import converter
+import pdf_converter
+from cache import ConversionCache
+from converter import markdown_cache_key, convert_markdown_files
+
+
+class CacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.page = os.path.join(self.directory, 'page.md')
+        with open(self.page, 'w', encoding='utf-8') as f:
+            f.write('# Page\n\n![](image.png)\n')
+        self.image = os.path.join(self.directory, 'image.png')
+        with open(self.image, 'wb') as f:
+            f.write(b'first image')
+        self.pdf = os.path.join(self.directory, 'file.pdf')
+        with open(self.pdf, 'wb') as f:
+            f.write(b'%PDF-1.4 not parsed for the key')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def key(self, engine='html'):
+        return markdown_cache_key(self.page, self.directory, engine=engine)
+
+    def test_key_is_stable(self):
+        self.assertEqual(self.key(), self.key())
+        self.assertEqual(pdf_converter.pdf_cache_key(self.pdf), pdf_converter.pdf_cache_key(self.pdf))
+
+    def test_key_changes_with_engine(self):
+        self.assertNotEqual(self.key('html'), self.key('tokens'))
+
+    def test_key_changes_with_referenced_image(self):
+        before = self.key()
+        with open(self.image, 'wb') as f:
+            f.write(b'second image')
+        self.assertNotEqual(self.key(), before)
+
+    def test_key_changes_with_version(self):
+        before = self.key(), pdf_converter.pdf_cache_key(self.pdf)
+        with mock.patch.object(converter, 'CONVERTER_VERSION', 'next'), \
+                mock.patch.object(pdf_converter, 'CONVERTER_VERSION', 'next'):
+            after = self.key(), pdf_converter.pdf_cache_key(self.pdf)
+        self.assertNotEqual(after[0], before[0])
+        self.assertNotEqual(after[1], before[1])
+
+    def test_key_changes_with_image_settings(self):
+        before = self.key(), pdf_converter.pdf_cache_key(self.pdf)
+        for settings in ('images=2:dpi=150:quality=85', 'images=2:dpi=200:quality=70'):
+            with mock.patch.object(converter, 'IMAGE_SETTINGS', settings), \
+                    mock.patch.object(pdf_converter, 'IMAGE_SETTINGS', settings):
+                after = self.key(), pdf_converter.pdf_cache_key(self.pdf)
+            self.assertNotEqual(after[0], before[0], settings)
+            self.assertNotEqual(after[1], before[1], settings)
+
+    def test_pdf_key_changes_with_image_extraction(self):
+        self.assertNotEqual(pdf_converter.pdf_cache_key(self.pdf, extract_images=True),
+                            pdf_converter.pdf_cache_key(self.pdf, extract_images=False))
+
+    def test_cached_document_is_returned(self):
+        conversion_cache = ConversionCache(os.path.join(self.directory, 'cache'), 1024 * 1024)
+        tasks = [(self.page, self.directory)]
+        [(_, converted, error)] = convert_markdown_files(tasks, cache=conversion_cache)
+        self.assertIsNone(error)
+        with mock.patch.object(converter, 'convert_markdown_to_bytes', side_effect=AssertionError('converted')):
+            [(_, cached, error)] = convert_markdown_files(tasks, cache=conversion_cache)
+        self.assertIsNone(error)
+        self.assertEqual(cached, converted)
+        self.assertEqual(conversion_cache.stats()['hits'], 1)
+
+
+class ConversionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_put_and_get(self):
+        conversion_cache = ConversionCache(self.directory, 1000)
+        self.assertIsNone(conversion_cache.get('aa01'))
+        conversion_cache.put('aa01', b'document')
+        self.assertEqual(conversion_cache.get('aa01'), b'document')
+        self.assertEqual(conversion_cache.stats()['bytes'], len(b'document'))
+
+    def test_overwrite_keeps_size(self):
+        conversion_cache = ConversionCache(self.directory, 1000)
+        for _ in range(10):
+            conversion_cache.put('aa01', b'x' * 300)
+        conversion_cache.put('aa01', b'x' * 100)
+        self.assertEqual(conversion_cache.stats()['bytes'], 100)
+        # A new process sees the same size on disk
+        self.assertEqual(ConversionCache(self.directory, 1000).stats()['bytes'], 100)
+
+    def test_evicts_least_recently_used_without_listing(self):
+        conversion_cache = ConversionCache(self.directory, 1000)
+        for key in ('aa01', 'bb02', 'cc03'):
+            conversion_cache.put(key, b'x' * 300)
+        conversion_cache.get('aa01')
+        with mock.patch.object(conversion_cache, '_entries', side_effect=AssertionError('listed')):
+            conversion_cache.put('dd04', b'x' * 300)
+        self.assertIsNone(conversion_cache.get('bb02'))
+        for key in ('aa01', 'cc03', 'dd04'):
+            self.assertIsNotNone(conversion_cache.get(key), key)
+        self.assertEqual(conversion_cache.stats()['bytes'], 900)
+
+    def test_rescans_for_entries_of_other_processes(self):
+        conversion_cache = ConversionCache(self.directory, 1000)
+        other = ConversionCache(self.directory, 1000)
+        for key in ('aa01', 'bb02', 'cc03'):
+            other.put(key, b'x' * 300)
+        with mock.patch.object(cache, 'RESCAN_INTERVAL', -1):
+            conversion_cache.put('dd04', b'x' * 300)
+        self.assertIsNone(conversion_cache.get('aa01'))
+        self.assertEqual(conversion_cache.stats()['bytes'], 900)
+
+    def test_skips_document_over_budget(self):
+        conversion_cache = ConversionCache(self.directory, 10)
+        conversion_cache.put('aa01', b'x' * 11)
+        self.assertIsNone(conversion_cache.get('aa01'))
+        self.assertEqual(conversion_cache.stats()['bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+DocumentBuilder appends blocks, spools them to disk and renumbers drawings.
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import docx
+from docx.shared import Inches
+from PIL import Image
+from docx_builder import DocumentBuilder, new_document
+
+
+def _png(color):
+    output = io.BytesIO()
+    Image.new('RGB', (20, 10), color).save(output, format='PNG')
+    output.seek(0)
+    return output
+
+
+class DocumentBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = DocumentBuilder(new_document())
+
+    def saved(self):
+        """Save the builder's document and open it again."""
+        output = io.BytesIO()
+        self.builder.save(output)
+        return docx.Document(io.BytesIO(output.getvalue()))
+
+    def test_blocks_and_last(self):
+        self.assertIsNone(self.builder.last)
+        first = self.builder.add_paragraph('one')
+        table = self.builder.add_table_data([[('a', True), ('b', True)], [('1', False)]], 2)
+        self.assertEqual(self.builder.blocks, [first, table])
+        self.assertIs(self.builder.last, table)
+
+        document = self.saved()
+        self.assertEqual(document.paragraphs[0].text, 'one')
+        self.assertEqual([cell.text for cell in document.tables[0].rows[1].cells], ['1', ''])
+
+    def test_indented_adds_to_own_indent(self):
+        before = self.builder.add_paragraph('before')
+        with self.builder.indented(Inches(0.5)):
+            plain = self.builder.add_paragraph('plain')
+            item = self.builder.add_paragraph('item')
+            item.paragraph_format.left_indent = Inches(0.5)
+            with self.builder.indented(Inches(0.25)):
+                deeper = self.builder.add_paragraph('deeper')
+        after = self.builder.add_paragraph('after')
+
+        self.assertIsNone(before.paragraph_format.left_indent)
+        self.assertEqual(plain.paragraph_format.left_indent, Inches(0.5))
+        self.assertEqual(item.paragraph_format.left_indent, Inches(1))
+        self.assertEqual(deeper.paragraph_format.left_indent, Inches(0.75))
+        self.assertIsNone(after.paragraph_format.left_indent)
+
+    def test_demoted_headings(self):
+        self.builder.add_heading('top', 1)
+        with self.builder.demoted(1):
+            self.builder.add_heading('title', 0)
+            self.builder.add_heading('sub', 1)
+            with self.builder.demoted(7):
+                self.builder.add_heading('deep', 3)
+        self.builder.add_heading('back', 2)
+
+        styles = [paragraph.style.name for paragraph in self.saved().paragraphs]
+        self.assertEqual(styles, ['Heading 1', 'Title', 'Heading 2', 'Heading 9', 'Heading 2'])
+
+    def test_spooled_blocks_are_saved_in_order(self):
+        for i in range(3):
+            self.builder.add_paragraph(f'spooled {i}')
+        self.builder.spool()
+        self.assertEqual(self.builder.blocks, [])
+        self.assertIsNone(self.builder.last)
+        self.builder.add_paragraph('in memory')
+        self.builder.spool()
+        self.builder.add_heading('last', 1)
+
+        texts = [paragraph.text for paragraph in self.saved().paragraphs]
+        self.assertEqual(texts, ['spooled 0', 'spooled 1', 'spooled 2', 'in memory', 'last'])
+
+    def test_drawing_ids_are_unique_after_spool(self):
+        self.builder.add_picture(_png((255, 0, 0)), width=Inches(1))
+        self.builder.spool()
+        self.builder.add_picture(_png((0, 255, 0)), width=Inches(1))
+        # Added without add_picture, python-docx numbers it from the tree alone
+        self.builder.add_paragraph().add_run().add_picture(_png((0, 0, 255)), width=Inches(1))
+
+        document = self.saved()
+        ids = [int(value) for value in document.element.body.xpath('.//wp:docPr/@id')]
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(len(document.inline_shapes), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+The html and tokens markdown engines should build the same document.
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA = os.path.join(REPO, 'test_data')
+sys.path.insert(0, REPO)
+# No image cache on disk, converted images would land in the working directory
+os.environ.setdefault('IMAGE_CACHE_MAX_BYTES', '0')
+
+import docx
+from PIL import Image
+from converter import convert_markdown_to_docx, MARKDOWN_ENGINES
+
+
+class MarkdownEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def convert(self, markdown, engine):
+        """Convert markdown with engine, images are looked up in the test directory."""
+        md_path = os.path.join(self.directory, 'page.md')
+        with open(md_path, 'w', encoding='utf-8') as f:
+            f.write(markdown)
+        output = io.BytesIO()
+        convert_markdown_to_docx(md_path, output, self.directory, engine=engine)
+        return docx.Document(io.BytesIO(output.getvalue()))
+
+    def assertSameDocument(self, markdown):
+        """Assert both engines build the same paragraphs, return them as (style, text)."""
+        documents = {
+            engine: [(paragraph.style.name, paragraph.text) for paragraph in self.convert(markdown, engine).paragraphs]
+            for engine in MARKDOWN_ENGINES
+        }
+        self.assertEqual(documents['html'], documents['tokens'])
+        return documents['html']
+
+    def test_html_block_keeps_its_text(self):
+        paragraphs = self.assertSameDocument('Before\n\n<div>raw html block</div>\n\nAfter')
+        self.assertIn(('Normal', 'raw html block'), paragraphs)
+
+    def test_html_inline_keeps_its_text(self):
+        paragraphs = self.assertSameDocument('Text with <span>inline</span> html')
+        self.assertEqual(paragraphs, [('Normal', 'Text with inline html')])
+
+    def test_html_image_is_embedded(self):
+        Image.new('RGB', (40, 20), (200, 30, 30)).save(os.path.join(self.directory, 'image.png'))
+        for engine in MARKDOWN_ENGINES:
+            document = self.convert('<img src="image.png">\n', engine)
+            self.assertEqual(len(document.inline_shapes), 1, engine)
+
+    def test_paren_numbers_are_not_a_list(self):
+        paragraphs = self.assertSameDocument('1) item one\n2) item two')
+        self.assertEqual(paragraphs, [('Normal', '1) item one\n2) item two')])
+
+    def test_list_does_not_interrupt_paragraph(self):
+        paragraphs = self.assertSameDocument('Steps:\n- one\n- two')
+        self.assertEqual(paragraphs, [('Normal', 'Steps:\n- one\n- two')])
+
+    def test_list_item_keeps_code_block(self):
+        paragraphs = self.assertSameDocument('- step\n\n  ```\n  cmd\n  ```')
+        self.assertEqual(paragraphs, [('List Bullet', 'step\ncmd')])
+
+    def test_loose_list_item_keeps_blank_line(self):
+        paragraphs = self.assertSameDocument('- one\n\n- two\n\n  more')
+        self.assertEqual(paragraphs, [('List Bullet', 'one'), ('List Bullet', 'two\n\nmore')])
+
+    def test_test_data_documents(self):
+        for name in sorted(os.listdir(TEST_DATA)):
+            if name.endswith('.md'):
+                with self.subTest(name), open(os.path.join(TEST_DATA, name), encoding='utf-8') as f:
+                    self.assertSameDocument(f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+A Notion export merged into one document follows the page tree and stores shared images once.
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import shutil
+import tempfile
+import zipfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# No image cache on disk, converted images would land in the working directory
+os.environ.setdefault('IMAGE_CACHE_MAX_BYTES', '0')
+
+import docx
+from PIL import Image
+from archive import ExportArchive
+from converter import notion_page_order, convert_notion_pages_to_docx
+
+ALPHA = 'Alpha ' + 'a' * 32
+BETA = 'Beta ' + 'b' * 32
+ZETA = 'Zeta ' + 'c' * 32
+
+
+def _png(color):
+    output = io.BytesIO()
+    Image.new('RGB', (40, 20), color).save(output, format='PNG')
+    return output.getvalue()
+
+
+def _link(*titles):
+    return '/'.join(title.replace(' ', '%20') for title in titles) + '.md'
+
+
+def _zip_bytes(members):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return output.getvalue()
+
+
+class NotionMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shared = _png((200, 30, 30))
+        # Links are URL-encoded and relative to the page, Zeta is linked first
+        alpha = (f'# Alpha\n\n[Zeta]({_link(ALPHA, ZETA)})\n\n[Beta]({_link(ALPHA, BETA)})\n\n'
+                 '![](shared.png)\n')
+        # Notion splits large exports into part zips, a subpage can be in another part than its parent
+        part1 = _zip_bytes({
+            f'{ALPHA}.md': alpha,
+            'shared.png': shared,
+            'Page 10 ' + 'd' * 32 + '.md': '# Page 10\n',
+        })
+        part2 = _zip_bytes({
+            f'{ALPHA}/{BETA}.md': '# Beta\n\n## Section\n\n![](shared.png)\n\n![](other.png)\n',
+            f'{ALPHA}/shared.png': shared,
+            f'{ALPHA}/other.png': _png((30, 30, 200)),
+            f'{ALPHA}/{ZETA}.md': 'Zeta has no heading of its own\n',
+            'Page 2 ' + 'e' * 32 + '.md': '# Page 2\n',
+        })
+        self.zip_path = os.path.join(self.directory, 'export.zip')
+        with open(self.zip_path, 'wb') as f:
+            f.write(_zip_bytes({'Export-Part-1.zip': part1, 'Export-Part-2.zip': part2}))
+        self.archive = ExportArchive(self.zip_path)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def merged(self):
+        pages = notion_page_order(self.archive.files('.md'))
+        output = io.BytesIO()
+        failed = convert_notion_pages_to_docx(pages, output)
+        self.assertEqual(failed, [])
+        return output.getvalue()
+
+    def test_page_order(self):
+        order = [(depth, title) for _, depth, title in notion_page_order(self.archive.files('.md'))]
+        # Subpages in the order their parent links to them, top-level pages by title, numbers by value
+        self.assertEqual(order, [(0, 'Alpha'), (1, 'Zeta'), (1, 'Beta'), (0, 'Page 2'), (0, 'Page 10')])
+
+    def test_headings_follow_page_tree(self):
+        document = docx.Document(io.BytesIO(self.merged()))
+        headings = [(paragraph.style.name, paragraph.text) for paragraph in document.paragraphs
+                    if paragraph.style.name.startswith('Heading')]
+        self.assertEqual(headings, [
+            ('Heading 1', 'Alpha'),
+            ('Heading 2', 'Zeta'),
+            ('Heading 2', 'Beta'),
+            ('Heading 3', 'Section'),
+            ('Heading 1', 'Page 2'),
+            ('Heading 1', 'Page 10'),
+        ])
+
+    def test_top_level_pages_start_on_new_page(self):
+        document = docx.Document(io.BytesIO(self.merged()))
+        breaks = document.element.body.xpath('.//w:br[@w:type="page"]')
+        self.assertEqual(len(breaks), 2)
+
+    def test_shared_image_is_stored_once(self):
+        data = self.merged()
+        document = docx.Document(io.BytesIO(data))
+        self.assertEqual(len(document.inline_shapes), 3)
+        with zipfile.ZipFile(io.BytesIO(data)) as package:
+            media = [name for name in package.namelist() if name.startswith('word/media/')]
+        self.assertEqual(len(media), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()